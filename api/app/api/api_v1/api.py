@@ -3,3 +3,4 @@ from fastapi import APIRouter
 
 router = APIRouter()
 router.include_router(llm_ep.router, prefix="/llm", tags=["llm"])
+router.include_router(llm_ep.admin_router, prefix="/llm", tags=["admin"])
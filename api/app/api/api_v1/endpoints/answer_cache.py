@@ -0,0 +1,203 @@
+"""
+Semantic answer cache.
+
+Answers are cached per tenant together with the embedding of the question
+they answer. A new question is served from the cache when its embedding is
+close enough (cosine similarity) to a cached question asked with the same
+generation parameters against the same version of the tenant's index.
+"""
+import os
+import time
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from langchain.schema import Document
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_ENABLED = os.environ.get('ANSWER_CACHE_ENABLED', 'true').lower() == 'true'
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.environ.get('ANSWER_CACHE_SIMILARITY_THRESHOLD', 0.95))
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get('ANSWER_CACHE_TTL_SECONDS', 3600))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', 1000))
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    docs: List[Document]
+    embedding: np.ndarray
+    created_at: float
+
+
+def normalize_question(q: str) -> str:
+    return " ".join(q.lower().split())
+
+
+class TenantAnswerCache:
+    """
+    Cache for a single tenant and index version. Entries are kept in LRU
+    order and the embeddings are matched with a single matrix product.
+    """
+    def __init__(self, index_version: str, max_entries: int, ttl_seconds: int):
+        self.index_version = index_version
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Tuple[str, str], CachedAnswer]" = OrderedDict()
+
+    def _expire(self, now: float) -> None:
+        expired = [k for k, e in self._entries.items() if now - e.created_at > self.ttl_seconds]
+        for k in expired:
+            del self._entries[k]
+
+    def lookup_exact(self, params_key: str, question: str) -> Optional[CachedAnswer]:
+        self._expire(time.time())
+        key = (params_key, normalize_question(question))
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def lookup(self, params_key: str, question: str, embedding: np.ndarray,
+               threshold: float) -> Tuple[Optional[CachedAnswer], float]:
+        entry = self.lookup_exact(params_key, question)
+        if entry is not None:
+            return entry, 1.0
+
+        candidates = [(k, e) for k, e in self._entries.items() if k[0] == params_key]
+        if not candidates:
+            return None, 0.0
+        matrix = np.stack([e.embedding for _, e in candidates])
+        scores = matrix @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] < threshold:
+            return None, float(scores[best])
+        k, entry = candidates[best]
+        self._entries.move_to_end(k)
+        return entry, float(scores[best])
+
+    def store(self, params_key: str, entry: CachedAnswer) -> None:
+        key = (params_key, normalize_question(entry.question))
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SemanticAnswerCache:
+    """
+    Per-tenant answer caches with hit/miss counters, keyed by tenant and
+    index version. The registry reports the version it serves through
+    index_swapped(), which drops the caches of the older versions. Requests
+    still running against an older version neither read nor fill the cache,
+    so they cannot evict the answers of the current version.
+    """
+    def __init__(self, threshold: float = ANSWER_CACHE_SIMILARITY_THRESHOLD,
+                 ttl_seconds: int = ANSWER_CACHE_TTL_SECONDS,
+                 max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._tenants: Dict[Tuple[str, str], TenantAnswerCache] = {}
+        self._current: Dict[str, str] = {}
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+        self.invalidations: Dict[str, int] = {}
+
+    def index_swapped(self, tenant_id: str, index_version: str) -> None:
+        """
+        Called by the registry whenever it serves a new version of a
+        tenant's index, including the first load.
+        """
+        self._current[tenant_id] = index_version
+        for key in [k for k in self._tenants if k[0] == tenant_id and k[1] != index_version]:
+            cache = self._tenants.pop(key)
+            if len(cache):
+                logger.info(f"index for tenant={tenant_id} changed, dropping {len(cache)} cached answers")
+                self.invalidations[tenant_id] = self.invalidations.get(tenant_id, 0) + 1
+
+    def _tenant_cache(self, tenant_id: str, index_version: str) -> Optional[TenantAnswerCache]:
+        current = self._current.get(tenant_id)
+        if current is not None and current != index_version:
+            return None
+        key = (tenant_id, index_version)
+        cache = self._tenants.get(key)
+        if cache is None:
+            cache = TenantAnswerCache(index_version, self.max_entries, self.ttl_seconds)
+            self._tenants[key] = cache
+        return cache
+
+    def lookup_exact(self, tenant_id: str, index_version: str, params_key: str,
+                     question: str) -> Optional[CachedAnswer]:
+        """
+        Matches the normalized question text only, so a repeated question is
+        answered without even embedding it. Misses are not counted here since
+        the caller goes on to lookup() with the embedding.
+        """
+        cache = self._tenant_cache(tenant_id, index_version)
+        entry = cache.lookup_exact(params_key, question) if cache is not None else None
+        if entry is not None:
+            self.hits[tenant_id] = self.hits.get(tenant_id, 0) + 1
+            logger.debug(f"answer cache exact hit for tenant={tenant_id}")
+        return entry
+
+    def lookup(self, tenant_id: str, index_version: str, params_key: str,
+               question: str, embedding: List[float]) -> Optional[CachedAnswer]:
+        cache = self._tenant_cache(tenant_id, index_version)
+        entry, score = (cache.lookup(params_key, question, _normalize(embedding), self.threshold)
+                        if cache is not None else (None, 0.0))
+        if entry is None:
+            self.misses[tenant_id] = self.misses.get(tenant_id, 0) + 1
+            return None
+        self.hits[tenant_id] = self.hits.get(tenant_id, 0) + 1
+        logger.debug(f"answer cache hit for tenant={tenant_id}, similarity={score:.3f}")
+        return entry
+
+    def store(self, tenant_id: str, index_version: str, params_key: str,
+              question: str, embedding: List[float], answer: str, docs: List[Document]) -> None:
+        cache = self._tenant_cache(tenant_id, index_version)
+        if cache is None:
+            return
+        cache.store(params_key, CachedAnswer(question=question,
+                                             answer=answer,
+                                             docs=docs,
+                                             embedding=_normalize(embedding),
+                                             created_at=time.time()))
+
+    def invalidate(self, tenant_id: str) -> None:
+        keys = [k for k in self._tenants if k[0] == tenant_id]
+        for key in keys:
+            del self._tenants[key]
+        if keys:
+            self.invalidations[tenant_id] = self.invalidations.get(tenant_id, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        entries: Dict[str, int] = {}
+        for (t, _), cache in self._tenants.items():
+            entries[t] = entries.get(t, 0) + len(cache)
+        tenants = set(entries) | set(self.hits) | set(self.misses)
+        stats = {}
+        for t in sorted(tenants):
+            hits, misses = self.hits.get(t, 0), self.misses.get(t, 0)
+            stats[t] = {
+                'entries': entries.get(t, 0),
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+                'invalidations': self.invalidations.get(t, 0),
+            }
+        return {'enabled': ANSWER_CACHE_ENABLED, 'threshold': self.threshold, 'tenants': stats}
+
+
+def _normalize(embedding: List[float]) -> np.ndarray:
+    v = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(v)
+    return v / norm if norm else v
+
+
+answer_cache = SemanticAnswerCache()
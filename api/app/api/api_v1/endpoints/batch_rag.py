@@ -0,0 +1,158 @@
+"""
+Bulk question answering for offline evaluation and FAQ generation.
+
+A batch is a list of single-turn requests for one tenant. Instead of running
+the /rag pipeline once per question, all the questions are embedded in
+batches, the index is searched once with the whole query matrix, and the
+answers are generated concurrently up to a limit. Batch requests do not
+read or write chat history.
+"""
+import os
+import json
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional
+import numpy as np
+from langchain.schema import Document
+from .clients import BEDROCK_SERVICE, run_blocking
+from .embeddings_cache import embed_scheduled, get_cached_embeddings
+from .answer_cache import ANSWER_CACHE_ENABLED, answer_cache, normalize_question
+from .fastapi_request import Request
+from .hybrid_search import HYBRID_CANDIDATES, has_lexical_index, hybrid_search
+from .rag_pipeline import cache_key, generate_answer
+from .vectordb_registry import VectorDBEntry
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_MODEL = os.environ.get('EMBEDDING_MODEL_ID')
+BATCH_MAX_REQUESTS = int(os.environ.get('BATCH_MAX_REQUESTS', 10000))
+BATCH_EMBEDDING_SIZE = int(os.environ.get('BATCH_EMBEDDING_SIZE', 256))
+BATCH_GENERATION_CONCURRENCY = int(os.environ.get('BATCH_GENERATION_CONCURRENCY', 16))
+# batch lines do not need a session, they never touch the chat history
+BATCH_SESSION_ID = "batch"
+
+
+def parse_batch(body: bytes) -> List[Request]:
+    """
+    Parses a JSONL body, one /rag request per line. Raises ValueError with
+    the offending line number.
+    """
+    reqs = []
+    for n, line in enumerate(body.decode("utf-8").splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            reqs.append(Request(**{'user_session_id': BATCH_SESSION_ID, **json.loads(line)}))
+        except Exception as e:
+            raise ValueError(f"line {n}: {e}")
+    if not reqs:
+        raise ValueError("the batch is empty")
+    if len(reqs) > BATCH_MAX_REQUESTS:
+        raise ValueError(f"the batch has {len(reqs)} requests, at most {BATCH_MAX_REQUESTS} are allowed")
+    return reqs
+
+
+async def embed_batch(questions: List[str]) -> np.ndarray:
+    """
+    Embeds the questions through the cached embeddings the indexes use.
+    Each question missing from the cache is scheduled as a Bedrock call of
+    its own, see embed_scheduled.
+    """
+    embeddings = get_cached_embeddings(EMBEDDINGS_MODEL, BEDROCK_SERVICE)
+    vectors = []
+    for i in range(0, len(questions), BATCH_EMBEDDING_SIZE):
+        vectors.extend(await embed_scheduled(embeddings, questions[i:i + BATCH_EMBEDDING_SIZE]))
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def _search(vector_db, questions: List[str], matrix: np.ndarray, k: int) -> List[List[Document]]:
+    if has_lexical_index(vector_db):
+        _, indices = vector_db.index.search(matrix, max(k, HYBRID_CANDIDATES))
+        return [hybrid_search(vector_db, q, v, k, vector_positions=row)
+                for q, v, row in zip(questions, matrix, indices)]
+
+    _, indices = vector_db.index.search(matrix, k)
+    results = []
+    for row in indices:
+        docs = []
+        for i in row:
+            if i == -1:
+                # fewer than k vectors in the index
+                continue
+            doc = vector_db.docstore.search(vector_db.index_to_docstore_id[int(i)])
+            if isinstance(doc, Document):
+                docs.append(doc)
+        results.append(docs)
+    return results
+
+
+async def search_batch(vector_db, questions: List[str], matrix: np.ndarray, k: int) -> List[List[Document]]:
+    """
+    A single FAISS search over the whole query matrix, each row is then
+    fused with BM25 when the index has a lexical index.
+    """
+    if len(matrix) == 0:
+        return []
+    return await run_blocking(_search, vector_db, questions, matrix, k)
+
+
+async def run_rag_batch(reqs: List[Request], entry: VectorDBEntry,
+                        concurrency: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Yields one result per request, in request order, as soon as the answers
+    before it are complete.
+    """
+    vector_db = entry.vector_db
+    matrix = await embed_batch([r.q for r in reqs])
+    logger.info(f"batch of {len(reqs)} requests embedded for tenant={entry.tenant_id}")
+
+    cached = [None] * len(reqs)
+    if ANSWER_CACHE_ENABLED:
+        cached = [answer_cache.lookup(entry.tenant_id, entry.version, cache_key(r), r.q, matrix[i].tolist())
+                  for i, r in enumerate(reqs)]
+    to_search = [i for i, c in enumerate(cached) if c is None]
+    k = max((reqs[i].max_matching_docs for i in to_search), default=0)
+    found = await search_batch(vector_db, [reqs[i].q for i in to_search], matrix[to_search], k)
+    docs = {i: d[:reqs[i].max_matching_docs] for i, d in zip(to_search, found)}
+
+    semaphore = asyncio.Semaphore(concurrency or BATCH_GENERATION_CONCURRENCY)
+    # repeated questions in a batch are generated once
+    generations: Dict[Any, asyncio.Future] = {}
+
+    async def generate(i: int) -> str:
+        async with semaphore:
+            answer_text = await generate_answer(reqs[i], reqs[i].q, docs[i])
+        if ANSWER_CACHE_ENABLED:
+            answer_cache.store(entry.tenant_id, entry.version, cache_key(reqs[i]), reqs[i].q,
+                               matrix[i].tolist(), answer_text, docs[i])
+        return answer_text
+
+    async def answer(i: int) -> Dict[str, Any]:
+        req = reqs[i]
+        result = {'index': i, 'question': req.q}
+        try:
+            if cached[i] is not None:
+                answer_text, answer_docs = cached[i].answer, cached[i].docs
+            else:
+                key = (cache_key(req), normalize_question(req.q))
+                if key not in generations:
+                    generations[key] = asyncio.ensure_future(generate(i))
+                answer_text, answer_docs = await asyncio.shield(generations[key]), docs[i]
+        except Exception as e:
+            logger.exception(f"batch request {i} failed")
+            result['error'] = str(e)
+            return result
+        result['answer'] = answer_text
+        result['cached'] = cached[i] is not None
+        if req.verbose is True:
+            result['docs'] = answer_docs
+        return result
+
+    tasks = [asyncio.ensure_future(answer(i)) for i in range(len(reqs))]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        # the client went away, stop generating
+        for task in [*tasks, *generations.values()]:
+            task.cancel()
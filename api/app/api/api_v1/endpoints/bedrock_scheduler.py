@@ -0,0 +1,268 @@
+"""
+Scheduler in front of every Bedrock invocation of the API.
+
+The Bedrock quota is shared by the account, so a single tenant asking many
+questions at once could throttle every other tenant. Each call therefore
+goes through three stages:
+
+- a token bucket per tenant, BEDROCK_TENANT_CALLS_PER_SECOND with bursts of
+  BEDROCK_TENANT_BURST calls, so no tenant gets more than its share. The
+  limit is per worker and off by default, it is meant for pods serving
+  several tenants;
+- a concurrency limit shared by the tenants of this worker. Calls that do not
+  get a slot wait in per-tenant queues served round robin, so a tenant with
+  a long queue does not delay the others. The limit adapts to Bedrock: it is
+  halved when Bedrock throttles and grows back by one slot per limit's worth
+  of successful calls, between 1 and MAX_CONCURRENT_BEDROCK_CALLS;
+- retries of throttled calls with full jitter exponential backoff.
+
+A call that cannot be made within BEDROCK_QUEUE_TIMEOUT_SECONDS, or is still
+throttled after BEDROCK_MAX_RETRIES retries, raises BedrockThrottledError,
+which the endpoints turn into a 429 with a Retry-After header.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import contextlib
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Deque, Dict
+from . import metrics
+from .clients import MAX_CONCURRENT_BEDROCK_CALLS, run_blocking
+from .tracing import current_tenant
+
+logger = logging.getLogger(__name__)
+
+# 0 disables the per-tenant rate limit
+BEDROCK_TENANT_CALLS_PER_SECOND = float(os.environ.get('BEDROCK_TENANT_CALLS_PER_SECOND', 0))
+BEDROCK_TENANT_BURST = int(os.environ.get('BEDROCK_TENANT_BURST', 40))
+BEDROCK_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('BEDROCK_QUEUE_TIMEOUT_SECONDS', 30))
+BEDROCK_MAX_RETRIES = int(os.environ.get('BEDROCK_MAX_RETRIES', 4))
+BEDROCK_BACKOFF_BASE_SECONDS = float(os.environ.get('BEDROCK_BACKOFF_BASE_SECONDS', 0.5))
+BEDROCK_BACKOFF_MAX_SECONDS = float(os.environ.get('BEDROCK_BACKOFF_MAX_SECONDS', 8))
+
+THROTTLING_ERRORS = ("ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException")
+# the concurrency limit is decreased at most once per interval, the calls in
+# flight when Bedrock starts throttling all fail together
+DECREASE_INTERVAL_SECONDS = 1.0
+
+
+class BedrockThrottledError(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_throttling_error(e: BaseException) -> bool:
+    # langchain re-raises the botocore error as a ValueError
+    while e is not None:
+        if isinstance(e, BedrockThrottledError) or any(code in str(e) for code in THROTTLING_ERRORS):
+            return True
+        e = e.__cause__ or e.__context__
+    return False
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Full jitter exponential backoff before retry number attempt + 1.
+    """
+    return random.uniform(0, min(BEDROCK_BACKOFF_MAX_SECONDS, BEDROCK_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def reserve(self, max_wait: float) -> float:
+        """
+        Takes a token and returns how long to wait until it is available,
+        tokens are reserved in advance so waiters are served in order.
+        Raises BedrockThrottledError when that is longer than max_wait.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+        if wait > max_wait:
+            raise BedrockThrottledError(f"the tenant exceeds {self.rate} Bedrock calls per second", wait)
+        self.tokens -= 1
+        return wait
+
+
+class BedrockScheduler:
+    """
+    Must be used from the event loop of the worker.
+    """
+    def __init__(self, max_concurrency: int = MAX_CONCURRENT_BEDROCK_CALLS,
+                 calls_per_second: float = BEDROCK_TENANT_CALLS_PER_SECOND, burst: int = BEDROCK_TENANT_BURST):
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.calls_per_second = calls_per_second
+        self.burst = burst
+        self.active = 0
+        self._buckets: Dict[str, TokenBucket] = {}
+        # tenant -> waiters, a tenant is moved to the end once served
+        self._waiting: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._last_decrease = 0.0
+        self.calls = 0
+        self.throttled = 0
+        self.retries = 0
+        self.rejected = 0
+        metrics.BEDROCK_CONCURRENCY_LIMIT.set(self.limit)
+
+    def _bucket(self, tenant: str) -> TokenBucket:
+        bucket = self._buckets.get(tenant)
+        if bucket is None:
+            bucket = self._buckets[tenant] = TokenBucket(self.calls_per_second, self.burst)
+        return bucket
+
+    def queue_depth(self, tenant: str) -> int:
+        return len(self._waiting.get(tenant, ()))
+
+    def _dispatch(self) -> None:
+        while self._waiting and self.active < int(self.limit):
+            tenant, waiters = self._waiting.popitem(last=False)
+            future = waiters.popleft()
+            if waiters:
+                self._waiting[tenant] = waiters
+            metrics.BEDROCK_QUEUE_DEPTH.set(len(waiters), tenant=tenant)
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    def _remove(self, tenant: str, future: asyncio.Future) -> None:
+        waiters = self._waiting.get(tenant)
+        if waiters is not None and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self._waiting[tenant]
+            metrics.BEDROCK_QUEUE_DEPTH.set(len(waiters), tenant=tenant)
+
+    async def acquire(self, tenant: str) -> None:
+        """
+        Waits for the tenant's token and then for a concurrency slot.
+        """
+        start = time.monotonic()
+        if self.calls_per_second > 0:
+            try:
+                wait = self._bucket(tenant).reserve(BEDROCK_QUEUE_TIMEOUT_SECONDS)
+            except BedrockThrottledError:
+                self._reject(tenant, "rate")
+                raise
+            if wait:
+                await asyncio.sleep(wait)
+
+        if self.active < int(self.limit) and not self._waiting:
+            self.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._waiting.setdefault(tenant, deque()).append(future)
+            metrics.BEDROCK_QUEUE_DEPTH.set(self.queue_depth(tenant), tenant=tenant)
+            try:
+                await asyncio.wait_for(future, max(0.0, BEDROCK_QUEUE_TIMEOUT_SECONDS - (time.monotonic() - start)))
+            except BaseException as e:
+                if future.done() and not future.cancelled():
+                    # the slot was handed over while giving up
+                    self._release_slot()
+                else:
+                    self._remove(tenant, future)
+                if isinstance(e, asyncio.TimeoutError):
+                    self._reject(tenant, "queue")
+                    raise BedrockThrottledError("no Bedrock capacity available for the tenant",
+                                                BEDROCK_QUEUE_TIMEOUT_SECONDS) from None
+                raise
+        metrics.BEDROCK_QUEUE_SECONDS.observe(time.monotonic() - start, tenant=tenant)
+
+    def _release_slot(self) -> None:
+        self.active -= 1
+        self._dispatch()
+
+    def release(self, throttled: bool) -> None:
+        """
+        Frees the slot of a call and adapts the concurrency limit to its
+        outcome.
+        """
+        now = time.monotonic()
+        if throttled:
+            self.throttled += 1
+            if now - self._last_decrease > DECREASE_INTERVAL_SECONDS:
+                self._last_decrease = now
+                self.limit = max(1.0, self.limit / 2)
+                logger.warning(f"Bedrock is throttling, concurrency limit lowered to {int(self.limit)}")
+        else:
+            self.calls += 1
+            self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+        metrics.BEDROCK_CONCURRENCY_LIMIT.set(self.limit)
+        self._release_slot()
+
+    def _reject(self, tenant: str, reason: str) -> None:
+        self.rejected += 1
+        metrics.BEDROCK_CALLS.inc(tenant=tenant, result=f"rejected_{reason}")
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tenant: str) -> AsyncIterator[None]:
+        """
+        Holds a concurrency slot while the body calls Bedrock, used as is by
+        the streamed generation which holds it for the whole stream.
+        """
+        await self.acquire(tenant)
+        throttled = False
+        try:
+            yield
+        except Exception as e:
+            throttled = is_throttling_error(e)
+            raise
+        finally:
+            self.release(throttled)
+            metrics.BEDROCK_CALLS.inc(tenant=tenant, result="throttled" if throttled else "ok")
+
+    async def run(self, func, *args, **kwargs) -> Any:
+        """
+        Runs a blocking Bedrock call on the IO thread pool for the tenant of
+        the current request, retrying it while Bedrock throttles.
+        """
+        tenant = current_tenant()
+        for attempt in range(BEDROCK_MAX_RETRIES + 1):
+            try:
+                async with self.slot(tenant):
+                    return await run_blocking(func, *args, **kwargs)
+            except Exception as e:
+                await self.backoff(tenant, attempt, e)
+
+    async def backoff(self, tenant: str, attempt: int, error: Exception) -> None:
+        """
+        Waits before retrying a call that failed with error, or raises when
+        the call must not be retried.
+        """
+        if isinstance(error, BedrockThrottledError) or not is_throttling_error(error):
+            raise error
+        if attempt >= BEDROCK_MAX_RETRIES:
+            self._reject(tenant, "retries")
+            raise BedrockThrottledError(f"Bedrock is still throttling after {attempt} retries",
+                                        BEDROCK_BACKOFF_MAX_SECONDS) from error
+        self.retries += 1
+        await asyncio.sleep(backoff_delay(attempt))
+
+    def stats(self) -> Dict[str, Any]:
+        return {'concurrency_limit': int(self.limit),
+                'max_concurrency': self.max_concurrency,
+                'active': self.active,
+                'queued': {t: len(w) for t, w in self._waiting.items()},
+                'calls': self.calls,
+                'throttled': self.throttled,
+                'retries': self.retries,
+                'rejected': self.rejected}
+
+
+scheduler = BedrockScheduler()
+
+
+async def run_bedrock(func, *args, **kwargs):
+    """
+    Same as run_blocking but scheduled by the Bedrock scheduler.
+    """
+    return await scheduler.run(func, *args, **kwargs)
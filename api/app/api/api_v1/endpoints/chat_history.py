@@ -0,0 +1,325 @@
+"""
+Bounded chat history stored in DynamoDB.
+
+A session item keeps between HISTORY_WINDOW_TURNS and HISTORY_MAX_TURNS of
+the last turns verbatim plus a rolling summary of the older ones, so its
+size, and the prompt built from it, stay bounded however long the
+conversation gets. A turn is appended with list_append, which writes only the
+new messages. Once more than HISTORY_MAX_TURNS turns are stored the item is
+compacted: the oldest turns are folded into the summary and only the last
+HISTORY_WINDOW_TURNS turns are written back. Compacting every few turns
+rather than on every turn keeps the summary calls rare, so the history read
+back, and the prompt, hold up to HISTORY_MAX_TURNS turns.
+
+The history of the active sessions is cached in-process. Before a cached
+copy is read its version is checked against the item with a consistent read
+of the Version attribute only, at most once every HISTORY_CACHE_CHECK_SECONDS,
+so turns written by another worker or pod are seen. Every write is also
+conditional on the version the cache holds, so a stale copy is reloaded
+instead of overwriting newer turns.
+
+Turns can also be added to the cache only, and written later by the history
+writer, see history_writer. The cache keeps the sessions with unsaved turns
+until they are written.
+"""
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Tuple
+from botocore.exceptions import ClientError
+from langchain.schema import BaseChatMessageHistory
+from langchain.schema.messages import (BaseMessage,
+                                       messages_from_dict,
+                                       messages_to_dict)
+
+logger = logging.getLogger(__name__)
+
+HISTORY_WINDOW_TURNS = int(os.environ.get('HISTORY_WINDOW_TURNS', 4))
+# turns stored before the item is compacted back to the window
+HISTORY_MAX_TURNS = max(int(os.environ.get('HISTORY_MAX_TURNS', 8)), HISTORY_WINDOW_TURNS)
+HISTORY_SUMMARY_MAX_CHARS = int(os.environ.get('HISTORY_SUMMARY_MAX_CHARS', 2000))
+HISTORY_CACHE_MAX_SESSIONS = int(os.environ.get('HISTORY_CACHE_MAX_SESSIONS', 10000))
+HISTORY_CACHE_TTL_SECONDS = int(os.environ.get('HISTORY_CACHE_TTL_SECONDS', 300))
+# the reads of one request share a version check
+HISTORY_CACHE_CHECK_SECONDS = float(os.environ.get('HISTORY_CACHE_CHECK_SECONDS', 1))
+
+# a turn is a question and its answer
+MESSAGES_PER_TURN = 2
+
+
+@dataclass
+class SessionHistory:
+    messages: List[BaseMessage] = field(default_factory=list)
+    summary: str = ""
+    # version of the item the messages were read from, None when there is no
+    # item or it was written before versions were stored
+    version: Optional[int] = None
+    loaded_at: float = field(default_factory=time.time)
+    # when the version was last checked against the item
+    checked_at: float = field(default_factory=time.time)
+    # the last messages are not written to the item yet
+    unsaved: int = 0
+
+    @property
+    def saved_messages(self) -> List[BaseMessage]:
+        return self.messages[:len(self.messages) - self.unsaved]
+
+
+class SessionHistoryCache:
+    """
+    LRU of the history of the most recently active sessions.
+    """
+    def __init__(self, max_sessions: int = HISTORY_CACHE_MAX_SESSIONS,
+                 ttl_seconds: int = HISTORY_CACHE_TTL_SECONDS):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._sessions: "OrderedDict[Tuple[str, str], SessionHistory]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[str, str]) -> Optional[SessionHistory]:
+        with self._lock:
+            state = self._sessions.get(key)
+            if state is None or (not state.unsaved and time.time() - state.loaded_at > self.ttl_seconds):
+                self._sessions.pop(key, None)
+                self.misses += 1
+                return None
+            self._sessions.move_to_end(key)
+            self.hits += 1
+            return state
+
+    def put(self, key: Tuple[str, str], state: SessionHistory) -> None:
+        with self._lock:
+            self._put(key, state)
+
+    def _put(self, key: Tuple[str, str], state: SessionHistory) -> None:
+        self._sessions[key] = state
+        self._sessions.move_to_end(key)
+        if len(self._sessions) > self.max_sessions:
+            # sessions with unsaved turns are kept, the writer bounds them
+            for k in [k for k, s in self._sessions.items() if not s.unsaved][:len(self._sessions) - self.max_sessions]:
+                del self._sessions[k]
+
+    def update(self, key: Tuple[str, str],
+               func: Callable[[Optional[SessionHistory]], Optional[SessionHistory]]) -> None:
+        """
+        Replaces the state of a session by func(state) atomically, the
+        session is dropped when func returns None.
+        """
+        with self._lock:
+            state = func(self._sessions.get(key))
+            if state is None:
+                self._sessions.pop(key, None)
+            else:
+                self._put(key, state)
+
+    def drop(self, key: Tuple[str, str]) -> None:
+        with self._lock:
+            self._sessions.pop(key, None)
+
+    def stats(self):
+        return {'sessions': len(self._sessions), 'hits': self.hits, 'misses': self.misses,
+                'unsaved_sessions': sum(1 for s in list(self._sessions.values()) if s.unsaved)}
+
+
+history_cache = SessionHistoryCache()
+
+
+def _is_conditional_check_failed(err: ClientError) -> bool:
+    return err.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+
+class WindowedDynamoDBChatMessageHistory(BaseChatMessageHistory):
+    """
+    Chat history of one session, backed by a Table resource created once per
+    process and by the in-process session cache.
+    """
+    def __init__(self, table, session_id: str, primary_key_name: str = "SessionId",
+                 cache: SessionHistoryCache = history_cache):
+        self.table = table
+        self.session_id = session_id
+        self.key = {primary_key_name: session_id}
+        self.cache = cache
+        self.cache_key = (table.name, session_id)
+
+    @property
+    def messages(self) -> List[BaseMessage]:  # type: ignore
+        return list(self._state().messages)
+
+    @property
+    def summary(self) -> str:
+        return self._state().summary
+
+    def _state(self) -> SessionHistory:
+        state = self.cache.get(self.cache_key)
+        if state is not None and not state.unsaved and time.time() - state.checked_at >= HISTORY_CACHE_CHECK_SECONDS:
+            state = self._check(state)
+        if state is None:
+            loaded = [self._load()]
+
+            def keep_unsaved(current: Optional[SessionHistory]) -> SessionHistory:
+                # turns may have been added while the item was read
+                loaded[0] = current if current is not None and current.unsaved else loaded[0]
+                return loaded[0]
+            self.cache.update(self.cache_key, keep_unsaved)
+            state = loaded[0]
+        return state
+
+    def _check(self, state: SessionHistory) -> Optional[SessionHistory]:
+        """
+        Returns state if the item still has its version, otherwise drops it
+        from the cache and returns None. Sessions with unsaved turns are not
+        checked, their write detects a newer item.
+        """
+        try:
+            response = self.table.get_item(Key=self.key, ProjectionExpression="#version",
+                                           ExpressionAttributeNames={"#version": "Version"}, ConsistentRead=True)
+        except ClientError as err:
+            logger.error(err)
+            return state
+        version = response.get("Item", {}).get("Version")
+        if (int(version) if version is not None else None) == state.version:
+            state.checked_at = time.time()
+            return state
+        logger.info(f"history of session {self.session_id} changed, reloading it")
+        # turns may have been added meanwhile, they are kept
+        self.cache.update(self.cache_key, lambda current: None if current is state else current)
+        return None
+
+    def _load(self) -> SessionHistory:
+        try:
+            response = self.table.get_item(Key=self.key, ConsistentRead=True)
+        except ClientError as err:
+            if err.response['Error']['Code'] == 'ResourceNotFoundException':
+                logger.warning(f"No record found with session id: {self.session_id}")
+            else:
+                logger.error(err)
+            return SessionHistory()
+        item = response.get("Item")
+        if item is None:
+            return SessionHistory()
+        version = item.get("Version")
+        return SessionHistory(messages=messages_from_dict(item.get("History", [])),
+                              summary=item.get("Summary", ""),
+                              version=int(version) if version is not None else None)
+
+    def _condition(self, state: SessionHistory):
+        if state.version is None:
+            return "attribute_not_exists(Version)", {}
+        return "Version = :version", {":version": state.version}
+
+    def evicted_by(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        """
+        The messages that fall out of the window when messages are added,
+        empty unless the item is due for compaction.
+        """
+        combined = self._state().messages + list(messages)
+        if len(combined) <= HISTORY_MAX_TURNS * MESSAGES_PER_TURN:
+            return []
+        return combined[:-HISTORY_WINDOW_TURNS * MESSAGES_PER_TURN]
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.add_messages([message])
+
+    def add_messages(self, messages: List[BaseMessage], summary: Optional[str] = None) -> None:
+        """
+        Appends the messages of a turn, compacting the item when it holds
+        more than HISTORY_MAX_TURNS turns. summary replaces the stored one on
+        compaction, the evicted messages are dropped when it is None.
+        """
+        self.add_unsaved(messages)
+        try:
+            self.save_unsaved(len(messages), summary)
+        except ClientError as err:
+            logger.error(err)
+            self.cache.drop(self.cache_key)
+
+    def add_unsaved(self, messages: List[BaseMessage]) -> None:
+        """
+        Appends the messages to the cached history only, they are read back
+        with the history until save_unsaved writes them.
+        """
+        self._state()
+
+        def append(state: Optional[SessionHistory]) -> SessionHistory:
+            state = state or SessionHistory()
+            return SessionHistory(messages=state.messages + list(messages), summary=state.summary,
+                                  version=state.version, loaded_at=state.loaded_at,
+                                  unsaved=state.unsaved + len(messages))
+        self.cache.update(self.cache_key, append)
+
+    def unsaved(self) -> Tuple[List[BaseMessage], List[BaseMessage]]:
+        """
+        The unsaved messages and the ones they evict from the window once
+        written, see evicted_by.
+        """
+        state = self._state()
+        messages = state.messages[len(state.messages) - state.unsaved:]
+        combined = state.messages
+        if len(combined) <= HISTORY_MAX_TURNS * MESSAGES_PER_TURN:
+            return messages, []
+        return messages, combined[:-HISTORY_WINDOW_TURNS * MESSAGES_PER_TURN]
+
+    def save_unsaved(self, count: int, summary: Optional[str] = None) -> None:
+        """
+        Writes the first count unsaved messages, reloading the item and
+        writing them again when another worker changed it. Turns added
+        meanwhile stay unsaved. Raises the ClientError of a failed write.
+        """
+        state = self._state()
+        messages = state.messages[len(state.messages) - state.unsaved:][:count]
+        if not messages:
+            return
+        base = SessionHistory(messages=state.saved_messages, summary=state.summary, version=state.version)
+        for attempt in range(2):
+            try:
+                written = self._write(base, messages, summary)
+                break
+            except ClientError as err:
+                if not _is_conditional_check_failed(err) or attempt == 1:
+                    raise
+                logger.info(f"history of session {self.session_id} changed, reloading it")
+                base = self._load()
+
+        def merge(current: Optional[SessionHistory]) -> SessionHistory:
+            later = current.messages[len(current.messages) - current.unsaved + len(messages):] if current else []
+            return SessionHistory(messages=written.messages + later, summary=written.summary,
+                                  version=written.version, unsaved=len(later))
+        self.cache.update(self.cache_key, merge)
+
+    def _write(self, state: SessionHistory, messages: List[BaseMessage],
+               summary: Optional[str]) -> SessionHistory:
+        condition, values = self._condition(state)
+        version = (state.version or 0) + 1
+        combined = state.messages + messages
+        if len(combined) <= HISTORY_MAX_TURNS * MESSAGES_PER_TURN:
+            self.table.update_item(
+                Key=self.key,
+                UpdateExpression="SET History = list_append(if_not_exists(History, :empty), :new), "
+                                 "Version = :next",
+                ConditionExpression=condition,
+                ExpressionAttributeValues={**values, ":empty": [], ":new": messages_to_dict(messages),
+                                           ":next": version})
+            return SessionHistory(messages=combined, summary=state.summary, version=version)
+
+        window = combined[-HISTORY_WINDOW_TURNS * MESSAGES_PER_TURN:]
+        summary = state.summary if summary is None else summary[-HISTORY_SUMMARY_MAX_CHARS:]
+        self.table.update_item(
+            Key=self.key,
+            UpdateExpression="SET History = :window, Summary = :summary, Version = :next",
+            ConditionExpression=condition,
+            ExpressionAttributeValues={**values, ":window": messages_to_dict(window),
+                                       ":summary": summary, ":next": version})
+        logger.info(f"compacted history of session {self.session_id} to {len(window)} messages")
+        return SessionHistory(messages=window, summary=summary, version=version)
+
+    def clear(self) -> None:
+        try:
+            self.table.delete_item(Key=self.key)
+        except ClientError as err:
+            logger.error(err)
+        self.cache.drop(self.cache_key)
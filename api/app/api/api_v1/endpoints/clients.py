@@ -0,0 +1,102 @@
+import os
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+
+logger = logging.getLogger(__name__)
+
+BEDROCK_SERVICE = os.environ.get('BEDROCK_SERVICE')
+
+# size of the botocore connection pools, one pool per client per process
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.environ.get('BEDROCK_MAX_POOL_CONNECTIONS', 64))
+DYNAMODB_MAX_POOL_CONNECTIONS = int(os.environ.get('DYNAMODB_MAX_POOL_CONNECTIONS', 32))
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 16))
+
+# concurrency limits, the thread pool is where all the blocking boto3 calls run.
+# Bedrock calls are scheduled by bedrock_scheduler within MAX_CONCURRENT_BEDROCK_CALLS
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 256))
+MAX_CONCURRENT_BEDROCK_CALLS = int(os.environ.get('MAX_CONCURRENT_BEDROCK_CALLS', BEDROCK_MAX_POOL_CONNECTIONS))
+BLOCKING_IO_THREADS = int(os.environ.get('BLOCKING_IO_THREADS',
+                                         BEDROCK_MAX_POOL_CONNECTIONS + DYNAMODB_MAX_POOL_CONNECTIONS))
+
+_executor = ThreadPoolExecutor(max_workers=BLOCKING_IO_THREADS, thread_name_prefix="ragapi-io")
+
+# asyncio primitives bind to the running loop on first use, so it is
+# safe to create them at import time
+request_limiter = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+
+def _client_config(max_pool_connections: int, max_attempts: int = 3) -> Config:
+    return Config(max_pool_connections=max_pool_connections,
+                  retries={'max_attempts': max_attempts, 'mode': 'adaptive' if max_attempts > 1 else 'standard'})
+
+
+@functools.lru_cache(maxsize=None)
+def _session() -> boto3.session.Session:
+    return boto3.session.Session()
+
+
+def get_bedrock_client(bedrock_service: str = BEDROCK_SERVICE):
+    """
+    Returns the process wide Bedrock runtime client. boto3 clients are
+    thread safe so a single client (and its connection pool) is shared by
+    every request served by this worker.
+    """
+    return _bedrock_client(bedrock_service)
+
+
+@functools.lru_cache(maxsize=None)
+def _bedrock_client(bedrock_service: str):
+    logger.info(f"creating {bedrock_service} client, max_pool_connections={BEDROCK_MAX_POOL_CONNECTIONS}")
+    # a single attempt, throttled calls are retried by bedrock_scheduler
+    # which also adapts its concurrency limit to them
+    return _session().client(service_name=bedrock_service,
+                             config=_client_config(BEDROCK_MAX_POOL_CONNECTIONS, max_attempts=1))
+
+
+@functools.lru_cache(maxsize=None)
+def get_s3_client():
+    """
+    Returns the process wide S3 client.
+    """
+    return _session().client('s3', config=_client_config(S3_MAX_POOL_CONNECTIONS))
+
+
+@functools.lru_cache(maxsize=None)
+def get_dynamodb_table(table_name: str):
+    """
+    Returns a DynamoDB Table resource backed by a pooled client. The table is
+    not loaded here, so no DescribeTable round trip is made.
+    """
+    logger.info(f"creating dynamodb resource for table={table_name}, "
+                f"max_pool_connections={DYNAMODB_MAX_POOL_CONNECTIONS}")
+    dynamodb = _session().resource('dynamodb', config=_client_config(DYNAMODB_MAX_POOL_CONNECTIONS))
+    return dynamodb.Table(table_name)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs a blocking call (boto3, FAISS, langchain) on the bounded IO thread
+    pool without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def reset_after_fork():
+    """
+    Called in a worker forked from a process that already used the clients,
+    e.g. the gunicorn master with preload_app. Connection pools and threads
+    are not shared with a forked process, so the worker creates its own.
+    """
+    global _executor
+    for cached in (_session, _bedrock_client, get_s3_client, get_dynamodb_table):
+        cached.cache_clear()
+    _executor = ThreadPoolExecutor(max_workers=BLOCKING_IO_THREADS, thread_name_prefix="ragapi-io")
+
+
+def shutdown():
+    _executor.shutdown(wait=False, cancel_futures=True)
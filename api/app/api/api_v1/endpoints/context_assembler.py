@@ -0,0 +1,135 @@
+"""
+Builds the context of the QA prompt from the retrieved chunks.
+
+The ingestion script splits with chunk_size=2000 and chunk_overlap=400, so
+adjacent chunks of the same row share up to 400 characters, and identical
+chunks can come back from different retrievers. The assembler drops
+duplicates and chunks contained in others, merges chunks that overlap into a
+single span and then keeps the chunks, most relevant first, within a token
+budget proportional to the request's maxTokenCount. The last chunk that does
+not fit is cut at a sentence boundary rather than dropped.
+"""
+import os
+import math
+import logging
+from dataclasses import dataclass
+from typing import Dict, List
+from langchain.schema import Document
+
+logger = logging.getLogger(__name__)
+
+# context budget in tokens as a multiple of maxTokenCount, 0 disables trimming
+CONTEXT_TOKEN_BUDGET_RATIO = float(os.environ.get('CONTEXT_TOKEN_BUDGET_RATIO', 8))
+# Claude and Titan average about 4 characters per token on English text
+CHARS_PER_TOKEN = float(os.environ.get('CHARS_PER_TOKEN', 4))
+# shorter overlaps are not considered shared text
+MIN_OVERLAP_CHARS = int(os.environ.get('MIN_OVERLAP_CHARS', 50))
+# a chunk is cut to fit the budget only when at least this many tokens fit
+MIN_TRUNCATED_TOKENS = int(os.environ.get('MIN_TRUNCATED_TOKENS', 100))
+
+context_stats: Dict[str, int] = {'requests': 0, 'tokens_before': 0, 'tokens_after': 0}
+
+
+@dataclass
+class AssembledContext:
+    texts: List[str]
+    tokens_before: int
+    tokens_after: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _overlap(a: str, b: str) -> int:
+    """
+    Length of the longest suffix of a that is a prefix of b.
+    """
+    if len(b) < MIN_OVERLAP_CHARS:
+        return 0
+    # the overlap starts at an occurrence of b's first characters in a
+    i = a.find(b[:MIN_OVERLAP_CHARS], max(0, len(a) - len(b)))
+    while i != -1:
+        if b.startswith(a[i:]):
+            return len(a) - i
+        i = a.find(b[:MIN_OVERLAP_CHARS], i + 1)
+    return 0
+
+
+def _merge(texts: List[str]) -> List[str]:
+    """
+    Removes texts contained in another and merges overlapping texts into the
+    more relevant one, keeping the order of relevance.
+    """
+    spans: List[str] = []
+    for text in texts:
+        for i, span in enumerate(spans):
+            if text in span:
+                break
+            if span in text:
+                spans[i] = text
+                break
+            n = _overlap(span, text)
+            if n:
+                spans[i] = span + text[n:]
+                break
+            n = _overlap(text, span)
+            if n:
+                spans[i] = text + span[n:]
+                break
+        else:
+            spans.append(text)
+            continue
+        # the grown span may now swallow or overlap another one
+        spans = _merge(spans) if len(spans) > 1 else spans
+    return spans
+
+
+def _truncate(text: str, max_chars: int) -> str:
+    cut = text[:max_chars]
+    for sep in (". ", "\n", " "):
+        i = cut.rfind(sep)
+        if i > max_chars // 2:
+            return cut[:i + 1].rstrip()
+    return cut
+
+
+def assemble_context(docs: List[Document], max_token_count: int) -> AssembledContext:
+    texts = [d.page_content for d in docs]
+    tokens_before = sum(estimate_tokens(t) for t in texts)
+    spans = _merge(texts)
+
+    if CONTEXT_TOKEN_BUDGET_RATIO > 0:
+        budget = int(CONTEXT_TOKEN_BUDGET_RATIO * max_token_count)
+        kept, used = [], 0
+        for span in spans:
+            tokens = estimate_tokens(span)
+            if used + tokens <= budget:
+                kept.append(span)
+                used += tokens
+                continue
+            remaining = budget - used
+            if remaining >= MIN_TRUNCATED_TOKENS or not kept:
+                kept.append(_truncate(span, int(remaining * CHARS_PER_TOKEN)))
+            break
+        spans = kept
+
+    context = AssembledContext(spans, tokens_before, sum(estimate_tokens(s) for s in spans))
+    context_stats['requests'] += 1
+    context_stats['tokens_before'] += context.tokens_before
+    context_stats['tokens_after'] += context.tokens_after
+    logger.info(f"context of {len(docs)} chunks assembled into {len(spans)} spans, "
+                f"tokens {context.tokens_before} -> {context.tokens_after}, saved {context.tokens_saved}")
+    return context
+
+
+def stats() -> Dict[str, object]:
+    saved = context_stats['tokens_before'] - context_stats['tokens_after']
+    return {**context_stats,
+            'tokens_saved': saved,
+            'budget_ratio': CONTEXT_TOKEN_BUDGET_RATIO,
+            'saved_rate': saved / context_stats['tokens_before'] if context_stats['tokens_before'] else 0.0}
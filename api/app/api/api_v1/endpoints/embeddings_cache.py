@@ -0,0 +1,236 @@
+"""
+Content addressed cache in front of an embeddings model.
+
+Embeddings are keyed by a hash of the model id and the text. They are kept in
+an in-memory LRU and, when EMBEDDING_CACHE_DIR is set, in a SQLite file that
+is shared by all the workers on the node and survives restarts. Concurrent
+requests for the same text wait for a single call to the model, and batches
+are de-duplicated and embedded in parallel.
+
+The API embeds through embed_scheduled, which looks the texts up first so
+only the misses are Bedrock calls, each one scheduled by the Bedrock
+scheduler.
+"""
+import os
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import threading
+import functools
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+from .bedrock_scheduler import run_bedrock
+from .clients import get_bedrock_client, run_blocking
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', 50000))
+EMBEDDING_CACHE_DIR = os.environ.get('EMBEDDING_CACHE_DIR')
+# Titan embeddings take one text per invocation, a batch is fanned out
+# over this many parallel calls
+EMBEDDING_BATCH_CONCURRENCY = int(os.environ.get('EMBEDDING_BATCH_CONCURRENCY', 8))
+
+
+def embedding_key(model_id: str, text: str) -> str:
+    return hashlib.sha256(f"{model_id}\0{text}".encode("utf-8")).hexdigest()
+
+
+class DiskEmbeddingStore:
+    """
+    SQLite backed key -> float32 vector store.
+    """
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        conn = self._conn()
+        # stay well below the sqlite host parameter limit
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                                chunk).fetchall()
+            for key, blob in rows:
+                found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        if not items:
+            return
+        with self._conn() as conn:
+            conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                             [(k, np.asarray(v, dtype=np.float32).tobytes()) for k, v in items.items()])
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings object (e.g. BedrockEmbeddings) with the cache.
+    Thread safe, it is called from the IO thread pool.
+    """
+    def __init__(self, embeddings: Embeddings, model_id: str,
+                 max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+                 disk_store: Optional[DiskEmbeddingStore] = None,
+                 batch_concurrency: int = EMBEDDING_BATCH_CONCURRENCY):
+        self.embeddings = embeddings
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.disk_store = disk_store
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._batch_executor = ThreadPoolExecutor(max_workers=batch_concurrency,
+                                                  thread_name_prefix="embeddings")
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        # must be called with the lock held
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _embed_uncached(self, texts: List[str]) -> List[List[float]]:
+        if len(texts) == 1:
+            return [self.embeddings.embed_query(texts[0])]
+        return list(self._batch_executor.map(self.embeddings.embed_query, texts))
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        keys = [embedding_key(self.model_id, t) for t in texts]
+        results: Dict[str, List[float]] = {}
+        waiting: Dict[str, Future] = {}
+        owned: Dict[str, str] = {}
+
+        with self._lock:
+            for key, text in zip(keys, texts):
+                if key in results or key in waiting or key in owned:
+                    continue
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    results[key] = self._memory[key]
+                    self.hits += 1
+                elif key in self._inflight:
+                    # somebody else is already embedding this text
+                    waiting[key] = self._inflight[key]
+                    self.coalesced += 1
+                else:
+                    self._inflight[key] = Future()
+                    owned[key] = text
+
+        if owned:
+            try:
+                self._fill(owned, results)
+            except Exception as e:
+                with self._lock:
+                    for key in owned:
+                        self._inflight.pop(key).set_exception(e)
+                raise
+
+        for key, future in waiting.items():
+            results[key] = future.result()
+        return [results[k] for k in keys]
+
+    def _fill(self, owned: Dict[str, str], results: Dict[str, List[float]]) -> None:
+        found = self.disk_store.get_many(list(owned)) if self.disk_store else {}
+        missing = [k for k in owned if k not in found]
+        computed = dict(zip(missing, self._embed_uncached([owned[k] for k in missing]))) if missing else {}
+        if self.disk_store:
+            self.disk_store.put_many(computed)
+
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(computed)
+            for key, vector in {**found, **computed}.items():
+                self._remember(key, vector)
+                results[key] = vector
+                self._inflight.pop(key).set_result(vector)
+
+    def cached(self, texts: List[str]) -> Dict[str, List[float]]:
+        """
+        The vectors of the texts found in memory or on disk, without calling
+        the model.
+        """
+        keys = {embedding_key(self.model_id, t): t for t in texts}
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            for key, text in keys.items():
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[text] = self._memory[key]
+        missing = [k for k, t in keys.items() if t not in found]
+        if self.disk_store and missing:
+            on_disk = self.disk_store.get_many(missing)
+            with self._lock:
+                for key, vector in on_disk.items():
+                    self._remember(key, vector)
+                    found[keys[key]] = vector
+        with self._lock:
+            self.hits += len(found)
+        return found
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0]
+
+    def stats(self) -> Dict[str, int]:
+        return {'entries': len(self._memory), 'hits': self.hits,
+                'misses': self.misses, 'coalesced': self.coalesced}
+
+
+async def embed_scheduled(embeddings: CachedEmbeddings, texts: List[str],
+                          concurrency: int = EMBEDDING_BATCH_CONCURRENCY) -> List[List[float]]:
+    """
+    Embeds the texts, each one missing from the cache is a Bedrock call of
+    its own scheduled for the tenant of the request, up to concurrency at
+    once. The vectors embedded before a call fails stay cached, so a retry
+    only embeds the rest.
+    """
+    found = await run_blocking(embeddings.cached, texts)
+    missing = [t for t in dict.fromkeys(texts) if t not in found]
+    if missing:
+        limiter = asyncio.Semaphore(concurrency)
+
+        async def embed(text: str) -> List[float]:
+            async with limiter:
+                return await run_bedrock(embeddings.embed_query, text)
+        vectors = await asyncio.gather(*(embed(t) for t in missing), return_exceptions=True)
+        for vector in vectors:
+            if isinstance(vector, BaseException):
+                raise vector
+        found.update(zip(missing, vectors))
+    return [found[t] for t in texts]
+
+
+@functools.lru_cache(maxsize=None)
+def get_cached_embeddings(embeddings_model: str, bedrock_service: str) -> CachedEmbeddings:
+    """
+    Returns the process wide cached embeddings for a model, shared by the
+    indexes of all tenants.
+    """
+    disk_store = None
+    if EMBEDDING_CACHE_DIR:
+        disk_store = DiskEmbeddingStore(os.path.join(EMBEDDING_CACHE_DIR, "embeddings.sqlite"))
+        logger.info(f"using on-disk embedding cache at {disk_store.path}")
+    # langchain.embeddings imports every embeddings integration
+    from langchain.embeddings import BedrockEmbeddings
+    br_embeddings = BedrockEmbeddings(client=get_bedrock_client(bedrock_service), model_id=embeddings_model)
+    return CachedEmbeddings(br_embeddings, embeddings_model, disk_store=disk_store)
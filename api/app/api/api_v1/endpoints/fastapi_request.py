@@ -2,7 +2,7 @@ import os
 import boto3
 from enum import Enum
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 class Text2TextModelName(str, Enum):
     modelId = os.environ.get('TEXT2TEXT_MODEL_ID')
@@ -16,6 +16,8 @@ class VectorDBType(str, Enum):
 class Request(BaseModel):
     q: str
     user_session_id: str
+    # only used when the X-Auth-Request-Tenantid header is not set
+    tenant_id: Optional[str] = None
     max_length: int = 500
     num_return_sequences: int = 1
     do_sample: bool = False
@@ -0,0 +1,192 @@
+"""
+Write-behind of the chat history.
+
+A turn is added to the session cache right away, so the next question of
+the session sees it, and the response is returned without waiting for
+DynamoDB. A background task then writes the unsaved turns in batches of up
+to HISTORY_WRITE_BATCH_SIZE sessions, one conditional update per session
+however many turns it gained meanwhile. BatchWriteItem cannot append to a
+list or check the session's version, so the updates of a batch are sent
+concurrently instead.
+
+Failed writes are retried with backoff. When HISTORY_WRITE_MAX_SESSIONS
+sessions are waiting, turns are written on the response path again until
+the writer catches up. The pending turns are flushed on shutdown.
+"""
+import os
+import random
+import asyncio
+import logging
+import contextvars
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from botocore.exceptions import ClientError
+from langchain.schema.messages import BaseMessage
+from . import metrics
+from .chat_history import WindowedDynamoDBChatMessageHistory
+from .clients import run_blocking
+from .tracing import span
+
+logger = logging.getLogger(__name__)
+
+HISTORY_WRITE_BEHIND_ENABLED = os.environ.get('HISTORY_WRITE_BEHIND_ENABLED', 'true').lower() == 'true'
+HISTORY_WRITE_BATCH_SIZE = int(os.environ.get('HISTORY_WRITE_BATCH_SIZE', 25))
+HISTORY_WRITE_MAX_SESSIONS = int(os.environ.get('HISTORY_WRITE_MAX_SESSIONS', 5000))
+# how long the writer waits for more turns before writing a batch
+HISTORY_WRITE_LINGER_MS = int(os.environ.get('HISTORY_WRITE_LINGER_MS', 20))
+HISTORY_WRITE_MAX_RETRIES = int(os.environ.get('HISTORY_WRITE_MAX_RETRIES', 5))
+HISTORY_WRITE_SHUTDOWN_TIMEOUT_SECONDS = float(os.environ.get('HISTORY_WRITE_SHUTDOWN_TIMEOUT_SECONDS', 20))
+
+# summarize(previous summary, evicted messages) -> new summary
+Summarizer = Callable[[str, List[BaseMessage]], Awaitable[Optional[str]]]
+
+
+class HistoryWriter:
+    """
+    Must be used from the event loop of the worker.
+    """
+    def __init__(self, summarize: Optional[Summarizer] = None):
+        self.summarize = summarize
+        # session -> its history and the context of the request that added
+        # the first unsaved turn, so the write is traced for its tenant
+        self._pending: "OrderedDict[Tuple[str, str], Tuple[WindowedDynamoDBChatMessageHistory, contextvars.Context]]" = OrderedDict()
+        # sessions being written, a session is never written twice at once
+        self._writing: Set[Tuple[str, str]] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Future] = None
+        self._closed = False
+        self.turns = 0
+        self.writes = 0
+        self.retries = 0
+        self.failures = 0
+        self.inline = 0
+
+    async def add_turn(self, history: WindowedDynamoDBChatMessageHistory, messages: List[BaseMessage]) -> None:
+        """
+        Adds the turn to the session history, written in the background
+        unless the writer is disabled, full or closed.
+        """
+        self.turns += 1
+        key = history.cache_key
+        await run_blocking(history.add_unsaved, messages)
+        queued = key in self._pending or key in self._writing
+        if not queued and (not HISTORY_WRITE_BEHIND_ENABLED or self._closed
+                           or len(self._pending) >= HISTORY_WRITE_MAX_SESSIONS):
+            self.inline += 1
+            self._writing.add(key)
+            try:
+                await self._write(history)
+            except Exception as e:
+                logger.error(f"could not write the history of session {history.session_id}: {e}")
+                history.cache.drop(key)
+            finally:
+                self._writing.discard(key)
+            return
+        if key not in self._pending:
+            self._pending[key] = (history, contextvars.copy_context())
+            metrics.HISTORY_WRITE_QUEUE_DEPTH.set(len(self._pending))
+        self._start()
+        self._wakeup.set()
+
+    def _start(self) -> None:
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if not self._closed:
+                await asyncio.sleep(HISTORY_WRITE_LINGER_MS / 1000)
+            while self._pending:
+                await self._flush_batch()
+            if self._closed:
+                return
+
+    async def _flush_batch(self) -> None:
+        batch = []
+        while self._pending and len(batch) < HISTORY_WRITE_BATCH_SIZE:
+            batch.append(self._pending.popitem(last=False)[1])
+        metrics.HISTORY_WRITE_QUEUE_DEPTH.set(len(self._pending))
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.create_task(self._write_with_retry(history), context=context)
+                               for history, context in batch))
+
+    async def _write_with_retry(self, history: WindowedDynamoDBChatMessageHistory) -> None:
+        while history.cache_key in self._writing:
+            # written on the response path right now, try again later
+            await asyncio.sleep(HISTORY_WRITE_LINGER_MS / 1000)
+        self._writing.add(history.cache_key)
+        try:
+            await self._write_attempts(history)
+        finally:
+            self._writing.discard(history.cache_key)
+
+    async def _write_attempts(self, history: WindowedDynamoDBChatMessageHistory) -> None:
+        for attempt in range(HISTORY_WRITE_MAX_RETRIES + 1):
+            try:
+                await self._write(history)
+                return
+            except Exception as e:
+                if attempt == HISTORY_WRITE_MAX_RETRIES:
+                    self.failures += 1
+                    metrics.HISTORY_WRITES.inc(result="failed")
+                    logger.error(f"could not write the history of session {history.session_id}, "
+                                 f"dropping its unsaved turns: {e}")
+                    history.cache.drop(history.cache_key)
+                    return
+                self.retries += 1
+                metrics.HISTORY_WRITES.inc(result="retried")
+                # full jitter exponential backoff, capped at 5 seconds
+                await asyncio.sleep(random.uniform(0, min(5, 0.1 * 2 ** attempt)))
+
+    async def _write(self, history: WindowedDynamoDBChatMessageHistory) -> None:
+        """
+        Writes the unsaved turns of the session. When they push turns out of
+        the history window these are summarized first, which costs one LLM
+        call every few turns.
+        """
+        (messages, evicted), previous = await run_blocking(lambda: (history.unsaved(), history.summary))
+        if not messages:
+            return
+        summary = None
+        if evicted and self.summarize is not None:
+            try:
+                summary = await self.summarize(previous, evicted)
+            except Exception:
+                logger.exception("could not summarize the chat history, keeping the previous summary")
+        with span("history_write", compacted=bool(evicted), messages=len(messages)):
+            try:
+                await run_blocking(history.save_unsaved, len(messages), summary)
+            except ClientError as err:
+                logger.warning(f"history write of session {history.session_id} failed: {err}")
+                raise
+        self.writes += 1
+        metrics.HISTORY_WRITES.inc(result="written")
+
+    async def close(self) -> None:
+        """
+        Writes the pending turns, later turns are written on the response
+        path.
+        """
+        self._closed = True
+        if self._task is None or self._task.done():
+            if not self._pending:
+                return
+            self._start()
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), HISTORY_WRITE_SHUTDOWN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.error(f"{len(self._pending)} sessions with unsaved chat history were not written on shutdown")
+        logger.info(f"history writer stopped, {self.stats()}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {'enabled': HISTORY_WRITE_BEHIND_ENABLED,
+                'pending_sessions': len(self._pending),
+                'turns': self.turns,
+                'writes': self.writes,
+                'retries': self.retries,
+                'failures': self.failures,
+                'inline': self.inline}
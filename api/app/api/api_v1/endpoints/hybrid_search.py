@@ -0,0 +1,115 @@
+"""
+Hybrid lexical and vector retrieval.
+
+Embeddings miss exact product terms, so when the tenant's docstore has a BM25
+index the nearest neighbours of the question embedding and the best BM25
+matches of its terms are fused with reciprocal rank fusion. The best fused
+candidates are then re-ranked locally, by the cosine similarity of their
+vectors to the question and by how many of the question's terms they
+contain, so fewer and better chunks are sent to the LLM.
+"""
+import os
+import re
+import logging
+from typing import Dict, List, Optional, Sequence
+import numpy as np
+from langchain.schema import Document
+
+logger = logging.getLogger(__name__)
+
+HYBRID_RETRIEVAL_ENABLED = os.environ.get('HYBRID_RETRIEVAL_ENABLED', 'true').lower() == 'true'
+# candidates taken from each retriever before fusion
+HYBRID_CANDIDATES = int(os.environ.get('HYBRID_CANDIDATES', 20))
+RRF_K = int(os.environ.get('RRF_K', 60))
+RERANK_ENABLED = os.environ.get('RERANK_ENABLED', 'true').lower() == 'true'
+RERANK_CANDIDATES = int(os.environ.get('RERANK_CANDIDATES', 10))
+# weight of the query term coverage against the vector similarity
+RERANK_LEXICAL_WEIGHT = float(os.environ.get('RERANK_LEXICAL_WEIGHT', 0.3))
+
+TOKEN_PATTERN = re.compile(r"\w+")
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i",
+    "in", "is", "it", "me", "my", "of", "on", "or", "the", "to", "what", "when", "where", "which",
+    "who", "why", "with", "you", "your",
+}
+
+
+def query_terms(question: str) -> List[str]:
+    terms = []
+    for t in TOKEN_PATTERN.findall(question.lower()):
+        if t not in STOPWORDS and t not in terms:
+            terms.append(t)
+    return terms
+
+
+def has_lexical_index(vector_db) -> bool:
+    docstore = vector_db.docstore
+    return HYBRID_RETRIEVAL_ENABLED and hasattr(docstore, "lexical_search") and docstore.has_lexical_index()
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = RRF_K) -> List[int]:
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking):
+            scores[position] = scores.get(position, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def _cosine(index, position: int, query: np.ndarray) -> Optional[float]:
+    try:
+        v = index.reconstruct(position)
+    except RuntimeError:
+        # e.g. IVF indexes without a direct map cannot reconstruct vectors
+        return None
+    norm = np.linalg.norm(v)
+    return float(v @ query / norm) if norm else 0.0
+
+
+def rerank(vector_db, question: str, embedding: List[float], positions: List[int],
+           docs: Dict[int, Document]) -> List[int]:
+    terms = query_terms(question)
+    query = np.asarray(embedding, dtype=np.float32)
+    query = query / (np.linalg.norm(query) or 1.0)
+    scores = {}
+    for rank, position in enumerate(positions):
+        words = set(TOKEN_PATTERN.findall(docs[position].page_content.lower()))
+        coverage = sum(t in words for t in terms) / len(terms) if terms else 0.0
+        similarity = _cosine(vector_db.index, position, query)
+        if similarity is None:
+            # fall back to the fused rank
+            similarity = 1.0 - rank / len(positions)
+        scores[position] = (1 - RERANK_LEXICAL_WEIGHT) * similarity + RERANK_LEXICAL_WEIGHT * coverage
+    return sorted(positions, key=scores.get, reverse=True)
+
+
+def _document(vector_db, position: int) -> Optional[Document]:
+    doc = vector_db.docstore.search(vector_db.index_to_docstore_id[position])
+    return doc if isinstance(doc, Document) else None
+
+
+def hybrid_search(vector_db, question: str, embedding: List[float], k: int,
+                  vector_positions: Optional[Sequence[int]] = None) -> List[Document]:
+    """
+    Blocking. vector_positions are the nearest neighbours of the embedding
+    when the caller already searched the index, e.g. for a whole batch.
+    """
+    if vector_positions is None:
+        _, indices = vector_db.index.search(np.asarray([embedding], dtype=np.float32), HYBRID_CANDIDATES)
+        vector_positions = indices[0]
+    vector_positions = [int(i) for i in vector_positions if i != -1]
+
+    terms = query_terms(question)
+    lexical_positions = []
+    if terms:
+        query = " OR ".join('"' + t.replace('"', '""') + '"' for t in terms)
+        lexical_positions = vector_db.docstore.lexical_search(query, HYBRID_CANDIDATES)
+
+    fused = reciprocal_rank_fusion([vector_positions, lexical_positions])
+    candidates = fused[:max(RERANK_CANDIDATES, k)] if RERANK_ENABLED else fused[:k]
+    docs = {p: d for p, d in ((p, _document(vector_db, p)) for p in candidates) if d is not None}
+    candidates = [p for p in candidates if p in docs]
+    if RERANK_ENABLED:
+        candidates = rerank(vector_db, question, embedding, candidates, docs)
+    logger.debug(f"hybrid search: {len(vector_positions)} vector and {len(lexical_positions)} BM25 candidates, "
+                 f"{len(fused)} fused, returning {min(k, len(candidates))}")
+    return [docs[p] for p in candidates[:k]]
@@ -1,35 +1,265 @@
 import os
-import boto3
+import json
+import fcntl
+import pickle
+import shutil
+import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional
 from urllib.parse import urlparse
-from langchain.vectorstores import FAISS
-from langchain.embeddings import BedrockEmbeddings
+import faiss
+from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from .clients import get_s3_client
+from .embeddings_cache import get_cached_embeddings
+from .sqlite_docstore import SQLiteDocstore, SQLiteIndexToDocstoreId, is_pinned
+
+if TYPE_CHECKING:
+    # langchain.vectorstores imports every vector store, it is imported on
+    # first use so the API starts serving health checks sooner
+    from langchain.vectorstores import FAISS
 
 logger = logging.getLogger(__name__)
 
-def load_vector_db_faiss(vectordb_s3_path: str, vectordb_local_path: str, embeddings_model: str, bedrock_service: str) -> FAISS:
+VECTORDB_FILES = ["index.faiss", "index.pkl"]
+# docstore read lazily instead of unpickling index.pkl, published by newer
+# versions of the ingestion script next to the other files
+DOCSTORE_FILE = "docstore.sqlite"
+MANIFEST_FILE = "manifest.json"
+# number of index versions kept on local disk per tenant
+VECTORDB_VERSIONS_KEPT = 2
+
+# faiss-cpu 1.7.4, pinned to the version of the ingestion script, only
+# memory maps the inverted lists of IVF indexes. Flat, HNSW and PQ indexes are
+# read into the memory of each process and are only shared by the workers
+# when they are preloaded in the gunicorn master, see gunicorn.conf.py.
+# Builds that have IO_FLAG_MMAP_IFC memory map every index.
+FAISS_MMAP_ALL_INDEXES = hasattr(faiss, "IO_FLAG_MMAP_IFC")
+FAISS_MMAP_FLAGS = (faiss.IO_FLAG_MMAP_IFC if FAISS_MMAP_ALL_INDEXES else faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+# search time overrides for approximate indexes, by default the nprobe and
+# efSearch the ingestion script stored in the index are used
+VECTORDB_NPROBE = os.environ.get('VECTORDB_NPROBE')
+VECTORDB_EF_SEARCH = os.environ.get('VECTORDB_EF_SEARCH')
+
+_transfer_config = TransferConfig(max_concurrency=8, multipart_threshold=64 * 1024 * 1024)
+
+
+class VectorDBFiles(NamedTuple):
+    local_dir: str
+    version: str
+    size_bytes: int
+
+
+class NotModified(Exception):
+    pass
+
+
+def _split_s3_path(vectordb_s3_path: str):
+    parsed = urlparse(vectordb_s3_path)
+    return parsed.netloc, parsed.path[1:]
+
+
+def _sha256(fpath: str) -> str:
+    digest = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_manifest(vectordb_s3_path: str, etag: Optional[str] = None) -> Optional[Dict]:
+    """
+    Returns the manifest published by the ingestion script, None when the
+    index was published without one (legacy layout) and raises NotModified
+    when etag is given and the manifest did not change.
+    """
+    bucket, prefix = _split_s3_path(vectordb_s3_path)
+    kwargs = {'IfNoneMatch': etag} if etag else {}
+    try:
+        response = get_s3_client().get_object(Bucket=bucket, Key=os.path.join(prefix, MANIFEST_FILE), **kwargs)
+    except ClientError as err:
+        code = err.response['Error']['Code']
+        if code in ('304', 'NotModified'):
+            raise NotModified()
+        # without s3:ListBucket a missing key is reported as AccessDenied
+        if code in ('404', 'NoSuchKey', '403', 'AccessDenied'):
+            return None
+        raise
+    manifest = json.loads(response['Body'].read())
+    manifest['etag'] = response['ETag']
+    return manifest
+
+
+def _download(bucket: str, files: Dict[str, str], local_dir: str) -> None:
+    """
+    Downloads {file name: s3 key} into local_dir in parallel.
+    """
+    s3 = get_s3_client()
+
+    def download(item):
+        vdb_file, key = item
+        fpath = os.path.join(local_dir, vdb_file)
+        logger.info(f"going to download from bucket={bucket}, path={key}, to {fpath}")
+        s3.download_file(bucket, key, fpath, Config=_transfer_config)
+        logger.info(f"after downloading from bucket={bucket}, path={key}, to {fpath}")
+
+    with ThreadPoolExecutor(max_workers=len(files)) as executor:
+        list(executor.map(download, files.items()))
+
+
+def _publish_dir(tmp_dir: str, version_dir: str) -> None:
+    # the rename is atomic, readers either see the complete version or none
+    if os.path.exists(version_dir):
+        shutil.rmtree(tmp_dir)
+    else:
+        os.rename(tmp_dir, version_dir)
+
+
+def _cleanup_versions(vectordb_local_path: str, keep: str) -> None:
+    versions = [d for d in os.listdir(vectordb_local_path)
+                if os.path.isdir(os.path.join(vectordb_local_path, d)) and not d.startswith('.')]
+    versions.sort(key=lambda d: os.path.getmtime(os.path.join(vectordb_local_path, d)), reverse=True)
+    for d in versions[VECTORDB_VERSIONS_KEPT:]:
+        if d == keep:
+            continue
+        version_dir = os.path.join(vectordb_local_path, d)
+        docstore_path = os.path.join(version_dir, DOCSTORE_FILE)
+        # the SQLite docstore is opened again by new threads and forked
+        # workers, memory mapped files stay valid for the processes using them
+        if os.path.exists(docstore_path) and is_pinned(docstore_path):
+            logger.info(f"keeping vector db version={d}, its docstore is still in use")
+            continue
+        shutil.rmtree(version_dir, ignore_errors=True)
+
+
+def _manifest_files(manifest: Dict) -> List[str]:
+    """
+    Files the API needs out of a published version, index.pkl is skipped when
+    the version has a SQLite docstore.
+    """
+    if DOCSTORE_FILE in manifest['files']:
+        return ["index.faiss", DOCSTORE_FILE]
+    return VECTORDB_FILES
+
+
+def _fetch_versioned(bucket: str, manifest: Dict, vectordb_local_path: str) -> str:
+    version = manifest['version']
+    vdb_files = _manifest_files(manifest)
+    version_dir = os.path.join(vectordb_local_path, version)
+    if os.path.exists(version_dir):
+        logger.info(f"vector db version={version} already on local disk at {version_dir}")
+        return version_dir
+
+    tmp_dir = os.path.join(vectordb_local_path, f".{version}.{os.getpid()}")
+    os.makedirs(tmp_dir, exist_ok=True)
+    _download(bucket, {f: manifest['files'][f]['key'] for f in vdb_files}, tmp_dir)
+    for vdb_file in vdb_files:
+        checksum = _sha256(os.path.join(tmp_dir, vdb_file))
+        if checksum != manifest['files'][vdb_file]['sha256']:
+            shutil.rmtree(tmp_dir)
+            raise ValueError(f"checksum mismatch for {vdb_file} of version={version}")
+    _publish_dir(tmp_dir, version_dir)
+    return version_dir
+
+
+def _fetch_legacy(bucket: str, prefix: str, vectordb_local_path: str) -> str:
+    """
+    Index published without a manifest, the files are only downloaded again
+    when their ETags changed. The version is derived from the ETags.
+    """
+    s3 = get_s3_client()
+    etags = {f: s3.head_object(Bucket=bucket, Key=os.path.join(prefix, f))['ETag'] for f in VECTORDB_FILES}
+    version = "legacy-" + hashlib.sha256(json.dumps(etags, sort_keys=True).encode()).hexdigest()[:16]
+    version_dir = os.path.join(vectordb_local_path, version)
+    if os.path.exists(version_dir):
+        return version_dir
+
+    tmp_dir = os.path.join(vectordb_local_path, f".{version}.{os.getpid()}")
+    os.makedirs(tmp_dir, exist_ok=True)
+    _download(bucket, {f: os.path.join(prefix, f) for f in VECTORDB_FILES}, tmp_dir)
+    _publish_dir(tmp_dir, version_dir)
+    return version_dir
+
+
+def fetch_vector_db_files(vectordb_s3_path: str, vectordb_local_path: str,
+                          manifest: Optional[Dict] = None) -> VectorDBFiles:
+    """
+    Makes the current version of the index available on local disk and
+    returns where. Workers on the same node serialize on a file lock so a
+    version is only downloaded once per node.
+    """
     os.makedirs(vectordb_local_path, exist_ok=True)
-    # download the vectordb files from S3
-    # note that the following code is only applicable to FAISS
-    # would need to be enhanced to support other vector dbs
-    vectordb_files = ["index.pkl", "index.faiss"]
-    for vdb_file in vectordb_files:        
-        s3 = boto3.client('s3')
-        fpath = os.path.join(vectordb_local_path, vdb_file)
-        with open(fpath, 'wb') as f:
-            parsed = urlparse(vectordb_s3_path)
-            bucket = parsed.netloc
-            path =  os.path.join(parsed.path[1:], vdb_file)
-            logger.info(f"going to download from bucket={bucket}, path={path}, to {fpath}")
-            s3.download_fileobj(bucket, path, f)
-            logger.info(f"after downloading from bucket={bucket}, path={path}, to {fpath}")
+    bucket, prefix = _split_s3_path(vectordb_s3_path)
+    with open(os.path.join(vectordb_local_path, ".lock"), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            manifest = manifest or get_manifest(vectordb_s3_path)
+            if manifest is not None:
+                version_dir = _fetch_versioned(bucket, manifest, vectordb_local_path)
+            else:
+                version_dir = _fetch_legacy(bucket, prefix, vectordb_local_path)
+            _cleanup_versions(vectordb_local_path, keep=os.path.basename(version_dir))
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    # the SQLite docstore is paged in on demand, it does not count as resident
+    size_bytes = sum(os.path.getsize(os.path.join(version_dir, f)) for f in VECTORDB_FILES
+                     if os.path.exists(os.path.join(version_dir, f)))
+    return VectorDBFiles(version_dir, os.path.basename(version_dir), size_bytes)
+
+
+def set_search_params(index: faiss.Index) -> None:
+    params = faiss.ParameterSpace()
+    if VECTORDB_NPROBE and faiss.try_extract_index_ivf(index) is not None:
+        params.set_index_parameter(index, "nprobe", int(VECTORDB_NPROBE))
+    if VECTORDB_EF_SEARCH and hasattr(index, "hnsw"):
+        params.set_index_parameter(index, "efSearch", int(VECTORDB_EF_SEARCH))
+
+
+def describe_index(index: faiss.Index) -> str:
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return f"{type(index).__name__}(nlist={ivf.nlist}, nprobe={ivf.nprobe})"
+    if hasattr(index, "hnsw"):
+        return f"{type(index).__name__}(efSearch={index.hnsw.efSearch})"
+    return type(index).__name__
+
+
+def read_vector_db_faiss(local_dir: str, embeddings) -> "FAISS":
+    """
+    Same as FAISS.load_local but the index is opened read-only and memory
+    mapped as far as the faiss build allows, see FAISS_MMAP_FLAGS. When
+    the version has a SQLite docstore the documents are read from it on
+    demand, only the k documents returned by a search are ever loaded.
+    Any index type written by the ingestion script (flat, IVF, HNSW, PQ, SQ8)
+    is supported.
+    """
+    from langchain.vectorstores import FAISS
+    index = faiss.read_index(os.path.join(local_dir, "index.faiss"), FAISS_MMAP_FLAGS)
+    set_search_params(index)
+    logger.info(f"read index {describe_index(index)} with {index.ntotal} vectors from {local_dir}, "
+                f"memory mapped={FAISS_MMAP_ALL_INDEXES or faiss.try_extract_index_ivf(index) is not None}")
+    docstore_path = os.path.join(local_dir, DOCSTORE_FILE)
+    if os.path.exists(docstore_path):
+        return FAISS(embeddings.embed_query, index, SQLiteDocstore(docstore_path),
+                     SQLiteIndexToDocstoreId(docstore_path))
+    with open(os.path.join(local_dir, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embeddings.embed_query, index, docstore, index_to_docstore_id)
+
+
+def load_vector_db_faiss(vectordb_s3_path: str, vectordb_local_path: str, embeddings_model: str, bedrock_service: str) -> "FAISS":
+    files = fetch_vector_db_files(vectordb_s3_path, vectordb_local_path)
 
     logger.info("Creating an embeddings object to hydrate the vector db")
 
-    boto3_bedrock = boto3.client(service_name=bedrock_service)
-    br_embeddings = BedrockEmbeddings(client=boto3_bedrock, model_id=embeddings_model)
+    # the embeddings object is shared by all the vector dbs of this process
+    # so repeated questions skip the embedding round trip
+    br_embeddings = get_cached_embeddings(embeddings_model, bedrock_service)
 
-    vector_db = FAISS.load_local(vectordb_local_path, br_embeddings)
-    logger.info(f"vector db hydrated, type={type(vector_db)} it has {vector_db.index.ntotal} embeddings")
+    vector_db = read_vector_db_faiss(files.local_dir, br_embeddings)
+    logger.info(f"vector db hydrated, type={type(vector_db)} it has {vector_db.index.ntotal} embeddings, "
+                f"version={files.version}")
 
     return vector_db
@@ -1,117 +1,238 @@
 import os
-import sys
-import boto3
+import hmac
+import json
+import math
 import logging
-from typing import Any, Dict
-from fastapi import APIRouter
-from urllib.parse import urlparse
-from langchain.chains import ConversationChain
-from langchain.memory import ConversationBufferMemory
-from langchain.chains import ConversationalRetrievalChain
-from langchain.memory.chat_message_histories import DynamoDBChatMessageHistory
-from langchain.llms.bedrock import Bedrock
-from langchain.prompts import PromptTemplate 
-# from langchain import PromptTemplate
+from typing import Any, Dict, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi import Request as HTTPRequest
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from .fastapi_request import (Request,
                               Text2TextModelName,
                               EmbeddingsModelName,
                               VectorDBType)
-from .initialize import load_vector_db_faiss
+from .bedrock_scheduler import BedrockThrottledError, scheduler
+from .clients import BEDROCK_SERVICE, request_limiter
+from .rag_pipeline import history_writer, run_rag, run_rag_stream
+from .batch_rag import parse_batch, run_rag_batch
+from .answer_cache import answer_cache
+from . import context_assembler, metrics, question_rewrite
+from .request_coalescing import coalescer
+from .chat_history import history_cache
+from .embeddings_cache import get_cached_embeddings
+from .startup import readiness
+from .tracing import UNKNOWN_TENANT, current_trace, request_trace
+from .vectordb_registry import (UnknownTenantError,
+                                VectorDBEntry,
+                                registry,
+                                resolve_tenant_id)
 
 logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger()
 
-CHATHISTORY_TABLE=os.environ.get('CHATHISTORY_TABLE')
-
 EMBEDDINGS_MODEL = os.environ.get('EMBEDDING_MODEL_ID')
-TEXT2TEXT_MODEL_ID = os.environ.get('TEXT2TEXT_MODEL_ID')
-BEDROCK_SERVICE = os.environ.get('BEDROCK_SERVICE')
+# the stats endpoints cover every tenant of the worker, they are only served
+# to callers sending this token in X-Admin-Token and disabled when unset
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
 
+async def require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="admin endpoints are disabled, set ADMIN_TOKEN")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="invalid admin token")
 
-VECTOR_DB_DIR = os.path.join("/tmp", "_vectordb")
-_vector_db = None
-vectordb_s3_path: str = f"s3://{os.environ.get('CONTEXTUAL_DATA_BUCKET')}/faiss_index/"
 
-if _vector_db is None:
-    _vector_db = load_vector_db_faiss(vectordb_s3_path,
-                                      VECTOR_DB_DIR,
-                                      EMBEDDINGS_MODEL,
-                                      BEDROCK_SERVICE)
 router = APIRouter()
+admin_router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@router.on_event("startup")
+async def start_background_tasks():
+    registry.start_refresh()
+    readiness.start()
+
+
+@router.on_event("shutdown")
+async def flush_history():
+    await history_writer.close()
+
+
+async def get_vector_db(req: Request, header_tenant_id: Optional[str]) -> VectorDBEntry:
+    tenant_id = resolve_tenant_id(header_tenant_id, req.tenant_id)
+    try:
+        return await registry.get_entry(tenant_id)
+    except UnknownTenantError as e:
+        # arbitrary tenant ids must not become metric label values
+        trace = current_trace()
+        if trace is not None:
+            trace.tenant_id = UNKNOWN_TENANT
+        raise HTTPException(status_code=404, detail=str(e))
+
 
 @router.post("/rag")
-def rag_handler(req: Request) -> Dict[str, Any]:
+async def rag_handler(req: Request,
+                      x_auth_request_tenantid: Optional[str] = Header(None)) -> Dict[str, Any]:
     # dump the received request for debugging purposes
     logger.info(f"req={req}")
 
-
-    # Use the vector db to find similar documents to the query
-    # the vector db call would automatically convert the query text
-    # into embeddings
-    docs = _vector_db.similarity_search(req.q, k=req.max_matching_docs)
-    logger.info(f"here are the {req.max_matching_docs} closest matching docs to the query=\"{req.q}\"")
-    for d in docs:
-        logger.info(f"---------")
-        logger.info(d)
-        logger.info(f"---------")
-
-    parameters = {
-        "max_tokens_to_sample": req.maxTokenCount,
-        "stop_sequences": req.stopSequences,
-        "temperature": req.temperature,
-        "top_k": req.topK,
-        "top_p": req.topP
-        }
-
-    endpoint_name = req.text_generation_model
-    logger.info(f"ModelId: {TEXT2TEXT_MODEL_ID}, Bedrock Model: {BEDROCK_SERVICE}")
-
-    session_id = req.user_session_id
-    boto3_bedrock = boto3.client(service_name=BEDROCK_SERVICE)
-    bedrock_llm = Bedrock(model_id=TEXT2TEXT_MODEL_ID, client=boto3_bedrock)
-    bedrock_llm.model_kwargs = parameters
-    
-    message_history = DynamoDBChatMessageHistory(table_name=CHATHISTORY_TABLE, session_id=session_id)
-    memory_chain = ConversationBufferMemory(
-        memory_key="chat_history",
-        chat_memory=message_history,
-        input_key="question",
-        ai_prefix="Assistant",
-        return_messages=True
-    )
-    
-    condense_prompt_claude = PromptTemplate.from_template("""
-    Answer only with the new question.
-    
-    Human: How would you ask the question considering the previous conversation: {question}
-    
-    Assistant: Question:""")
-
-    qa = ConversationalRetrievalChain.from_llm(
-        llm=bedrock_llm, 
-        retriever=_vector_db.as_retriever(search_type='similarity', search_kwargs={"k": req.max_matching_docs}), 
-        memory=memory_chain,
-        condense_question_prompt=condense_prompt_claude,
-        chain_type='stuff', # 'refine',
-    )
-
-    qa.combine_docs_chain.llm_chain.prompt = PromptTemplate.from_template("""
-    {context}
-
-    Human: Answer the question inside the <q></q> XML tags.
-    
-    <q>{question}</q>
-    
-    Do not use any XML tags in the answer. If you don't know the answer or if the answer is not in the context say "Sorry, I don't know."
-
-    Assistant:""")
-
-    answer = ""
-    answer = qa.run({'question': req.q })
-
-    logger.info(f"answer received from llm,\nquestion: \"{req.q}\"\nanswer: \"{answer}\"")
-    resp = {'question': req.q, 'answer': answer, 'session_id': req.user_session_id}
-    if req.verbose is True:
-        resp['docs'] = docs
-
-    return resp
+    with request_trace(resolve_tenant_id(x_auth_request_tenantid, req.tenant_id), "rag"):
+        async with request_limiter:
+            entry = await get_vector_db(req, x_auth_request_tenantid)
+            try:
+                return await run_rag(req, entry)
+            except BedrockThrottledError as e:
+                raise HTTPException(status_code=429, detail=str(e),
+                                    headers={'Retry-After': str(math.ceil(e.retry_after))})
+
+
+@router.post("/rag/stream")
+async def rag_stream_handler(req: Request,
+                             x_auth_request_tenantid: Optional[str] = Header(None)) -> StreamingResponse:
+    """
+    Same as /rag but the response is streamed as JSON lines: a 'sources'
+    event, one 'token' event per generated chunk and a final 'done' event.
+    """
+    logger.info(f"req={req}")
+    # resolve the index before streaming starts so errors map to a status code
+    entry = await get_vector_db(req, x_auth_request_tenantid)
+
+    async def events():
+        with request_trace(entry.tenant_id, "rag_stream"):
+            async with request_limiter:
+                try:
+                    async for event in run_rag_stream(req, entry):
+                        yield json.dumps(jsonable_encoder(event)) + "\n"
+                except BedrockThrottledError as e:
+                    logger.warning(f"answer not streamed, {e}")
+                    yield json.dumps({'type': 'error', 'detail': str(e), 'status': 429,
+                                      'retry_after': math.ceil(e.retry_after)}) + "\n"
+                except Exception as e:
+                    logger.exception("error while streaming the answer")
+                    yield json.dumps({'type': 'error', 'detail': str(e)}) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+@router.post("/rag/batch")
+async def rag_batch_handler(request: HTTPRequest,
+                            concurrency: Optional[int] = Query(None, ge=1),
+                            x_auth_request_tenantid: Optional[str] = Header(None)) -> StreamingResponse:
+    """
+    Answers a JSONL body of single-turn /rag requests for one tenant. The
+    results are streamed back as JSON lines in request order, each with the
+    'index' of its request and either an 'answer' or an 'error'. concurrency
+    caps the answers generated in parallel.
+    """
+    try:
+        reqs = parse_batch(await request.body())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    tenants = {resolve_tenant_id(x_auth_request_tenantid, r.tenant_id) for r in reqs}
+    if len(tenants) > 1:
+        raise HTTPException(status_code=400, detail=f"a batch is for a single tenant, got {sorted(tenants)}")
+    logger.info(f"batch of {len(reqs)} requests for tenant={tenants.pop()}")
+    entry = await get_vector_db(reqs[0], x_auth_request_tenantid)
+
+    async def results():
+        with request_trace(entry.tenant_id, "rag_batch"):
+            async with request_limiter:
+                # the results are written in request order
+                written = 0
+                try:
+                    async for result in run_rag_batch(reqs, entry, concurrency):
+                        yield json.dumps(jsonable_encoder(result)) + "\n"
+                        written += 1
+                except Exception as e:
+                    # the status code is sent already, the requests without
+                    # a result get an error line each
+                    logger.exception("error while answering the batch")
+                    error = {'error': str(e)}
+                    if isinstance(e, BedrockThrottledError):
+                        error.update(status=429, retry_after=math.ceil(e.retry_after))
+                    for i in range(written, len(reqs)):
+                        yield json.dumps({'index': i, 'question': reqs[i].q, **error}) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+
+@router.delete("/answer-cache")
+async def answer_cache_invalidate_handler(x_auth_request_tenantid: Optional[str] = Header(None)) -> Dict[str, Any]:
+    """
+    Drops the cached answers of the caller's tenant, e.g. after its index
+    was republished.
+    """
+    tenant_id = resolve_tenant_id(x_auth_request_tenantid, None)
+    answer_cache.invalidate(tenant_id)
+    return answer_cache.stats()['tenants'].get(tenant_id, {})
+
+
+@admin_router.get("/vectordbs")
+async def vectordbs_handler() -> Dict[str, Any]:
+    return registry.stats()
+
+
+@admin_router.get("/answer-cache")
+async def answer_cache_handler() -> Dict[str, Any]:
+    return answer_cache.stats()
+
+
+@admin_router.get("/embeddings-cache")
+async def embeddings_cache_handler() -> Dict[str, Any]:
+    return get_cached_embeddings(EMBEDDINGS_MODEL, BEDROCK_SERVICE).stats()
+
+
+@admin_router.get("/condense")
+async def condense_handler() -> Dict[str, Any]:
+    """
+    How many requests skipped the condense question call and why.
+    """
+    return question_rewrite.stats()
+
+
+@admin_router.get("/context")
+async def context_handler() -> Dict[str, Any]:
+    """
+    Prompt context tokens before and after de-duplication and trimming.
+    """
+    return context_assembler.stats()
+
+
+@admin_router.get("/bedrock")
+async def bedrock_handler() -> Dict[str, Any]:
+    """
+    Concurrency limit, queues and throttling of the Bedrock scheduler.
+    """
+    return scheduler.stats()
+
+
+@admin_router.get("/history")
+async def history_handler() -> Dict[str, Any]:
+    """
+    Chat history cache and the turns waiting to be written.
+    """
+    return {'cache': history_cache.stats(), 'writer': history_writer.stats()}
+
+
+@admin_router.get("/coalescing")
+async def coalescing_handler() -> Dict[str, Any]:
+    """
+    Requests that shared the answer of an identical in-flight question.
+    """
+    return coalescer.stats()
+
+
+def render_metrics() -> str:
+    """
+    Prometheus text exposition of the request, stage, token, cache and index
+    metrics. The gauges of the caches and indexes are read at scrape time.
+    """
+    metrics.INDEX_SIZE_BYTES.clear()
+    for tenant_id, entry in registry.entries().items():
+        metrics.INDEX_SIZE_BYTES.set(entry.size_bytes, tenant=tenant_id)
+    for stat, value in get_cached_embeddings(EMBEDDINGS_MODEL, BEDROCK_SERVICE).stats().items():
+        metrics.EMBEDDING_CACHE.set(value, stat=stat)
+    for stat, value in history_cache.stats().items():
+        metrics.HISTORY_CACHE.set(value, stat=stat)
+    return metrics.registry.render()
@@ -0,0 +1,187 @@
+"""
+Process wide metrics in the Prometheus text exposition format.
+
+A small thread safe implementation of labelled counters, gauges and
+histograms, so the API does not need a client library. Metrics are per
+worker process, Prometheus aggregates the workers of a pod by their
+instance label.
+"""
+import math
+import threading
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+# seconds, from a cache hit to a long generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}, got {sorted(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}",
+                *self.samples()]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> (per bucket counts, sum)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="%s"' % _format_value(bound)
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUESTS = registry.register(Counter(
+    "ragapi_requests_total", "Requests by tenant, endpoint and HTTP status.", ["tenant", "endpoint", "status"]))
+REQUEST_SECONDS = registry.register(Histogram(
+    "ragapi_request_duration_seconds", "End to end request latency.", ["tenant", "endpoint"]))
+REQUESTS_IN_FLIGHT = registry.register(Gauge(
+    "ragapi_requests_in_flight", "Requests being served.", ["endpoint"]))
+STAGE_SECONDS = registry.register(Histogram(
+    "ragapi_stage_duration_seconds", "Latency of the pipeline stages.", ["tenant", "stage"]))
+LLM_TOKENS = registry.register(Histogram(
+    "ragapi_llm_tokens", "Estimated prompt and completion tokens per LLM call.", ["tenant", "call", "kind"],
+    buckets=TOKEN_BUCKETS))
+LLM_TOKENS_TOTAL = registry.register(Counter(
+    "ragapi_llm_tokens_total", "Estimated prompt and completion tokens.", ["tenant", "call", "kind"]))
+ANSWER_CACHE_LOOKUPS = registry.register(Counter(
+    "ragapi_answer_cache_lookups_total", "Answer cache lookups by result.", ["tenant", "lookup", "result"]))
+COALESCED_REQUESTS = registry.register(Counter(
+    "ragapi_coalesced_requests_total", "Questions without history by single-flight role.", ["tenant", "role"]))
+CONDENSE_PATHS = registry.register(Counter(
+    "ragapi_condense_path_total", "Requests by condense question path.", ["tenant", "path"]))
+INDEX_LOAD_SECONDS = registry.register(Histogram(
+    "ragapi_index_load_duration_seconds", "Time to download and open a tenant's index.", ["tenant"]))
+INDEX_LOADS = registry.register(Counter(
+    "ragapi_index_loads_total", "Index loads, including hot reloads.", ["tenant"]))
+INDEX_SIZE_BYTES = registry.register(Gauge(
+    "ragapi_index_size_bytes", "Resident size of the loaded indexes.", ["tenant"]))
+BEDROCK_CALLS = registry.register(Counter(
+    "ragapi_bedrock_calls_total", "Bedrock calls by result, including throttled and rejected calls.",
+    ["tenant", "result"]))
+BEDROCK_QUEUE_DEPTH = registry.register(Gauge(
+    "ragapi_bedrock_queue_depth", "Bedrock calls waiting for a concurrency slot.", ["tenant"]))
+BEDROCK_QUEUE_SECONDS = registry.register(Histogram(
+    "ragapi_bedrock_queue_duration_seconds", "Time Bedrock calls waited for the rate and concurrency limits.",
+    ["tenant"]))
+BEDROCK_CONCURRENCY_LIMIT = registry.register(Gauge(
+    "ragapi_bedrock_concurrency_limit", "Adaptive limit of the concurrent Bedrock calls of the worker."))
+EMBEDDING_CACHE = registry.register(Gauge(
+    "ragapi_embedding_cache", "Embedding cache entries, hits, misses and coalesced calls.", ["stat"]))
+HISTORY_WRITES = registry.register(Counter(
+    "ragapi_history_writes_total", "Background chat history writes by result.", ["result"]))
+HISTORY_WRITE_QUEUE_DEPTH = registry.register(Gauge(
+    "ragapi_history_write_queue_depth", "Sessions with chat history waiting to be written."))
+HISTORY_CACHE = registry.register(Gauge(
+    "ragapi_history_cache", "Chat history cache sessions, hits and misses.", ["stat"]))
@@ -0,0 +1,78 @@
+"""
+Decides whether a question has to be rewritten into a standalone question
+before retrieval.
+
+ConversationalRetrievalChain asks the LLM to condense the question on every
+turn that has chat history, which doubles the Bedrock calls of a turn. Most
+follow-up questions are self-contained though, so in 'auto' mode the rewrite
+is only done when the question looks like it refers to the conversation:
+it uses a pronoun or a follow-up phrase, or is too short to stand on its own.
+"""
+import os
+import re
+from collections import Counter
+from typing import Dict, List, Tuple
+from langchain.schema.messages import BaseMessage
+from . import metrics
+from .tracing import current_tenant
+
+# auto: rewrite only questions that refer to the conversation
+# always: rewrite whenever there is chat history (ConversationalRetrievalChain)
+# never: always retrieve with the question as asked
+CONDENSE_QUESTION_MODE = os.environ.get('CONDENSE_QUESTION_MODE', 'auto').lower()
+# the documents retrieved for the question as asked are kept when the
+# rewritten question embeds this close to it
+CONDENSE_REUSE_SIMILARITY = float(os.environ.get('CONDENSE_REUSE_SIMILARITY', 0.9))
+MIN_SELF_CONTAINED_WORDS = int(os.environ.get('MIN_SELF_CONTAINED_WORDS', 4))
+
+# paths a request can take, reported in the response and counted
+NO_HISTORY = "no_history"
+SELF_CONTAINED = "self_contained"
+REWRITTEN = "rewritten"
+REWRITTEN_REUSED_RETRIEVAL = "rewritten_reused_retrieval"
+DISABLED = "disabled"
+
+REFERENCE_WORDS = {
+    "it", "its", "it's", "itself", "they", "them", "their", "theirs", "themselves",
+    "this", "these", "those", "he", "him", "his", "she", "her", "hers",
+    "same", "former", "latter", "above", "previous", "aforementioned", "else",
+}
+FOLLOW_UP_PATTERN = re.compile(
+    r"^(and|but|so|or|also|then|what about|how about|why not|what else|tell me more|more|ok|okay)\b"
+    r"|\b(about|does|is|was|do|did|and) that\b|\bthat one\b",
+    re.IGNORECASE)
+WORD_PATTERN = re.compile(r"[a-z']+")
+
+condense_stats: Dict[str, int] = Counter()
+
+
+def needs_rewrite(question: str, chat_history: List[BaseMessage]) -> Tuple[bool, str]:
+    """
+    Returns whether the question has to be condensed and the path taken when
+    it does not.
+    """
+    if not chat_history:
+        return False, NO_HISTORY
+    if CONDENSE_QUESTION_MODE == 'never':
+        return False, DISABLED
+    if CONDENSE_QUESTION_MODE == 'always':
+        return True, REWRITTEN
+    words = WORD_PATTERN.findall(question.lower())
+    if len(words) < MIN_SELF_CONTAINED_WORDS:
+        return True, REWRITTEN
+    if REFERENCE_WORDS.intersection(words) or FOLLOW_UP_PATTERN.search(question.strip()):
+        return True, REWRITTEN
+    return False, SELF_CONTAINED
+
+
+def record_path(path: str) -> None:
+    condense_stats[path] += 1
+    metrics.CONDENSE_PATHS.inc(tenant=current_tenant(), path=path)
+
+
+def stats() -> Dict[str, object]:
+    total = sum(condense_stats.values())
+    skipped = total - condense_stats[REWRITTEN] - condense_stats[REWRITTEN_REUSED_RETRIEVAL]
+    return {'mode': CONDENSE_QUESTION_MODE,
+            'paths': dict(condense_stats),
+            'skip_rate': skipped / total if total else 0.0}
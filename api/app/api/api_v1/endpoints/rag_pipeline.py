@@ -0,0 +1,469 @@
+"""
+The retrieval augmented generation pipeline used by the /rag endpoint.
+
+Everything that does not depend on the request (prompt templates, the Bedrock
+LLM wrapper, the boto3 clients) is built once per process. Each request then
+runs the stages below on the bounded IO thread pool so the event loop is never
+blocked by boto3, FAISS or langchain.
+"""
+import os
+import json
+import asyncio
+import logging
+import functools
+import itertools
+import threading
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, List, Optional, Tuple
+import numpy as np
+from langchain.prompts import PromptTemplate
+from langchain.schema import Document
+from langchain.schema.messages import AIMessage, BaseMessage, HumanMessage, get_buffer_string
+from .bedrock_scheduler import run_bedrock, scheduler
+from .clients import (BEDROCK_SERVICE,
+                      get_bedrock_client,
+                      get_dynamodb_table,
+                      run_blocking)
+from .answer_cache import ANSWER_CACHE_ENABLED, CachedAnswer, answer_cache
+from .chat_history import WindowedDynamoDBChatMessageHistory
+from . import metrics, question_rewrite
+from .context_assembler import assemble_context, estimate_tokens
+from .embeddings_cache import CachedEmbeddings, embed_scheduled
+from .history_writer import HistoryWriter
+from .hybrid_search import has_lexical_index, hybrid_search
+from .request_coalescing import REQUEST_COALESCING_ENABLED, Flight, SharedAnswer, coalescer
+from .fastapi_request import Request
+from .tracing import current_tenant, record_tokens, span
+from .vectordb_registry import VectorDBEntry
+
+if TYPE_CHECKING:
+    from langchain.llms.bedrock import Bedrock
+
+logger = logging.getLogger(__name__)
+
+CHATHISTORY_TABLE = os.environ.get('CHATHISTORY_TABLE')
+TEXT2TEXT_MODEL_ID = os.environ.get('TEXT2TEXT_MODEL_ID')
+# fold the turns that fall out of the history window into a summary
+HISTORY_SUMMARY_ENABLED = os.environ.get('HISTORY_SUMMARY_ENABLED', 'true').lower() == 'true'
+# log the full text of the retrieved documents of every request, at DEBUG level
+LOG_DOCS = os.environ.get('LOG_DOCS', 'false').lower() == 'true'
+
+CONDENSE_PROMPT = PromptTemplate.from_template("""
+    {chat_history}
+
+    Answer only with the new question.
+
+    Human: How would you ask the question considering the previous conversation: {question}
+
+    Assistant: Question:""")
+
+QA_PROMPT = PromptTemplate.from_template("""
+    {context}
+
+    Human: Answer the question inside the <q></q> XML tags.
+
+    <q>{question}</q>
+
+    Do not use any XML tags in the answer. If you don't know the answer or if the answer is not in the context say "Sorry, I don't know."
+
+    Assistant:""")
+
+SUMMARY_PROMPT = PromptTemplate.from_template("""
+    <summary>{summary}</summary>
+
+    <conversation>
+    {conversation}
+    </conversation>
+
+    Human: Extend the summary inside the <summary></summary> XML tags with the conversation inside the <conversation></conversation> XML tags. Keep the topics and facts a follow-up question could refer to and answer in a few sentences.
+
+    Assistant: Summary:""")
+SUMMARY_PARAMETERS = {"max_tokens_to_sample": 300, "temperature": 0.0}
+
+# same separator the langchain 'stuff' documents chain uses
+DOCUMENT_SEPARATOR = "\n\n"
+
+
+@functools.lru_cache(maxsize=None)
+def get_llm() -> "Bedrock":
+    """
+    Returns the Bedrock LLM shared by all requests. Generation parameters
+    are passed per call so nothing request specific is stored on it.
+    """
+    # langchain.llms imports every LLM integration, it takes about a second
+    from langchain.llms.bedrock import Bedrock
+    logger.info(f"ModelId: {TEXT2TEXT_MODEL_ID}, Bedrock Model: {BEDROCK_SERVICE}")
+    return Bedrock(model_id=TEXT2TEXT_MODEL_ID, client=get_bedrock_client())
+
+
+def generation_parameters(req: Request) -> Dict[str, Any]:
+    return {
+        "max_tokens_to_sample": req.maxTokenCount,
+        "stop_sequences": req.stopSequences,
+        "temperature": req.temperature,
+        "top_k": req.topK,
+        "top_p": req.topP
+        }
+
+
+def get_message_history(session_id: str) -> WindowedDynamoDBChatMessageHistory:
+    return WindowedDynamoDBChatMessageHistory(table=get_dynamodb_table(CHATHISTORY_TABLE),
+                                              session_id=session_id)
+
+
+async def load_history(history: WindowedDynamoDBChatMessageHistory) -> Tuple[List[BaseMessage], str]:
+    with span("history_load") as s:
+        messages, summary = await run_blocking(lambda: (history.messages, history.summary))
+        s.attributes['messages'] = len(messages)
+        return messages, summary
+
+
+def format_history(summary: str, chat_history: List[BaseMessage]) -> str:
+    # 'Human:' and 'Assistant:' are reserved for the turns of the prompt itself
+    conversation = get_buffer_string(chat_history, human_prefix="User", ai_prefix="Bot")
+    return f"Summary of the earlier conversation: {summary}\n{conversation}" if summary else conversation
+
+
+async def condense_question(req: Request, chat_history: str) -> str:
+    """
+    Rewrites the question as a standalone question given the stored turns,
+    at most HISTORY_MAX_TURNS of them, and the summary of the older ones.
+    """
+    prompt = CONDENSE_PROMPT.format(chat_history=chat_history, question=req.q)
+    with span("condense") as s:
+        question = await run_bedrock(get_llm().predict, prompt, **generation_parameters(req))
+        record_tokens(s, estimate_tokens(prompt), estimate_tokens(question))
+    return question.strip()
+
+
+async def embed_query(vector_db, question: str) -> List[float]:
+    with span("embedding"):
+        # a cache hit is not a Bedrock call, it is not scheduled
+        embeddings = getattr(vector_db.embedding_function, "__self__", None)
+        if isinstance(embeddings, CachedEmbeddings):
+            return (await embed_scheduled(embeddings, [question]))[0]
+        return await run_bedrock(vector_db.embedding_function, question)
+
+
+async def retrieve(vector_db, question: str, embedding: List[float], k: int) -> List[Document]:
+    """
+    Vector search, fused with BM25 and re-ranked when the index has a
+    lexical index.
+    """
+    hybrid = has_lexical_index(vector_db)
+    with span("vector_search", hybrid=hybrid, k=k):
+        if hybrid:
+            return await run_blocking(hybrid_search, vector_db, question, embedding, k)
+        return await run_blocking(vector_db.similarity_search_by_vector, embedding, k=k)
+
+
+async def embed_and_retrieve(vector_db, question: str, k: int) -> Tuple[List[float], List[Document]]:
+    embedding = await embed_query(vector_db, question)
+    return embedding, await retrieve(vector_db, question, embedding, k)
+
+
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    a, b = np.asarray(a, dtype=np.float32), np.asarray(b, dtype=np.float32)
+    norm = np.linalg.norm(a) * np.linalg.norm(b)
+    return float(a @ b / norm) if norm else 0.0
+
+
+def build_qa_prompt(req: Request, question: str, docs: List[Document]) -> str:
+    context = assemble_context(docs, req.maxTokenCount)
+    return QA_PROMPT.format(context=DOCUMENT_SEPARATOR.join(context.texts), question=question)
+
+
+async def generate_answer(req: Request, question: str, docs: List[Document]) -> str:
+    prompt = build_qa_prompt(req, question, docs)
+    with span("generation") as s:
+        answer = await run_bedrock(get_llm().predict, prompt, **generation_parameters(req))
+        record_tokens(s, estimate_tokens(prompt), estimate_tokens(answer))
+    return answer
+
+
+async def stream_answer(req: Request, question: str, docs: List[Document]) -> AsyncIterator[str]:
+    """
+    Yields the answer tokens as Bedrock produces them. The blocking response
+    stream is consumed on the IO thread pool and handed over to the event
+    loop through a queue. A stream throttled before its first token is
+    retried, the scheduler's slot is held until the stream ends.
+    """
+    prompt = build_qa_prompt(req, question, docs)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    tenant = current_tenant()
+    done = object()
+
+    def produce(queue: asyncio.Queue, cancelled: threading.Event):
+        try:
+            for token in get_llm().stream(prompt, **generation_parameters(req)):
+                if cancelled.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, token)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    completion = []
+    with span("generation", streamed=True) as s:
+        try:
+            for attempt in itertools.count():
+                queue: asyncio.Queue = asyncio.Queue()
+                cancelled = threading.Event()
+                try:
+                    async with scheduler.slot(tenant):
+                        producer = asyncio.ensure_future(run_blocking(produce, queue, cancelled))
+                        try:
+                            while True:
+                                item = await queue.get()
+                                if item is done:
+                                    break
+                                if isinstance(item, Exception):
+                                    raise item
+                                if not completion:
+                                    s.attributes['first_token_ms'] = round((loop.time() - start) * 1000, 1)
+                                completion.append(item)
+                                yield item
+                        finally:
+                            # stop reading from bedrock if the client went away
+                            cancelled.set()
+                            await producer
+                    break
+                except Exception as e:
+                    if completion:
+                        raise
+                    await scheduler.backoff(tenant, attempt, e)
+        finally:
+            record_tokens(s, estimate_tokens(prompt), estimate_tokens("".join(completion)))
+
+
+async def summarize(summary: str, messages: List[BaseMessage]) -> str:
+    prompt = SUMMARY_PROMPT.format(summary=summary, conversation=format_history("", messages))
+    with span("summary") as s:
+        summary = await run_bedrock(get_llm().predict, prompt, **SUMMARY_PARAMETERS)
+        record_tokens(s, estimate_tokens(prompt), estimate_tokens(summary))
+    return summary.strip()
+
+
+history_writer = HistoryWriter(summarize if HISTORY_SUMMARY_ENABLED else None)
+
+
+async def save_turn(history: WindowedDynamoDBChatMessageHistory, question: str, answer: str) -> None:
+    """
+    Appends the turn to the session history. It is written to DynamoDB in
+    the background by the history writer, which also summarizes the turns
+    that fall out of the history window.
+    """
+    await history_writer.add_turn(history, [HumanMessage(content=question), AIMessage(content=answer)])
+
+
+def cache_key(req: Request) -> str:
+    """
+    Answers are only shared between requests that would have produced
+    them with the same retrieval and generation parameters.
+    """
+    return json.dumps({**generation_parameters(req),
+                       'k': req.max_matching_docs,
+                       'model': TEXT2TEXT_MODEL_ID}, sort_keys=True)
+
+
+def log_docs(question: str, docs: List[Document]) -> None:
+    if not LOG_DOCS:
+        return
+    logger.debug(f"here are the {len(docs)} closest matching docs to the query=\"{question}\"")
+    for d in docs:
+        logger.debug("---------")
+        logger.debug(d)
+        logger.debug("---------")
+
+
+def record_cache_lookup(lookup: str, cached: Optional[CachedAnswer]) -> None:
+    metrics.ANSWER_CACHE_LOOKUPS.inc(tenant=current_tenant(), lookup=lookup,
+                                     result="hit" if cached is not None else "miss")
+
+
+class RagContext:
+    """
+    State of one RAG turn shared by the blocking and the streaming variant.
+    """
+    def __init__(self, req: Request, entry: VectorDBEntry):
+        self.req = req
+        self.entry = entry
+        self.history: Optional[WindowedDynamoDBChatMessageHistory] = None
+        self.question: str = req.q
+        self.embedding: Optional[List[float]] = None
+        self.docs: List[Document] = []
+        self.cached: Optional[CachedAnswer] = None
+        self.condense_path: Optional[str] = None
+        # set when this request leads a flight of identical questions
+        self.flight: Optional[Flight] = None
+        # set when another request answered the same question
+        self.shared: Optional[SharedAnswer] = None
+
+    @property
+    def vector_db(self):
+        return self.entry.vector_db
+
+
+async def prepare(ctx: RagContext) -> None:
+    """
+    Everything that happens before generation: load history, condense the
+    question if it refers to the conversation, look it up in the answer
+    cache and otherwise retrieve the matching documents.
+
+    When the question is condensed, the documents for the question as asked
+    are retrieved while the LLM rewrites it and are kept if the rewritten
+    question turns out to mean the same thing.
+    """
+    req = ctx.req
+    ctx.history = get_message_history(req.user_session_id)
+    chat_history, summary = await load_history(ctx.history)
+    rewrite, ctx.condense_path = question_rewrite.needs_rewrite(req.q, chat_history)
+    if not rewrite:
+        question_rewrite.record_path(ctx.condense_path)
+        if not await join_flight(ctx):
+            await search(ctx)
+        return
+
+    speculative = asyncio.ensure_future(embed_and_retrieve(ctx.vector_db, req.q, req.max_matching_docs))
+    # the result may never be awaited, do not let a failure go unretrieved
+    speculative.add_done_callback(lambda f: f.cancelled() or f.exception())
+    try:
+        ctx.question = await condense_question(req, format_history(summary, chat_history))
+        await search(ctx, speculative)
+    finally:
+        speculative.cancel()
+        question_rewrite.record_path(ctx.condense_path)
+    logger.info(f"question=\"{req.q}\" condensed to \"{ctx.question}\", path={ctx.condense_path}")
+
+
+async def join_flight(ctx: RagContext) -> bool:
+    """
+    Coalesces a question without history with the identical questions in
+    flight. Returns True when another request answered it, ctx.shared then
+    holds the answer. Otherwise the request runs the pipeline, as the
+    leader of the flight when ctx.flight is set.
+    """
+    if not REQUEST_COALESCING_ENABLED or ctx.condense_path != question_rewrite.NO_HISTORY:
+        return False
+    flight = coalescer.join(coalescer.key(ctx.entry.tenant_id, ctx.entry.version, cache_key(ctx.req), ctx.req.q))
+    if flight.leader:
+        ctx.flight = flight
+        return False
+    with span("coalesced_wait"):
+        ctx.shared = await flight.wait()
+    if ctx.shared is None:
+        coalescer.record_fallback()
+        return False
+    ctx.docs = ctx.shared.docs
+    return True
+
+
+def complete_flight(ctx: RagContext, answer: Optional[str]) -> None:
+    """
+    Hands the answer, or None on failure, to the requests waiting for it.
+    """
+    if ctx.flight is not None:
+        ctx.flight.complete(SharedAnswer(answer, ctx.docs) if answer is not None else None)
+
+
+async def search(ctx: RagContext, speculative: Optional[asyncio.Future] = None) -> None:
+    """
+    Answer cache lookups and retrieval for ctx.question. The question
+    embedding is computed once and used for both the cache lookup and the
+    vector search.
+    """
+    req, entry = ctx.req, ctx.entry
+    if ANSWER_CACHE_ENABLED:
+        ctx.cached = answer_cache.lookup_exact(entry.tenant_id, entry.version, cache_key(req), ctx.question)
+        record_cache_lookup("exact", ctx.cached)
+        if ctx.cached is not None:
+            ctx.docs = ctx.cached.docs
+            return
+
+    ctx.embedding = await embed_query(ctx.vector_db, ctx.question)
+    if ANSWER_CACHE_ENABLED:
+        ctx.cached = answer_cache.lookup(entry.tenant_id, entry.version, cache_key(req),
+                                         ctx.question, ctx.embedding)
+        record_cache_lookup("semantic", ctx.cached)
+        if ctx.cached is not None:
+            ctx.docs = ctx.cached.docs
+            return
+
+    if speculative is not None:
+        raw_embedding, raw_docs = await speculative
+        if cosine_similarity(raw_embedding, ctx.embedding) >= question_rewrite.CONDENSE_REUSE_SIMILARITY:
+            ctx.condense_path = question_rewrite.REWRITTEN_REUSED_RETRIEVAL
+            ctx.docs = raw_docs
+            log_docs(ctx.question, ctx.docs)
+            return
+
+    ctx.docs = await retrieve(ctx.vector_db, ctx.question, ctx.embedding, req.max_matching_docs)
+    log_docs(ctx.question, ctx.docs)
+
+
+def cache_answer(ctx: RagContext, answer: str) -> None:
+    if ANSWER_CACHE_ENABLED and ctx.cached is None:
+        answer_cache.store(ctx.entry.tenant_id, ctx.entry.version, cache_key(ctx.req),
+                           ctx.question, ctx.embedding, answer, ctx.docs)
+
+
+async def run_rag(req: Request, entry: VectorDBEntry) -> Dict[str, Any]:
+    """
+    Runs one conversational RAG turn: load history, condense the question,
+    retrieve, generate and persist the turn.
+    """
+    ctx = RagContext(req, entry)
+    answer = None
+    try:
+        await prepare(ctx)
+        if ctx.shared is not None:
+            answer = ctx.shared.answer
+        elif ctx.cached is not None:
+            answer = ctx.cached.answer
+        else:
+            answer = await generate_answer(req, ctx.question, ctx.docs)
+            cache_answer(ctx, answer)
+    finally:
+        complete_flight(ctx, answer)
+    await save_turn(ctx.history, req.q, answer)
+
+    logger.info(f"answer received from llm,\nquestion: \"{req.q}\"\nanswer: \"{answer}\"")
+    resp = {'question': req.q, 'answer': answer, 'session_id': req.user_session_id,
+            'condense_path': ctx.condense_path}
+    if req.verbose is True:
+        resp['docs'] = ctx.docs
+    return resp
+
+
+async def run_rag_stream(req: Request, entry: VectorDBEntry) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Streaming variant of run_rag. Yields a 'sources' event with the retrieved
+    documents first, then one 'token' event per chunk generated by Bedrock
+    and finally a 'done' event with the full answer. The turn is saved
+    once the answer is complete. A request coalesced with an identical one
+    receives the answer as a single token once it is complete.
+    """
+    ctx = RagContext(req, entry)
+    answer = None
+    try:
+        await prepare(ctx)
+        yield {'type': 'sources', 'question': req.q, 'session_id': req.user_session_id,
+               'condense_path': ctx.condense_path, 'docs': ctx.docs}
+
+        if ctx.shared is not None or ctx.cached is not None:
+            answer = ctx.shared.answer if ctx.shared is not None else ctx.cached.answer
+            yield {'type': 'token', 'text': answer}
+        else:
+            tokens = []
+            async for token in stream_answer(req, ctx.question, ctx.docs):
+                tokens.append(token)
+                yield {'type': 'token', 'text': token}
+            answer = "".join(tokens)
+            cache_answer(ctx, answer)
+    finally:
+        complete_flight(ctx, answer)
+
+    await save_turn(ctx.history, req.q, answer)
+    logger.info(f"answer streamed from llm,\nquestion: \"{req.q}\"\nanswer: \"{answer}\"")
+    yield {'type': 'done', 'answer': answer, 'session_id': req.user_session_id}
@@ -0,0 +1,101 @@
+"""
+Single-flight de-duplication of identical in-flight questions.
+
+During launches and incidents many users of a tenant ask the same question
+within seconds. Requests without chat history that ask the same normalized
+question of the same index version with the same generation parameters
+share one retrieval and generation: the first one leads, the others wait for
+its answer and only persist their own turn. Once the leader is done the
+answer cache serves the later requests.
+
+If the leader fails or its client goes away, its followers run the pipeline
+themselves.
+"""
+import os
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from langchain.schema import Document
+from . import metrics
+from .answer_cache import normalize_question
+from .tracing import current_tenant
+
+logger = logging.getLogger(__name__)
+
+REQUEST_COALESCING_ENABLED = os.environ.get('REQUEST_COALESCING_ENABLED', 'true').lower() == 'true'
+
+FlightKey = Tuple[str, str, str, str]
+
+
+@dataclass
+class SharedAnswer:
+    answer: str
+    docs: List[Document]
+
+
+class Flight:
+    def __init__(self, coalescer: "RequestCoalescer", key: FlightKey, future: asyncio.Future, leader: bool):
+        self._coalescer = coalescer
+        self.key = key
+        self.future = future
+        self.leader = leader
+
+    async def wait(self) -> Optional[SharedAnswer]:
+        """
+        The leader's answer, None when the leader did not get one.
+        """
+        return await asyncio.shield(self.future)
+
+    def complete(self, answer: Optional[SharedAnswer]) -> None:
+        """
+        Called by the leader once, with None when it failed.
+        """
+        if self.leader and not self.future.done():
+            self._coalescer.remove(self)
+            self.future.set_result(answer)
+
+
+class RequestCoalescer:
+    """
+    In-flight questions of this worker. Must be used from the event loop.
+    """
+    def __init__(self):
+        self._flights: Dict[FlightKey, asyncio.Future] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.fallbacks = 0
+
+    @staticmethod
+    def key(tenant_id: str, index_version: str, params_key: str, question: str) -> FlightKey:
+        return (tenant_id, index_version, params_key, normalize_question(question))
+
+    def join(self, key: FlightKey) -> Flight:
+        future = self._flights.get(key)
+        leader = future is None
+        if leader:
+            future = asyncio.get_running_loop().create_future()
+            self._flights[key] = future
+            self.leaders += 1
+        else:
+            self.followers += 1
+        metrics.COALESCED_REQUESTS.inc(tenant=current_tenant(), role="leader" if leader else "follower")
+        return Flight(self, key, future, leader)
+
+    def remove(self, flight: Flight) -> None:
+        if self._flights.get(flight.key) is flight.future:
+            del self._flights[flight.key]
+
+    def record_fallback(self) -> None:
+        self.fallbacks += 1
+        metrics.COALESCED_REQUESTS.inc(tenant=current_tenant(), role="fallback")
+
+    def stats(self):
+        return {'enabled': REQUEST_COALESCING_ENABLED,
+                'in_flight': len(self._flights),
+                'leaders': self.leaders,
+                'followers': self.followers,
+                'fallbacks': self.fallbacks}
+
+
+coalescer = RequestCoalescer()
@@ -0,0 +1,119 @@
+"""
+Read-only docstore backed by the docstore.sqlite file written by the
+ingestion script.
+
+Unlike index.pkl, which every worker has to unpickle in full, the SQLite file
+is opened lazily and only the rows of the documents returned by a search are
+read. The file is part of an immutable index version, so it is opened with
+immutable=1 and SQLite skips all locking. While a docstore is open it holds
+a shared flock on the file, so the cleanup of old versions leaves the files
+still in use in place: the workers open their connections lazily, per thread
+and again after a fork, and need the file to still be there.
+
+When the ingestion script was run with --bm25 the file also has a docs_fts
+full text index over the chunks, which is searched with SQLite's BM25 ranking.
+"""
+import os
+import json
+import fcntl
+import sqlite3
+import threading
+from collections.abc import Mapping
+from typing import Iterator, List, Optional, Union
+from langchain.docstore.base import Docstore
+from langchain.schema import Document
+
+# memory mapped reads let the workers share the page cache
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+
+
+def pin(path: str):
+    """
+    Marks the file as in use until the returned file object is closed or
+    garbage collected, see is_pinned.
+    """
+    f = open(path, 'rb')
+    fcntl.flock(f, fcntl.LOCK_SH)
+    return f
+
+
+def is_pinned(path: str) -> bool:
+    """
+    True while a process, or a worker forked from it, has the file pinned.
+    """
+    with open(path, 'rb') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(f, fcntl.LOCK_UN)
+        return False
+
+
+class _SQLiteFile:
+    def __init__(self, path: str):
+        self.path = path
+        self._pin = pin(path)
+        self._local = threading.local()
+        # fail on load rather than on the first search
+        self.conn()
+
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        # a connection opened before a fork, e.g. in the gunicorn master,
+        # must not be used by the forked worker
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+class SQLiteDocstore(Docstore):
+    def __init__(self, path: str):
+        self._file = _SQLiteFile(path)
+        self._has_lexical_index: Optional[bool] = None
+
+    def has_lexical_index(self) -> bool:
+        if self._has_lexical_index is None:
+            row = self._file.conn().execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'docs_fts'").fetchone()
+            self._has_lexical_index = row is not None
+        return self._has_lexical_index
+
+    def lexical_search(self, query: str, k: int) -> List[int]:
+        """
+        FAISS positions of the k best BM25 matches of an FTS5 query.
+        """
+        rows = self._file.conn().execute(
+            "SELECT rowid FROM docs_fts WHERE docs_fts MATCH ? ORDER BY bm25(docs_fts) LIMIT ?", (query, k))
+        return [position for (position,) in rows]
+
+    def search(self, search: str) -> Union[str, Document]:
+        row = self._file.conn().execute("SELECT page_content, metadata FROM docs WHERE id = ?",
+                                        (search,)).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(page_content=row[0], metadata=json.loads(row[1]))
+
+
+class SQLiteIndexToDocstoreId(Mapping):
+    """
+    FAISS position -> docstore id mapping, read from the same file.
+    """
+    def __init__(self, path: str):
+        self._file = _SQLiteFile(path)
+
+    def __getitem__(self, position: int) -> str:
+        row = self._file.conn().execute("SELECT id FROM docs WHERE position = ?", (int(position),)).fetchone()
+        if row is None:
+            raise KeyError(position)
+        return row[0]
+
+    def __len__(self) -> int:
+        return self._file.conn().execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def __iter__(self) -> Iterator[int]:
+        for (position,) in self._file.conn().execute("SELECT position FROM docs ORDER BY position"):
+            yield position
@@ -0,0 +1,105 @@
+"""
+Work deferred until the server accepts connections.
+
+The worker starts serving health checks right away. In the background it
+then imports the heavy langchain modules, creates the Bedrock clients and
+hydrates the indexes of the tenants in VECTORDB_PRELOAD_TENANTS. The
+readiness probe fails until that is done, so traffic only reaches warm
+workers. A tenant whose index cannot be loaded does not keep the worker
+unready, its first request retries the load.
+"""
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+from . import clients
+from .clients import BEDROCK_SERVICE, run_blocking
+from .vectordb_registry import DEFAULT_TENANT_ID, registry
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_MODEL = os.environ.get('EMBEDDING_MODEL_ID')
+# comma separated tenants loaded at startup, empty to load every index on
+# first request
+VECTORDB_PRELOAD_TENANTS = [t.strip() for t in
+                            os.environ.get('VECTORDB_PRELOAD_TENANTS', DEFAULT_TENANT_ID).split(",") if t.strip()]
+
+PENDING = "pending"
+LOADED = "loaded"
+FAILED = "failed"
+
+
+class Readiness:
+    def __init__(self, tenant_ids: List[str]):
+        self.started_at = time.time()
+        self.warm_seconds: Optional[float] = None
+        self.imports = PENDING
+        self.tenants: Dict[str, str] = {t: PENDING for t in tenant_ids}
+        self.errors: Dict[str, str] = {}
+        self._task: Optional[asyncio.Future] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.imports != PENDING and PENDING not in self.tenants.values()
+
+    def status(self) -> Dict[str, Any]:
+        return {'ready': self.ready,
+                'imports': self.imports,
+                'tenants': dict(self.tenants),
+                'errors': dict(self.errors),
+                'uptime_seconds': round(time.time() - self.started_at, 1),
+                'warm_seconds': self.warm_seconds}
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._warm_up())
+
+    async def _warm_up(self) -> None:
+        try:
+            await run_blocking(_import_heavy_modules)
+            self.imports = LOADED
+        except Exception as e:
+            logger.exception("could not warm up the pipeline, it is warmed up by the first request")
+            self.imports = FAILED
+            self.errors['imports'] = str(e)
+        await asyncio.gather(*(self._preload(t) for t in self.tenants))
+        self.warm_seconds = round(time.time() - self.started_at, 2)
+        logger.info(f"worker ready after {self.warm_seconds}s, tenants={self.tenants}")
+
+    async def _preload(self, tenant_id: str) -> None:
+        try:
+            await registry.get_entry(tenant_id)
+            self.tenants[tenant_id] = LOADED
+        except Exception as e:
+            logger.exception(f"could not preload the vector db of tenant={tenant_id}")
+            self.tenants[tenant_id] = FAILED
+            self.errors[tenant_id] = str(e)
+
+
+def _import_heavy_modules() -> None:
+    # imported by the first request otherwise, see rag_pipeline.get_llm
+    # and initialize.read_vector_db_faiss
+    import langchain.vectorstores  # noqa: F401
+    from .embeddings_cache import get_cached_embeddings
+    from .rag_pipeline import get_llm
+    get_llm()
+    get_cached_embeddings(EMBEDDINGS_MODEL, BEDROCK_SERVICE)
+
+
+def before_fork() -> None:
+    """
+    gunicorn master hook with preload_app, see gunicorn.conf.py.
+    """
+    registry.load_before_fork(VECTORDB_PRELOAD_TENANTS)
+
+
+def after_fork() -> None:
+    """
+    gunicorn worker hook, run in every worker right after it is forked.
+    """
+    clients.reset_after_fork()
+    registry.after_fork()
+
+
+readiness = Readiness(VECTORDB_PRELOAD_TENANTS)
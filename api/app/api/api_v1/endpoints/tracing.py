@@ -0,0 +1,136 @@
+"""
+Per-request traces of the RAG pipeline.
+
+A trace is started by the endpoint once the tenant is known and is carried
+to every stage, including the ones running concurrently, by a context
+variable. Every span is recorded in the stage latency histogram with the
+tenant label and, when the opentelemetry API is installed, exported as an
+OpenTelemetry span. The spans of a request are logged as a single JSON line
+when it completes.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+import contextlib
+import contextvars
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+from . import metrics
+
+try:
+    from opentelemetry import trace as otel_trace
+    _tracer = otel_trace.get_tracer("ragapi")
+except ImportError:
+    _tracer = None
+
+logger = logging.getLogger(__name__)
+
+TRACE_LOG_ENABLED = os.environ.get('TRACE_LOG_ENABLED', 'true').lower() == 'true'
+# tenant label of the work done outside of a request, e.g. hot reloads
+NO_TENANT = "none"
+# tenant label of requests for a tenant that does not exist
+UNKNOWN_TENANT = "unknown"
+
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    duration: float = 0.0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class RequestTrace:
+    tenant_id: str
+    endpoint: str
+    trace_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    start: float = field(default_factory=time.perf_counter)
+    spans: List[Span] = field(default_factory=list)
+
+    def to_dict(self, status: int) -> Dict[str, Any]:
+        spans = [{'name': s.name, 'start_ms': round((s.start - self.start) * 1000, 1),
+                  'duration_ms': round(s.duration * 1000, 1), **s.attributes}
+                 for s in sorted(self.spans, key=lambda s: s.start)]
+        return {'trace_id': self.trace_id, 'tenant': self.tenant_id, 'endpoint': self.endpoint,
+                'status': status, 'duration_ms': round((time.perf_counter() - self.start) * 1000, 1),
+                'spans': spans}
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar("ragapi_trace", default=None)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current.get()
+
+
+def current_tenant() -> str:
+    trace = _current.get()
+    return trace.tenant_id if trace is not None else NO_TENANT
+
+
+@contextlib.contextmanager
+def request_trace(tenant_id: str, endpoint: str) -> Iterator[RequestTrace]:
+    """
+    Traces a request. The status is 200 unless the body raises, an
+    HTTPException raised in the body keeps its status code.
+    """
+    trace = RequestTrace(tenant_id=tenant_id, endpoint=endpoint)
+    token = _current.set(trace)
+    metrics.REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+    status = 200
+    otel_span = _tracer.start_as_current_span(f"rag.{endpoint}") if _tracer else contextlib.nullcontext()
+    try:
+        with otel_span:
+            yield trace
+    except Exception as e:
+        status = getattr(e, 'status_code', 500)
+        raise
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            # a streamed body may finish in another context than it started
+            pass
+        metrics.REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+        metrics.REQUESTS.inc(tenant=trace.tenant_id, endpoint=endpoint, status=str(status))
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - trace.start, tenant=trace.tenant_id,
+                                        endpoint=endpoint)
+        if TRACE_LOG_ENABLED:
+            logger.info(json.dumps(trace.to_dict(status)))
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """
+    Times a stage of the current request. Attributes can also be added to
+    the yielded span while it runs.
+    """
+    trace = _current.get()
+    s = Span(name=name, start=time.perf_counter(), attributes=dict(attributes))
+    otel_span = _tracer.start_as_current_span(name) if _tracer else contextlib.nullcontext()
+    try:
+        with otel_span as current:
+            yield s
+            if current is not None:
+                for key, value in s.attributes.items():
+                    current.set_attribute(key, value)
+    finally:
+        s.duration = time.perf_counter() - s.start
+        metrics.STAGE_SECONDS.observe(s.duration, tenant=current_tenant(), stage=name)
+        if trace is not None:
+            trace.spans.append(s)
+
+
+def record_tokens(s: Span, prompt_tokens: int, completion_tokens: int) -> None:
+    """
+    Adds the estimated tokens of the LLM call timed by s to its span and
+    to the token metrics, labelled with the span name.
+    """
+    tenant = current_tenant()
+    s.attributes.update(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    for kind, tokens in (("prompt", prompt_tokens), ("completion", completion_tokens)):
+        metrics.LLM_TOKENS.observe(tokens, tenant=tenant, call=s.name, kind=kind)
+        metrics.LLM_TOKENS_TOTAL.inc(tokens, tenant=tenant, call=s.name, kind=kind)
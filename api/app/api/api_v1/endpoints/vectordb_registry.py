@@ -0,0 +1,254 @@
+"""
+Registry of per-tenant vector databases.
+
+Indexes are downloaded from S3 and hydrated on first use, kept in memory
+within a configurable budget and evicted least recently used first. Concurrent
+requests for a tenant whose index is still loading wait for the same load.
+Loaded indexes are periodically checked for a newer published version, which
+is loaded in the background and swapped in; requests already running keep
+the version they started with.
+"""
+import os
+import re
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+from . import metrics
+from .answer_cache import answer_cache
+from .clients import BEDROCK_SERVICE, run_blocking
+from .embeddings_cache import get_cached_embeddings
+from .initialize import (NotModified,
+                         fetch_vector_db_files,
+                         get_manifest,
+                         read_vector_db_faiss)
+from .tracing import span
+
+if TYPE_CHECKING:
+    from langchain.vectorstores import FAISS
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_MODEL = os.environ.get('EMBEDDING_MODEL_ID')
+
+# tenant used when the request does not carry one, this is the tenant
+# the pod was deployed for
+DEFAULT_TENANT_ID = os.environ.get('DEFAULT_TENANT_ID', 'default')
+# e.g. s3://contextual-data-{tenant}-abcd1234/faiss_index/
+VECTORDB_S3_PATH_TEMPLATE = os.environ.get('VECTORDB_S3_PATH_TEMPLATE')
+DEFAULT_VECTORDB_S3_PATH = f"s3://{os.environ.get('CONTEXTUAL_DATA_BUCKET')}/faiss_index/"
+VECTOR_DB_DIR = os.path.join("/tmp", "_vectordb")
+VECTORDB_MEMORY_BUDGET_MB = int(os.environ.get('VECTORDB_MEMORY_BUDGET_MB', 2048))
+# how often loaded indexes are checked for a new version, 0 disables hot reload
+VECTORDB_REFRESH_SECONDS = int(os.environ.get('VECTORDB_REFRESH_SECONDS', 60))
+
+# tenant ids end up in S3 paths and local directory names
+TENANT_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+
+class UnknownTenantError(Exception):
+    pass
+
+
+class _UnboundEmbeddings:
+    """
+    Embeddings of the indexes loaded before fork, the Bedrock client must be
+    created by the worker. See VectorDBRegistry.after_fork.
+    """
+    def embed_query(self, text: str):
+        raise RuntimeError("the index was loaded before fork and its embeddings are not bound yet")
+
+
+@dataclass
+class VectorDBEntry:
+    tenant_id: str
+    vector_db: "FAISS"
+    size_bytes: int
+    version: str
+    manifest_etag: Optional[str] = None
+    loaded_at: float = field(default_factory=time.time)
+
+
+def vectordb_s3_path(tenant_id: str) -> str:
+    if not TENANT_ID_PATTERN.match(tenant_id) or tenant_id in (".", ".."):
+        raise UnknownTenantError(f"invalid tenant id={tenant_id!r}")
+    if VECTORDB_S3_PATH_TEMPLATE:
+        return VECTORDB_S3_PATH_TEMPLATE.format(tenant=tenant_id)
+    if tenant_id == DEFAULT_TENANT_ID:
+        return DEFAULT_VECTORDB_S3_PATH
+    raise UnknownTenantError(f"no vector db configured for tenant={tenant_id}, "
+                             f"set VECTORDB_S3_PATH_TEMPLATE to serve more than one tenant")
+
+
+class VectorDBRegistry:
+    """
+    Maps a tenant to its FAISS vector db. All methods must be called from
+    the event loop.
+    """
+    def __init__(self, memory_budget_bytes: int):
+        self.memory_budget_bytes = memory_budget_bytes
+        self._entries: "OrderedDict[str, VectorDBEntry]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Future] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.loads = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    async def get(self, tenant_id: str) -> "FAISS":
+        return (await self.get_entry(tenant_id)).vector_db
+
+    async def get_entry(self, tenant_id: str) -> VectorDBEntry:
+        entry = self._entries.get(tenant_id)
+        if entry is not None:
+            self._entries.move_to_end(tenant_id)
+            return entry
+
+        # de-duplicate concurrent loads of the same tenant
+        future = self._loading.get(tenant_id)
+        if future is None:
+            future = asyncio.ensure_future(self._load(tenant_id))
+            self._loading[tenant_id] = future
+            future.add_done_callback(lambda _: self._loading.pop(tenant_id, None))
+        return await asyncio.shield(future)
+
+    async def _load(self, tenant_id: str, manifest: Optional[Dict] = None) -> VectorDBEntry:
+        s3_path = vectordb_s3_path(tenant_id)
+        local_path = os.path.join(VECTOR_DB_DIR, tenant_id)
+        logger.info(f"loading vector db for tenant={tenant_id} from {s3_path}")
+        start = time.time()
+        with span("index_fetch"):
+            files = await run_blocking(fetch_vector_db_files, s3_path, local_path, manifest)
+        current = self._entries.get(tenant_id)
+        if current is not None and current.version == files.version:
+            current.manifest_etag = manifest['etag'] if manifest else None
+            return current
+
+        embeddings = get_cached_embeddings(EMBEDDINGS_MODEL, BEDROCK_SERVICE)
+        with span("index_read"):
+            vector_db = await run_blocking(read_vector_db_faiss, files.local_dir, embeddings)
+        entry = VectorDBEntry(tenant_id=tenant_id,
+                              vector_db=vector_db,
+                              size_bytes=files.size_bytes,
+                              version=files.version,
+                              manifest_etag=manifest['etag'] if manifest else None)
+        logger.info(f"vector db for tenant={tenant_id} loaded in {time.time() - start:.2f}s, "
+                    f"size={entry.size_bytes} bytes, version={entry.version}")
+        self.loads += 1
+        metrics.INDEX_LOADS.inc(tenant=tenant_id)
+        metrics.INDEX_LOAD_SECONDS.observe(time.time() - start, tenant=tenant_id)
+        self.put(entry)
+        return entry
+
+    def load_before_fork(self, tenant_ids: List[str]) -> None:
+        """
+        Blocking. Loads the indexes in the gunicorn master before the workers
+        are forked, the workers then share their memory copy on write
+        instead of each loading a copy. Failures are left to the workers.
+        """
+        for tenant_id in tenant_ids:
+            start = time.time()
+            try:
+                files = fetch_vector_db_files(vectordb_s3_path(tenant_id), os.path.join(VECTOR_DB_DIR, tenant_id))
+                vector_db = read_vector_db_faiss(files.local_dir, _UnboundEmbeddings())
+            except Exception:
+                logger.exception(f"could not load the vector db for tenant={tenant_id} before fork")
+                continue
+            self.put(VectorDBEntry(tenant_id=tenant_id, vector_db=vector_db,
+                                   size_bytes=files.size_bytes, version=files.version))
+            self.loads += 1
+            metrics.INDEX_LOADS.inc(tenant=tenant_id)
+            metrics.INDEX_LOAD_SECONDS.observe(time.time() - start, tenant=tenant_id)
+            logger.info(f"vector db for tenant={tenant_id} loaded before fork in {time.time() - start:.2f}s, "
+                        f"size={files.size_bytes} bytes, version={files.version}")
+
+    def after_fork(self) -> None:
+        """
+        Binds the indexes loaded before fork to this worker's embeddings.
+        """
+        embeddings = get_cached_embeddings(EMBEDDINGS_MODEL, BEDROCK_SERVICE)
+        for entry in self._entries.values():
+            entry.vector_db.embedding_function = embeddings.embed_query
+
+    async def refresh(self) -> None:
+        """
+        Loads and swaps in the new version of every loaded index that was
+        republished. A tenant is only checked once its manifest ETag changed.
+        """
+        for tenant_id, entry in list(self._entries.items()):
+            s3_path = vectordb_s3_path(tenant_id)
+            try:
+                manifest = await run_blocking(get_manifest, s3_path, entry.manifest_etag)
+                if manifest is not None and manifest['version'] == entry.version:
+                    entry.manifest_etag = manifest['etag']
+                    continue
+                # legacy indexes are compared by the ETags of their files
+                new_entry = await self._load(tenant_id, manifest)
+                if new_entry is not entry:
+                    self.reloads += 1
+                    logger.info(f"vector db for tenant={tenant_id} swapped from "
+                                f"version={entry.version} to version={new_entry.version}")
+            except NotModified:
+                continue
+            except Exception:
+                logger.exception(f"could not refresh the vector db for tenant={tenant_id}")
+
+    async def refresh_forever(self, interval_seconds: int) -> None:
+        while True:
+            await asyncio.sleep(interval_seconds)
+            await self.refresh()
+
+    def start_refresh(self) -> None:
+        if VECTORDB_REFRESH_SECONDS > 0 and self._refresh_task is None:
+            self._refresh_task = asyncio.ensure_future(self.refresh_forever(VECTORDB_REFRESH_SECONDS))
+
+    def put(self, entry: VectorDBEntry) -> None:
+        self._entries[entry.tenant_id] = entry
+        answer_cache.index_swapped(entry.tenant_id, entry.version)
+        self._entries.move_to_end(entry.tenant_id)
+        self._evict(keep=entry.tenant_id)
+
+    def _evict(self, keep: str) -> None:
+        # requests already holding a reference to an evicted index keep
+        # using it, the memory is released once they finish
+        while self.size_bytes > self.memory_budget_bytes and len(self._entries) > 1:
+            tenant_id, entry = next(iter(self._entries.items()))
+            if tenant_id == keep:
+                break
+            del self._entries[tenant_id]
+            self.evictions += 1
+            logger.info(f"evicted vector db for tenant={tenant_id}, size={entry.size_bytes} bytes")
+
+    def evict(self, tenant_id: str) -> None:
+        if self._entries.pop(tenant_id, None) is not None:
+            self.evictions += 1
+
+    def entries(self) -> Dict[str, VectorDBEntry]:
+        return dict(self._entries)
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(e.size_bytes for e in self._entries.values())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'tenants': {t: e.version for t, e in self._entries.items()},
+            'loading': list(self._loading.keys()),
+            'size_bytes': self.size_bytes,
+            'memory_budget_bytes': self.memory_budget_bytes,
+            'loads': self.loads,
+            'reloads': self.reloads,
+            'evictions': self.evictions,
+        }
+
+
+registry = VectorDBRegistry(VECTORDB_MEMORY_BUDGET_MB * 1024 * 1024)
+
+
+def resolve_tenant_id(header_tenant_id: Optional[str], request_tenant_id: Optional[str]) -> str:
+    """
+    The tenant set by the authentication proxy always wins, the tenant in the
+    request body is only used for calls that do not go through the proxy.
+    """
+    return header_tenant_id or request_tenant_id or DEFAULT_TENANT_ID
@@ -0,0 +1,95 @@
+"""
+gunicorn settings of the RAG API, read by gunicorn from the working
+directory.
+
+The number of workers defaults to one per core available to the container,
+bounded by its memory: every worker needs GUNICORN_WORKER_MEMORY_MB for
+itself and, unless the indexes are shared, its own copy of the indexes
+(VECTORDB_MEMORY_BUDGET_MB). GUNICORN_WORKERS sets the count explicitly.
+
+With GUNICORN_PRELOAD (the default) the app is imported and the indexes of
+VECTORDB_PRELOAD_TENANTS are loaded once in the master, and the forked
+workers share them copy on write. With the pinned faiss-cpu 1.7.4 this is the
+only way flat, HNSW and PQ indexes are shared: faiss only memory maps the
+inverted lists of IVF indexes, which the page cache shares in any case.
+Indexes loaded later (other tenants, new versions) are loaded by each worker
+and take VECTORDB_MEMORY_BUDGET_MB in each of them.
+"""
+import os
+import math
+import multiprocessing
+
+GUNICORN_WORKER_MEMORY_MB = int(os.environ.get('GUNICORN_WORKER_MEMORY_MB', 512))
+VECTORDB_MEMORY_BUDGET_MB = int(os.environ.get('VECTORDB_MEMORY_BUDGET_MB', 2048))
+GUNICORN_PRELOAD = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+
+def _read(path: str):
+    try:
+        with open(path) as f:
+            return f.read().split()
+    except OSError:
+        return None
+
+
+def available_cpus() -> int:
+    """
+    CPUs this process may use, honouring the cgroup CPU quota of the pod.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = multiprocessing.cpu_count()
+    quota = _read("/sys/fs/cgroup/cpu.max")
+    if quota and quota[0] != "max":
+        cpus = min(cpus, math.ceil(int(quota[0]) / int(quota[1])))
+    quota, period = _read("/sys/fs/cgroup/cpu/cpu.cfs_quota_us"), _read("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and int(quota[0]) > 0:
+        cpus = min(cpus, math.ceil(int(quota[0]) / int(period[0])))
+    return max(1, cpus)
+
+
+def available_memory_mb() -> int:
+    """
+    Memory limit of the pod's cgroup, or the physical memory.
+    """
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        limit = _read(path)
+        if limit and limit[0] != "max":
+            memory = min(memory, int(limit[0]))
+    return memory // (1024 * 1024)
+
+
+def worker_count() -> int:
+    if os.environ.get('GUNICORN_WORKERS'):
+        return int(os.environ['GUNICORN_WORKERS'])
+    memory = available_memory_mb()
+    if GUNICORN_PRELOAD:
+        # one copy of the indexes, shared by all the workers
+        per_worker, memory = GUNICORN_WORKER_MEMORY_MB, memory - VECTORDB_MEMORY_BUDGET_MB
+    else:
+        per_worker = GUNICORN_WORKER_MEMORY_MB + VECTORDB_MEMORY_BUDGET_MB
+    return max(1, min(available_cpus(), memory // per_worker))
+
+
+bind = os.environ.get('GUNICORN_BIND', "0.0.0.0:8000")
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = worker_count()
+preload_app = GUNICORN_PRELOAD
+# let streamed answers finish on shutdown
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 60))
+
+
+def when_ready(server):
+    if GUNICORN_PRELOAD:
+        from api.api_v1.endpoints.startup import before_fork
+        before_fork()
+    server.log.info(f"starting {workers} workers, preload_app={GUNICORN_PRELOAD}, "
+                    f"cpus={available_cpus()}, memory={available_memory_mb()}MB")
+
+
+def post_fork(server, worker):
+    if GUNICORN_PRELOAD:
+        from api.api_v1.endpoints.startup import after_fork
+        after_fork()
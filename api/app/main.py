@@ -3,8 +3,11 @@ import sys
 import boto3
 import logging
 import subprocess
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse
 from api.api_v1.api import router as api_router
+from api.api_v1.endpoints.llm_ep import render_metrics, require_admin
+from api.api_v1.endpoints.startup import readiness
 
 logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger()
@@ -15,4 +18,21 @@ app = FastAPI()
 async def root():
     return {"message": "API for question answering bot"}
 
+@app.get("/ready")
+async def ready():
+    """
+    Readiness probe, 503 until the pipeline is warm and the preloaded
+    indexes are hydrated. / is the liveness probe.
+    """
+    return JSONResponse(readiness.status(), status_code=200 if readiness.ready else 503)
+
+@app.get("/metrics", response_class=PlainTextResponse, dependencies=[Depends(require_admin)])
+async def metrics():
+    """
+    Prometheus metrics. The series are labelled by tenant, so like the admin
+    endpoints this needs the X-Admin-Token header and is disabled while
+    ADMIN_TOKEN is unset; configure the scraper to send the header.
+    """
+    return render_metrics()
+
 app.include_router(api_router, prefix="/api/v1")
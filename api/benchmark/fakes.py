@@ -0,0 +1,286 @@
+"""
+Local stand-ins for the AWS services used by the RAG API, for benchmarking
+without an AWS account.
+
+- Bedrock: deterministic hashed bag-of-words embeddings, and an LLM stub with
+  a configurable time to first token and token rate that echoes the
+  question.
+- S3: a local directory with one sub-directory per bucket.
+- DynamoDB: an in-memory table that supports the calls the chat history
+  makes.
+
+install() makes the API's boto3 session return these, it must be called
+before the first client is created.
+"""
+import io
+import os
+import re
+import copy
+import json
+import time
+import random
+import shutil
+import hashlib
+import functools
+import threading
+from typing import Dict, List, Optional
+import numpy as np
+from botocore.exceptions import ClientError
+
+
+def _client_error(code: str, operation: str) -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class Latency:
+    """
+    Sleeps for a mean latency with uniform jitter, in milliseconds.
+    """
+    def __init__(self, mean_ms: float = 0.0, jitter_ms: float = 0.0):
+        self.mean_ms = mean_ms
+        self.jitter_ms = jitter_ms
+
+    def sleep(self) -> None:
+        ms = self.mean_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if ms > 0:
+            time.sleep(ms / 1000)
+
+
+def fake_embedding(text: str, dim: int = 1536) -> List[float]:
+    """
+    Hashed bag of words, texts sharing words are close to each other.
+    """
+    v = np.zeros(dim, dtype=np.float32)
+    for w in re.findall(r"\w+", text.lower()):
+        v[int(hashlib.md5(w.encode("utf-8")).hexdigest(), 16) % dim] += 1
+    norm = np.linalg.norm(v)
+    return (v / norm if norm else v).tolist()
+
+
+class _Body:
+    def __init__(self, data: bytes):
+        self._data = data
+
+    def read(self) -> bytes:
+        return self._data
+
+
+class FakeBedrockRuntime:
+    def __init__(self, embed_latency: Latency, llm_latency: Latency, tokens_per_second: float = 50.0,
+                 answer_tokens: int = 40, dim: int = 1536):
+        self.embed_latency = embed_latency
+        self.llm_latency = llm_latency
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.dim = dim
+        self.calls: Dict[str, int] = {'embed': 0, 'llm': 0, 'stream': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, kind: str) -> None:
+        with self._lock:
+            self.calls[kind] += 1
+
+    def _completion(self, prompt: str) -> str:
+        condense = re.search(r"previous conversation: (.*?)\n", prompt)
+        if condense:
+            return " " + condense.group(1)
+        if prompt.rstrip().endswith("Summary:"):
+            return " The user asked questions about the knowledge base."
+        question = re.search(r"<q>([^<]+)</q>", prompt)
+        question = question.group(1) if question else "the question"
+        return f" Here is what the knowledge base says about {question}." + " lorem" * self.answer_tokens
+
+    def invoke_model(self, body, modelId, accept=None, contentType=None):
+        request = json.loads(body)
+        if "embed" in modelId:
+            self._count('embed')
+            self.embed_latency.sleep()
+            response = {'embedding': fake_embedding(request['inputText'], self.dim)}
+        else:
+            self._count('llm')
+            completion = self._completion(request['prompt'])
+            self.llm_latency.sleep()
+            time.sleep(len(completion.split()) / self.tokens_per_second)
+            response = {'completion': completion}
+        return {'body': _Body(json.dumps(response).encode("utf-8"))}
+
+    def invoke_model_with_response_stream(self, body, modelId, accept=None, contentType=None):
+        self._count('stream')
+        completion = self._completion(json.loads(body)['prompt'])
+
+        def events():
+            # time to first token, then a steady token rate
+            self.llm_latency.sleep()
+            for word in completion.split():
+                time.sleep(1 / self.tokens_per_second)
+                yield {'chunk': {'bytes': json.dumps({'completion': " " + word}).encode("utf-8")}}
+        return {'body': events()}
+
+
+def _etag(path: str) -> str:
+    with open(path, 'rb') as f:
+        return '"%s"' % hashlib.md5(f.read()).hexdigest()
+
+
+class FakeS3:
+    """
+    Both the client and the resource API calls made by the API and the
+    ingestion script, backed by root/<bucket>/<key>.
+    """
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, key)
+
+    # client
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise _client_error('NoSuchKey', 'GetObject')
+        etag = _etag(path)
+        if IfNoneMatch and IfNoneMatch == etag:
+            raise _client_error('304', 'GetObject')
+        with open(path, 'rb') as f:
+            return {'Body': io.BytesIO(f.read()), 'ETag': etag}
+
+    def head_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise _client_error('404', 'HeadObject')
+        return {'ETag': _etag(path)}
+
+    def download_file(self, Bucket, Key, Filename, Config=None):
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise _client_error('404', 'HeadObject')
+        shutil.copy(path, Filename)
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copy(Filename, path)
+
+    # resource
+    def Bucket(self, name):
+        s3 = self
+
+        class _Bucket:
+            def upload_file(self, Filename, Key, **kwargs):
+                s3.upload_file(Filename, name, Key)
+
+            def download_file(self, Key, Filename, **kwargs):
+                s3.download_file(name, Key, Filename)
+        return _Bucket()
+
+    def Object(self, bucket, key):
+        s3 = self
+
+        class _Object:
+            def get(self):
+                return s3.get_object(bucket, key)
+
+            def put(self, Body, **kwargs):
+                path = s3._path(bucket, key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(Body)
+        return _Object()
+
+
+class FakeTable:
+    """
+    In-memory DynamoDB table keyed by its partition key. Supports the
+    expressions used by the chat history and the sessions table.
+    """
+    def __init__(self, name: str, latency: Latency):
+        self.name = name
+        self.latency = latency
+        self.items: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(Key) -> str:
+        return json.dumps(Key, sort_keys=True)
+
+    def get_item(self, Key, **kwargs):
+        self.latency.sleep()
+        with self._lock:
+            item = self.items.get(self._key(Key))
+            return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def put_item(self, Item, **kwargs):
+        self.latency.sleep()
+        key = {k: Item[k] for k in ('SessionId', 'TenantId') if k in Item}
+        with self._lock:
+            self.items[self._key(key)] = copy.deepcopy(Item)
+        return {}
+
+    def delete_item(self, Key, **kwargs):
+        self.latency.sleep()
+        with self._lock:
+            self.items.pop(self._key(Key), None)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None,
+                    ExpressionAttributeValues=None, **kwargs):
+        self.latency.sleep()
+        values = ExpressionAttributeValues or {}
+        with self._lock:
+            item = copy.deepcopy(self.items.get(self._key(Key), dict(Key)))
+            if not self._condition(item, ConditionExpression, values):
+                raise _client_error('ConditionalCheckFailedException', 'UpdateItem')
+            for assignment in re.split(r", (?=\w+ = )", UpdateExpression[len("SET "):]):
+                name, expression = assignment.split(" = ", 1)
+                item[name] = self._evaluate(item, expression, values)
+            self.items[self._key(Key)] = item
+        return {'Attributes': copy.deepcopy(item)}
+
+    @staticmethod
+    def _condition(item: Dict, expression: Optional[str], values: Dict) -> bool:
+        if expression is None:
+            return True
+        m = re.fullmatch(r"attribute_not_exists\((\w+)\)", expression)
+        if m:
+            return m.group(1) not in item
+        m = re.fullmatch(r"(\w+) = (:\w+)", expression)
+        if m:
+            return item.get(m.group(1)) == values[m.group(2)]
+        raise NotImplementedError(expression)
+
+    @staticmethod
+    def _evaluate(item: Dict, expression: str, values: Dict):
+        m = re.fullmatch(r"list_append\(if_not_exists\((\w+), (:\w+)\), (:\w+)\)", expression)
+        if m:
+            return item.get(m.group(1), values[m.group(2)]) + values[m.group(3)]
+        return values[expression]
+
+
+class FakeSession:
+    """
+    Stands in for the boto3 session of the API, see clients._session.
+    """
+    def __init__(self, bedrock: FakeBedrockRuntime, s3: FakeS3, dynamodb_latency: Latency):
+        self.bedrock = bedrock
+        self.s3 = s3
+        self.dynamodb_latency = dynamodb_latency
+        self.tables: Dict[str, FakeTable] = {}
+
+    def client(self, service_name, config=None, **kwargs):
+        if service_name == 's3':
+            return self.s3
+        return self.bedrock
+
+    def resource(self, service_name, config=None, **kwargs):
+        session = self
+
+        class _DynamoDB:
+            def Table(self, name):
+                return session.tables.setdefault(name, FakeTable(name, session.dynamodb_latency))
+        return _DynamoDB()
+
+
+def install(session: FakeSession) -> None:
+    from api.api_v1.endpoints import clients
+    # cached like the real one, so that clients.reset_after_fork works
+    clients._session = functools.lru_cache(maxsize=None)(lambda: session)
@@ -0,0 +1,440 @@
+"""
+Offline benchmark of the RAG API.
+
+Runs the FastAPI app in process against the local stand-ins of fakes.py, so
+no AWS account is needed, and replays a JSONL file of /rag requests at a
+given concurrency.
+
+Usage:
+    python api/benchmark/run_benchmark.py [requests.jsonl] [--concurrency 16] [--llm-latency-ms 300]
+
+Every input line is a /rag request, as for api/rag_batch.py, optionally with
+"stream": true to call /rag/stream and "tenant" to set the tenant header:
+
+    {"q": "What is Amazon SageMaker?", "user_session_id": "s1", "stream": true}
+
+The requests of a session are sent one after the other, sessions are
+replayed in parallel. Without an input file, sessions of --turns questions
+are generated from the tenant's CSV file.
+
+Before replaying, the tenant's CSV file is ingested into a local bucket with
+the ingestion script's functions and the index is loaded once. The report
+has the p50/p95/p99 latency of every request and of each stage (index load,
+history, condense, speculative and regular retrieval, generation), the
+throughput, and the memory allocated by each stage in a sequential pass
+traced with tracemalloc.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import functools
+import contextvars
+import tracemalloc
+from collections import defaultdict
+from typing import Any, Dict, List
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, os.path.join(REPO_DIR, "api", "app"))
+sys.path.insert(0, os.path.join(REPO_DIR, "data_ingestion_to_vectordb"))
+
+TENANT_ID = "benchmark"
+BUCKET = "contextual-data-benchmark"
+STAGES = ["index_fetch", "index_read", "history_load", "condense", "speculative_retrieval", "retrieval",
+          "generation", "history_save"]
+FOLLOW_UP_QUESTIONS = ["Can you tell me more about it?", "How much does that cost?", "And what about its limits?"]
+
+# stage -> seconds spent in the stage by the current request
+_stage_times: contextvars.ContextVar = contextvars.ContextVar("stage_times")
+# index loads happen outside of requests
+_index_times: Dict[str, List[float]] = defaultdict(list)
+_memory_peaks: Dict[str, List[int]] = defaultdict(list)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the RAG API against local AWS stand-ins")
+    parser.add_argument("input", nargs="?", help="JSONL file of /rag requests, generated when omitted")
+    parser.add_argument("--csv", default=os.path.join(REPO_DIR, "data", "Amazon_SageMaker_FAQs.csv"),
+                        help="CSV file ingested as the tenant's knowledge base")
+    parser.add_argument("--replicate", type=int, default=1,
+                        help="copies of the CSV chunks in the index, to benchmark larger indexes")
+    parser.add_argument("--bm25", action="store_true", help="build the BM25 index for hybrid retrieval")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight")
+    parser.add_argument("--requests", type=int, default=200, help="requests generated without an input file")
+    parser.add_argument("--turns", type=int, default=4, help="questions per generated session")
+    parser.add_argument("--follow-up-rate", type=float, default=0.3,
+                        help="share of generated questions that refer to the previous turn")
+    parser.add_argument("--stream", action="store_true", help="send generated requests to /rag/stream")
+    parser.add_argument("--embed-latency-ms", type=float, default=20, help="mean embedding call latency")
+    parser.add_argument("--llm-latency-ms", type=float, default=300, help="mean LLM time to first token")
+    parser.add_argument("--llm-jitter-ms", type=float, default=100, help="uniform jitter of the LLM latency")
+    parser.add_argument("--tokens-per-second", type=float, default=200, help="LLM generation rate")
+    parser.add_argument("--answer-tokens", type=int, default=40, help="words of filler in every answer")
+    parser.add_argument("--dynamodb-latency-ms", type=float, default=5, help="DynamoDB call latency")
+    parser.add_argument("--memory-requests", type=int, default=20,
+                        help="requests replayed one at a time with tracemalloc, 0 skips the memory pass")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the API's INFO logs")
+    return parser.parse_args()
+
+
+def configure_environment(work_dir: str) -> None:
+    """
+    The API reads its configuration from the environment at import time.
+    """
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("BEDROCK_SERVICE", "bedrock-runtime")
+    os.environ.setdefault("TEXT2TEXT_MODEL_ID", "anthropic.claude-v2")
+    os.environ.setdefault("EMBEDDING_MODEL_ID", "amazon.titan-embed-text-v1")
+    os.environ.setdefault("CHATHISTORY_TABLE", "benchmark-chat-history")
+    os.environ["CONTEXTUAL_DATA_BUCKET"] = BUCKET
+    os.environ["DEFAULT_TENANT_ID"] = TENANT_ID
+    os.environ["VECTORDB_REFRESH_SECONDS"] = "0"
+    os.environ["EMBEDDING_CACHE_DIR"] = os.path.join(work_dir, "embeddings_cache")
+
+
+def timed_stage(stage: str, func):
+    """
+    Wraps an async pipeline function to add its duration to the current
+    request's stage times, and its allocations to the stage's peaks when
+    tracemalloc is tracing.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            times = _stage_times.get(None)
+            if times is not None:
+                times[stage] += time.perf_counter() - start
+                if tracing:
+                    _memory_peaks[stage].append(tracemalloc.get_traced_memory()[1] - before)
+    return wrapper
+
+
+def timed_task(stage: str, func):
+    """
+    Same as timed_stage for a pipeline function run as a separate task next
+    to the request's own stages. The stages it calls are not timed, they
+    would be counted twice and overlap the stage running meanwhile.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        times = _stage_times.get(None)
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        # only unsets the stage times in the task's own context
+        _stage_times.set(None)
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            if times is not None:
+                times[stage] += time.perf_counter() - start
+                if tracing:
+                    _memory_peaks[stage].append(tracemalloc.get_traced_memory()[1] - before)
+    return wrapper
+
+
+def timed_stream(stage: str, func):
+    """
+    Same as timed_stage for async generators, the time to the first item
+    is also recorded as the request's first_token.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        times = _stage_times.get(None)
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            async for item in func(*args, **kwargs):
+                if times is not None and "first_token" not in times:
+                    times["first_token"] = time.perf_counter() - times["start"]
+                yield item
+        finally:
+            if times is not None:
+                times[stage] += time.perf_counter() - start
+            if tracing:
+                _memory_peaks[stage].append(tracemalloc.get_traced_memory()[1] - before)
+    return wrapper
+
+
+def timed_blocking(stage: str, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _index_times[stage].append(time.perf_counter() - start)
+    return wrapper
+
+
+def instrument() -> None:
+    from api.api_v1.endpoints import rag_pipeline, vectordb_registry
+    rag_pipeline.load_history = timed_stage("history_load", rag_pipeline.load_history)
+    rag_pipeline.save_turn = timed_stage("history_save", rag_pipeline.save_turn)
+    rag_pipeline.condense_question = timed_stage("condense", rag_pipeline.condense_question)
+    # the speculative retrieval of the raw question runs while the question is condensed
+    rag_pipeline.embed_and_retrieve = timed_task("speculative_retrieval", rag_pipeline.embed_and_retrieve)
+    rag_pipeline.embed_query = timed_stage("retrieval", rag_pipeline.embed_query)
+    rag_pipeline.retrieve = timed_stage("retrieval", rag_pipeline.retrieve)
+    rag_pipeline.generate_answer = timed_stage("generation", rag_pipeline.generate_answer)
+    rag_pipeline.stream_answer = timed_stream("generation", rag_pipeline.stream_answer)
+    vectordb_registry.fetch_vector_db_files = timed_blocking("index_fetch", vectordb_registry.fetch_vector_db_files)
+    vectordb_registry.read_vector_db_faiss = timed_blocking("index_read", vectordb_registry.read_vector_db_faiss)
+
+
+def build_index(csv_path: str, replicate: int, bm25: bool, s3, work_dir: str) -> int:
+    """
+    Ingests the CSV file into the fake bucket the way the ingestion script
+    does, with the fake embeddings. Returns the number of chunks.
+    """
+    from langchain.schema import Document
+    from api.api_v1.endpoints.clients import BEDROCK_SERVICE
+    from api.api_v1.endpoints.embeddings_cache import get_cached_embeddings
+    import data_ingestion_to_vectordb as ingestion
+    from ann_index import IndexSpec
+
+    chunks = ingestion.load_chunks(csv_path)
+    for copy in range(1, replicate):
+        for doc in list(chunks.values())[:len(chunks) // copy]:
+            replica = Document(page_content=f"(copy {copy}) {doc.page_content}", metadata=doc.metadata)
+            chunks[ingestion.chunk_id(replica)] = replica
+    embeddings = get_cached_embeddings(os.environ["EMBEDDING_MODEL_ID"], BEDROCK_SERVICE)
+    vector_db = ingestion.apply_delta(None, chunks, list(chunks), [], embeddings, batch_size=256)
+
+    local_dir = os.path.join(work_dir, "faiss_index")
+    vector_db.save_local(local_dir)
+    ingestion.save_sqlite_docstore(vector_db, local_dir, bm25)
+    with open(os.path.join(local_dir, ingestion.INDEX_SPEC_FILE), "w") as f:
+        json.dump({**IndexSpec(index_type="flat").to_dict(), "bm25": bm25}, f, sort_keys=True)
+    ingestion.publish_index(s3, BUCKET, local_dir)
+    return len(chunks)
+
+
+def csv_questions(csv_path: str) -> List[str]:
+    import csv
+    with open(csv_path, encoding="utf-8-sig") as f:
+        return [row[0].strip() for row in csv.reader(f) if row and row[0].strip()]
+
+
+def generate_requests(args) -> List[Dict[str, Any]]:
+    rng = random.Random(args.seed)
+    questions = csv_questions(args.csv)
+    reqs = []
+    for n in range(args.requests):
+        turn = n % args.turns
+        q = rng.choice(questions)
+        if turn > 0 and rng.random() < args.follow_up_rate:
+            q = rng.choice(FOLLOW_UP_QUESTIONS)
+        reqs.append({"q": q, "user_session_id": f"benchmark-{n // args.turns}", "stream": args.stream})
+    return reqs
+
+
+def read_requests(path: str) -> List[Dict[str, Any]]:
+    with open(path) as f:
+        reqs = [json.loads(line) for line in f if line.strip()]
+    for n, req in enumerate(reqs):
+        req.setdefault("user_session_id", f"replay-{n}")
+    return reqs
+
+
+def sessions_of(reqs: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    sessions: Dict[str, List[Dict[str, Any]]] = {}
+    for req in reqs:
+        sessions.setdefault(req["user_session_id"], []).append(req)
+    return list(sessions.values())
+
+
+async def send(client, req: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Sends one request and returns its latency and stage times. The ASGI
+    transport buffers streamed responses, so the time to the first token is
+    taken inside the app.
+    """
+    body = {k: v for k, v in req.items() if k not in ("stream", "tenant")}
+    headers = {"X-Auth-Request-Tenantid": req.get("tenant", TENANT_ID)}
+    path = "/api/v1/llm/rag/stream" if req.get("stream") else "/api/v1/llm/rag"
+    start = time.perf_counter()
+    times: Dict[str, float] = defaultdict(float, start=start)
+    _stage_times.set(times)
+    response = await client.post(path, json=body, headers=headers)
+    ok = response.status_code == 200 and '"type": "error"' not in response.text
+    times.pop("start")
+    return {"latency": time.perf_counter() - start, "ok": ok, "stages": dict(times)}
+
+
+async def replay(client, sessions: List[List[Dict[str, Any]]], concurrency: int) -> List[Dict[str, Any]]:
+    queue: asyncio.Queue = asyncio.Queue()
+    for session in sessions:
+        queue.put_nowait(session)
+    results = []
+
+    async def worker():
+        while not queue.empty():
+            for req in queue.get_nowait():
+                results.append(await send(client, req))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    import numpy as np
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"count": len(values), "mean": float(np.mean(values)),
+            "p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+def max_rss_mb() -> float:
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+    except OSError:
+        return max_rss_mb()
+
+
+def summarize(results: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    stages = {s: percentiles(_index_times[s]) for s in ("index_fetch", "index_read")}
+    stages.update({s: percentiles([r["stages"][s] for r in results if s in r["stages"]])
+                   for s in STAGES if not s.startswith("index_")})
+    return {
+        "requests": len(results),
+        "errors": sum(not r["ok"] for r in results),
+        "elapsed_seconds": elapsed,
+        "throughput_rps": len(results) / elapsed if elapsed else 0.0,
+        "latency": percentiles([r["latency"] for r in results]),
+        "first_token": percentiles([r["stages"]["first_token"] for r in results if "first_token" in r["stages"]]),
+        "stages": {s: v for s, v in stages.items() if v},
+    }
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    lines = [f"{report['requests']} requests, {report['errors']} errors, concurrency={report['concurrency']}, "
+             f"{report['elapsed_seconds']:.2f}s, {report['throughput_rps']:.1f} requests/s",
+             f"index: {report['chunks']} chunks, loaded in {report['index_load_seconds']:.3f}s, "
+             f"RSS +{report['index_rss_mb']:.1f} MB, max RSS {report['max_rss_mb']:.0f} MB",
+             f"bedrock calls: {report['bedrock_calls']}, answer cache: {json.dumps(report['answer_cache'])}",
+             "",
+             f"{'stage':<22}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak alloc KB':>15}"]
+    rows = [("request", report["latency"])]
+    if report["first_token"]:
+        rows.append(("first_token", report["first_token"]))
+    rows += list(report["stages"].items())
+    for name, p in rows:
+        memory = report["memory"].get(name)
+        lines.append(f"{name:<22}{p['count']:>7}{p['p50'] * 1000:>10.1f}{p['p95'] * 1000:>10.1f}"
+                     f"{p['p99'] * 1000:>10.1f}{memory['peak_kb_max'] if memory else '':>15}")
+    return "\n".join(lines)
+
+
+async def run(args, fake_session) -> Dict[str, Any]:
+    import httpx
+    from main import app
+    from api.api_v1.endpoints.answer_cache import answer_cache
+    from api.api_v1.endpoints.vectordb_registry import registry
+
+    reqs = read_requests(args.input) if args.input else generate_requests(args)
+    rss_before, start = rss_mb(), time.perf_counter()
+    await registry.get_entry(TENANT_ID)
+    index_load, index_rss = time.perf_counter() - start, rss_mb() - rss_before
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        start = time.perf_counter()
+        results = await replay(client, sessions_of(reqs), args.concurrency)
+        report = summarize(results, time.perf_counter() - start)
+        report["answer_cache"] = answer_cache.stats()
+
+        memory = {}
+        if args.memory_requests:
+            # answered again rather than served from the answer cache
+            answer_cache.invalidate(TENANT_ID)
+            # one request at a time so that the stages do not overlap, only the
+            # speculative retrieval still overlaps the condense call
+            tracemalloc.start()
+            memory_reqs = [{**r, "user_session_id": f"memory-{r['user_session_id']}"}
+                           for r in reqs[:args.memory_requests]]
+            await replay(client, sessions_of(memory_reqs), 1)
+            tracemalloc.stop()
+            memory = {s: {"peak_kb_mean": int(sum(p) / len(p) / 1024), "peak_kb_max": int(max(p) / 1024)}
+                      for s, p in _memory_peaks.items()}
+
+    report.update({"concurrency": args.concurrency,
+                   "index_load_seconds": index_load,
+                   "index_rss_mb": index_rss,
+                   "max_rss_mb": max_rss_mb(),
+                   "memory": memory,
+                   "bedrock_calls": dict(fake_session.bedrock.calls)})
+    return report
+
+
+def main():
+    args = parse_args()
+    for name in ("input", "csv", "json"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    random.seed(args.seed)
+    work_dir = tempfile.mkdtemp(prefix="rag-benchmark-")
+    configure_environment(work_dir)
+    # the ingestion script creates its data directory relative to the cwd
+    os.chdir(work_dir)
+
+    import logging
+    import fakes
+    session = fakes.FakeSession(
+        bedrock=fakes.FakeBedrockRuntime(embed_latency=fakes.Latency(args.embed_latency_ms),
+                                         llm_latency=fakes.Latency(args.llm_latency_ms, args.llm_jitter_ms),
+                                         tokens_per_second=args.tokens_per_second,
+                                         answer_tokens=args.answer_tokens),
+        s3=fakes.FakeS3(os.path.join(work_dir, "s3")),
+        dynamodb_latency=fakes.Latency(args.dynamodb_latency_ms))
+    fakes.install(session)
+    from api.api_v1.endpoints import vectordb_registry
+    vectordb_registry.VECTOR_DB_DIR = os.path.join(work_dir, "vectordb")
+    if not args.verbose:
+        # the API sets INFO on the root logger when it is imported
+        from main import app  # noqa: F401
+        logging.getLogger().setLevel(logging.WARNING)
+    instrument()
+
+    # the embedding latency is a property of the queries, not of ingestion
+    embed_latency, session.bedrock.embed_latency = session.bedrock.embed_latency, fakes.Latency()
+    chunks = build_index(args.csv, args.replicate, args.bm25, session.s3, work_dir)
+    session.bedrock.embed_latency = embed_latency
+
+    report = asyncio.run(run(args, session))
+    report["chunks"] = chunks
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
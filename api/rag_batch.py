@@ -0,0 +1,73 @@
+"""
+Sends a JSONL file of questions to the /rag/batch endpoint and writes the
+answers as JSONL.
+
+Usage:
+    python api/rag_batch.py questions.jsonl answers.jsonl --tenant tenanta [--url http://127.0.0.1:8000]
+
+Every input line is a /rag request, only "q" is required:
+
+    {"q": "What is Amazon SageMaker?", "max_matching_docs": 3}
+
+Every output line has the "index" of its input line, the "question" and
+either the "answer" or an "error". Large files are sent in chunks of
+--chunk-size lines, one batch request per chunk.
+"""
+import json
+import time
+import argparse
+import urllib.request
+from typing import Iterator, List
+
+
+def read_chunks(path: str, chunk_size: int) -> Iterator[List[str]]:
+    chunk = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                chunk.append(line.strip())
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def post_batch(url: str, tenant: str, lines: List[str], concurrency: int, timeout: int) -> Iterator[dict]:
+    request = urllib.request.Request(f"{url}/api/v1/llm/rag/batch?concurrency={concurrency}",
+                                     data="\n".join(lines).encode("utf-8"),
+                                     headers={"Content-Type": "application/x-ndjson",
+                                              "X-Auth-Request-Tenantid": tenant},
+                                     method="POST")
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        for line in response:
+            if line.strip():
+                yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions with the /rag/batch endpoint")
+    parser.add_argument("input", help="JSONL file, one /rag request per line")
+    parser.add_argument("output", help="JSONL file the answers are written to")
+    parser.add_argument("--tenant", required=True, help="tenant whose knowledge base answers the questions")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="base URL of the RAG API")
+    parser.add_argument("--concurrency", type=int, default=16, help="answers generated in parallel")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="questions sent per batch request")
+    parser.add_argument("--timeout", type=int, default=3600, help="seconds to wait for a batch")
+    args = parser.parse_args()
+
+    start = time.time()
+    done, failed, offset = 0, 0, 0
+    with open(args.output, "w") as out:
+        for lines in read_chunks(args.input, args.chunk_size):
+            for result in post_batch(args.url, args.tenant, lines, args.concurrency, args.timeout):
+                result["index"] += offset
+                failed += "error" in result
+                done += 1
+                out.write(json.dumps(result) + "\n")
+            offset += len(lines)
+            print(f"answered {done} questions, {failed} failed, {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -41,6 +41,65 @@ class Sessions:
             self.table = table
         return exists
 
+    def use_table(self, table_name):
+        """
+        Stores the table in a member variable without checking that it exists,
+        which saves the DescribeTable round trip of exists().
+
+        :param table_name: The name of the table.
+        """
+        self.table = self.dyn_resource.Table(table_name)
+
+    def upsert_session(self, tenant_id, new_interaction, idle_time):
+        """
+        Returns the session_id of the current session of a tenant/user and
+        records the interaction. The session is kept when its last interaction
+        is less than idle_time seconds old, otherwise (or when there is none)
+        a new session_id is stored. Keeping the session, the common case, is
+        a single conditional UpdateItem.
+
+        :param tenant_id: The Tenant ID
+        :param new_interaction: The time of the interaction.
+        :param idle_time: Seconds after which a new session is started.
+        :return: The session_id of the current session.
+        """
+        try:
+            response = self.table.update_item(
+                Key={'TenantId': tenant_id},
+                UpdateExpression="set last_interaction=:new_interaction",
+                ConditionExpression="attribute_exists(session_id) and last_interaction > :cutoff",
+                ExpressionAttributeValues={':new_interaction': new_interaction,
+                                           ':cutoff': new_interaction - idle_time},
+                ReturnValues="ALL_NEW")
+            return response['Attributes']['session_id']
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                logger.error(
+                    "Couldn't update session %s in table %s. Here's why: %s: %s",
+                    tenant_id, self.table.name,
+                    err.response['Error']['Code'], err.response['Error']['Message'])
+                raise
+
+        session_id = str(uuid.uuid4())
+        try:
+            # the condition stops concurrent reruns from each starting a session
+            self.table.update_item(
+                Key={'TenantId': tenant_id},
+                UpdateExpression="set session_id=:session_id, last_interaction=:new_interaction",
+                ConditionExpression="attribute_not_exists(session_id) or last_interaction <= :cutoff",
+                ExpressionAttributeValues={':session_id': session_id,
+                                           ':new_interaction': new_interaction,
+                                           ':cutoff': new_interaction - idle_time})
+        except ClientError as err:
+            if err.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return self.get_session(tenant_id)['session_id']
+            logger.error(
+                "Couldn't start session %s in table %s. Here's why: %s: %s",
+                tenant_id, self.table.name,
+                err.response['Error']['Code'], err.response['Error']['Message'])
+            raise
+        return session_id
+
     def get_session(self, tenant_id):
         """
         Gets session data from the table for a specific session.
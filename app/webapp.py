@@ -19,15 +19,13 @@ from sessions import Sessions
 
 table_name = os.getenv('SESSIONS_TABLE')
 
-# Create DynamoDB client
-dynamodb = boto3.resource("dynamodb")
-
 # global constants
 STREAMLIT_SESSION_VARS: List[Tuple] = [("generated", []), ("past", []), ("input", ""), ("stored_session", [])]
 HTTP_OK: int = 200
 
 MODE_RAG: str = 'RAG'
-MODE_VALUES: List[str] = [MODE_RAG]
+MODE_RAG_STREAMING: str = 'RAG (streaming)'
+MODE_VALUES: List[str] = [MODE_RAG_STREAMING, MODE_RAG]
 
 TEXT2TEXT_MODEL_LIST: List[str] = ["anthropic.claude-instant-v1"]
 EMBEDDINGS_MODEL_LIST: List[str] = ["amazon.titan-embed-text-v1"]
@@ -35,7 +33,8 @@ EMBEDDINGS_MODEL_LIST: List[str] = ["amazon.titan-embed-text-v1"]
 # API endpoint
 api: str = "http://127.0.0.1:8000"
 api_rag_ep: str = f"{api}/api/v1/llm/rag"
-print(f"api_rag_ep={api_rag_ep}")
+api_rag_stream_ep: str = f"{api}/api/v1/llm/rag/stream"
+print(f"api_rag_ep={api_rag_ep}, api_rag_stream_ep={api_rag_stream_ep}")
 
 ####################
 # Streamlit code
@@ -46,8 +45,8 @@ tenantid = headers.get("X-Auth-Request-Tenantid")
 user_email = headers.get("X-Auth-Request-Email")
 
 tenant_id = tenantid + ":" + user_email
-dyn_resource = boto3.resource('dynamodb')
 IDLE_TIME = 600                                     # seconds
+SESSION_CACHE_TIME = 60                             # seconds
 current_time = int(datetime.now().timestamp())
 
 # Page title
@@ -70,6 +69,61 @@ def get_user_input() -> str:
     return input_text
 
 
+def stream_rag_answer(data: Dict, headers: Dict) -> str:
+    """
+    Calls the streaming RAG endpoint and renders the answer as the tokens
+    arrive. Returns the final text to keep in the conversation history.
+    """
+    placeholder = st.empty()
+    answer: str = ""
+    sources: List[str] = []
+    with req.post(api_rag_stream_ep, headers=headers, json=data, stream=True) as resp:
+        if resp.status_code != HTTP_OK:
+            return resp.text
+        for line in resp.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if event['type'] == 'sources':
+                sources = list(set([d['metadata']['source'] for d in event['docs']]))
+                placeholder.info(f"Sources: {sources}", icon="📚")
+            elif event['type'] == 'token':
+                answer += event['text']
+                placeholder.success(f"{answer}▌", icon="👩‍💻")
+            elif event['type'] == 'done':
+                answer = event['answer']
+            elif event['type'] == 'error':
+                answer = f"{answer}\n\nError: {event['detail']}"
+    # the answer is rendered in the conversation below once complete
+    placeholder.empty()
+    return f"{answer} \n \n Sources: {sources}"
+
+
+@st.cache_resource
+def get_sessions() -> Sessions:
+    """
+    The sessions table handle is created once and shared by all reruns.
+    """
+    sessions = Sessions(boto3.resource('dynamodb'))
+    sessions.use_table(table_name)
+    return sessions
+
+
+def get_session_id() -> str:
+    """
+    Returns the session_id of the current session. The session is only
+    refreshed in DynamoDB when it was last refreshed more than
+    SESSION_CACHE_TIME seconds ago, which is well below IDLE_TIME.
+    """
+    cached = st.session_state.get("session_cache")
+    if cached and cached["tenant_id"] == tenant_id and current_time - cached["refreshed"] < SESSION_CACHE_TIME:
+        return cached["session_id"]
+    session_id = get_sessions().upsert_session(tenant_id, current_time, IDLE_TIME)
+    st.session_state["session_cache"] = {"tenant_id": tenant_id, "session_id": session_id,
+                                         "refreshed": current_time}
+    return session_id
+
+
 # sidebar with options
 with st.sidebar.expander("⚙️", expanded=True):
     text2text_model = st.selectbox(label='Text2Text Model', options=TEXT2TEXT_MODEL_LIST)
@@ -89,31 +143,19 @@ user_input: str = get_user_input()
 # based on the selected mode type call the appropriate API endpoint
 if user_input:
     try:
-        sessions = Sessions(dyn_resource)
-        sessions_exists = sessions.exists(table_name)
-        if sessions_exists:
-            session = sessions.get_session(tenant_id)
-            if session:
-                if ((current_time - session['last_interaction']) < IDLE_TIME):
-                    sessions.update_session_last_interaction(tenant_id, current_time)
-                    updated_session = sessions.get_session(tenant_id)
-                    print(updated_session['session_id'])
-                else:
-                    sessions.update_session(tenant_id, current_time)
-                    updated_session = sessions.get_session(tenant_id)
-            else:
-                sessions.add_session(tenant_id)
-                session = sessions.get_session(tenant_id)
+        session_id = get_session_id()
+        print(session_id)
     except Exception as e:
         print(f"Something went wrong: {e}")
 
     # headers for request and response encoding, same for both endpoints
     headers: Dict = {"accept": "application/json",
-                     "Content-Type": "application/json"
+                     "Content-Type": "application/json",
+                     "X-Auth-Request-Tenantid": tenantid
                     }
     output: str = None
     if mode == MODE_RAG:
-        user_session_id = tenant_id + ":" + session["session_id"]
+        user_session_id = tenant_id + ":" + session_id
         data = {"q": user_input, "user_session_id": user_session_id, "verbose": True}
         resp = req.post(api_rag_ep, headers=headers, json=data)
         if resp.status_code != HTTP_OK:
@@ -122,6 +164,10 @@ if user_input:
             resp = resp.json()
             sources = list(set([d['metadata']['source'] for d in resp['docs']]))
             output = f"{resp['answer']} \n \n Sources: {sources}"
+    elif mode == MODE_RAG_STREAMING:
+        user_session_id = tenant_id + ":" + session_id
+        data = {"q": user_input, "user_session_id": user_session_id}
+        output = stream_rag_answer(data, headers)
     else:
         print("error")
         output = f"unhandled mode value={mode}"
@@ -0,0 +1,160 @@
+"""
+Approximate nearest neighbour index types for the tenant indexes.
+
+The default flat index is exact, but its search cost and memory grow
+linearly with the number of chunks. For large tenants the index can instead
+be built as IVF, HNSW, product quantized (PQ, IVF+PQ) or int8 scalar
+quantized (SQ8), trained on the tenant's own embeddings. Search time
+parameters (nprobe, efSearch) are stored in the index file so the API uses
+them as is.
+"""
+import math
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+import faiss
+import numpy as np
+
+INDEX_TYPES = ["flat", "ivf", "hnsw", "pq", "ivfpq", "sq8"]
+# k-means wants about this many training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+
+
+@dataclass
+class IndexSpec:
+    index_type: str = "flat"
+    nlist: Optional[int] = None  # IVF lists, 4 * sqrt(n) when not set
+    nprobe: int = 8
+    hnsw_m: int = 32
+    ef_construction: int = 200
+    ef_search: int = 64
+    pq_m: Optional[int] = None  # PQ sub-quantizers, dim / 24 rounded to a divisor when not set
+    pq_bits: int = 8
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+def _nlist(spec: IndexSpec, n: int) -> int:
+    if spec.nlist:
+        return spec.nlist
+    return max(1, min(int(4 * math.sqrt(n)), n // MIN_POINTS_PER_CENTROID))
+
+
+def _pq_m(spec: IndexSpec, dim: int) -> int:
+    if spec.pq_m:
+        if dim % spec.pq_m:
+            raise ValueError(f"pq_m={spec.pq_m} does not divide the embedding dimension {dim}")
+        return spec.pq_m
+    m = max(1, dim // 24)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def factory_string(spec: IndexSpec, n: int, dim: int) -> str:
+    if spec.index_type == "flat":
+        return "Flat"
+    if spec.index_type == "ivf":
+        return f"IVF{_nlist(spec, n)},Flat"
+    if spec.index_type == "hnsw":
+        return f"HNSW{spec.hnsw_m}"
+    if spec.index_type == "pq":
+        return f"PQ{_pq_m(spec, dim)}x{spec.pq_bits}"
+    if spec.index_type == "ivfpq":
+        return f"IVF{_nlist(spec, n)},PQ{_pq_m(spec, dim)}x{spec.pq_bits}"
+    if spec.index_type == "sq8":
+        return "SQ8"
+    raise ValueError(f"unknown index type {spec.index_type}, expected one of {INDEX_TYPES}")
+
+
+def min_training_points(spec: IndexSpec, n: int) -> int:
+    points = 0
+    if spec.index_type in ("ivf", "ivfpq"):
+        points = _nlist(spec, n)
+    if spec.index_type in ("pq", "ivfpq"):
+        points = max(points, 2 ** spec.pq_bits)
+    return points
+
+
+def build_index(vectors: np.ndarray, spec: IndexSpec) -> faiss.Index:
+    """
+    Builds and trains an index of the given type over the vectors. Corpora
+    too small to train the requested type get a flat index.
+    """
+    n, dim = vectors.shape
+    if n < min_training_points(spec, n):
+        print(f"index:{n} vectors are too few to train {spec.index_type}, using a flat index")
+        spec = IndexSpec()
+    index = faiss.index_factory(dim, factory_string(spec, n, dim))
+    if spec.index_type == "hnsw":
+        index.hnsw.efConstruction = spec.ef_construction
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    set_search_params(index, spec)
+    return index
+
+
+def set_search_params(index: faiss.Index, spec: IndexSpec) -> None:
+    params = faiss.ParameterSpace()
+    if hasattr(faiss.try_extract_index_ivf(index), "nprobe"):
+        params.set_index_parameter(index, "nprobe", spec.nprobe)
+    if hasattr(index, "hnsw"):
+        params.set_index_parameter(index, "efSearch", spec.ef_search)
+
+
+def describe(index: faiss.Index) -> str:
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return f"{type(index).__name__}(nlist={ivf.nlist}, nprobe={ivf.nprobe})"
+    if hasattr(index, "hnsw"):
+        return f"{type(index).__name__}(efSearch={index.hnsw.efSearch})"
+    return type(index).__name__
+
+
+def _measure(index: faiss.Index, queries: np.ndarray, k: int):
+    start = time.perf_counter()
+    _, ids = index.search(queries, k)
+    return ids, (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def recall_report(vectors: np.ndarray, specs: List[IndexSpec], k: int = 4,
+                  n_queries: int = 200, seed: int = 0) -> List[Dict]:
+    """
+    Recall@k and per query latency of each index type against the exact flat
+    index. The queries are corpus vectors with a little noise added, which is
+    close enough to real questions for comparing the index types.
+    """
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)]
+    noise = rng.normal(scale=0.01 * float(np.std(vectors)), size=sample.shape)
+    queries = (sample + noise).astype(np.float32)
+
+    flat = faiss.IndexFlatL2(vectors.shape[1])
+    flat.add(vectors)
+    truth, flat_ms = _measure(flat, queries, k)
+    rows = [{"index_type": "flat", "index": describe(flat), "recall": 1.0,
+             "latency_ms": flat_ms, "size_bytes": faiss.serialize_index(flat).nbytes}]
+
+    for spec in specs:
+        if spec.index_type == "flat":
+            continue
+        start = time.perf_counter()
+        index = build_index(vectors, spec)
+        build_seconds = time.perf_counter() - start
+        ids, ms = _measure(index, queries, k)
+        hits = sum(len(set(found) & set(expected)) for found, expected in zip(ids, truth))
+        rows.append({"index_type": spec.index_type, "index": describe(index),
+                     "recall": hits / truth.size, "latency_ms": ms,
+                     "size_bytes": faiss.serialize_index(index).nbytes,
+                     "build_seconds": build_seconds})
+    return rows
+
+
+def format_report(rows: List[Dict]) -> str:
+    lines = [f"{'type':<8}{'index':<48}{'recall':>8}{'ms/query':>10}{'size':>12}"]
+    for r in rows:
+        lines.append(f"{r['index_type']:<8}{r['index']:<48}{r['recall']:>8.3f}"
+                     f"{r['latency_ms']:>10.3f}{r['size_bytes']:>12}")
+    return "\n".join(lines)
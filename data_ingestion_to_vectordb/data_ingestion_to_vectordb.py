@@ -1,62 +1,711 @@
+"""
+Builds the FAISS index of every tenant and uploads it to the tenant's
+contextual data bucket.
+
+Usage:
+    python data_ingestion_to_vectordb/data_ingestion_to_vectordb.py [--manifest manifest.json]
+
+The manifest maps each tenant to its CSV source and optionally its bucket:
+
+    {
+        "tenanta": "data/Amazon_SageMaker_FAQs.csv",
+        "tenantb": {"source": "data/Amazon_EMR_FAQs.csv", "bucket": "contextual-data-tenantb-abcd"}
+    }
+
+Without a manifest the two sample tenants are ingested. Ingestion is
+incremental: every chunk is identified by a hash of its content, so only
+chunks that were added or changed since the previous index are embedded and
+added, and removed chunks are deleted from the existing index.
+
+--index-type builds an approximate index (ivf, hnsw, pq, ivfpq or sq8)
+trained on the tenant's embeddings instead of the exact flat one, and
+--recall-report prints the recall and latency of every index type against
+the flat index. Approximate indexes are rebuilt whenever the chunks change,
+the embeddings of unchanged chunks come from the embedding cache.
+
+--bm25 adds a BM25 full text index of the chunks to the SQLite docstore, the
+API then fuses lexical and vector search results.
+
+--streaming ingests sources that do not fit in memory into a flat index: the
+CSV rows are read lazily and split, embedded and added to the index in
+batches of --rows-per-batch rows. Only the vectors of the index are kept in
+memory: the documents of each batch go straight into the SQLite docstore,
+keyed by their FAISS position, and the ids of the chunks seen in the source
+into a second SQLite file, both in a checkpoint directory next to the local
+index. Every --checkpoint-rows rows index.faiss and the number of rows read
+are saved there too, a run that failed resumes after its last checkpoint.
+Streaming runs publish no index.pkl, the API reads the SQLite docstore.
+"""
 import os
+import csv
+import json
+import time
+import shutil
+import hashlib
+import sqlite3
+import argparse
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Optional, Tuple
+import faiss
+import numpy as np
 import boto3
 import botocore
+from botocore.config import Config
 
-from langchain.document_loaders import CSVLoader
+from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.text_splitter import CharacterTextSplitter
-from langchain.indexes.vectorstore import VectorStoreIndexWrapper
 from langchain.embeddings import BedrockEmbeddings
-from langchain.llms.bedrock import Bedrock
+from langchain.schema import Document
 from langchain.vectorstores import FAISS
+from embeddings_cache import CachedEmbeddings
+from ann_index import INDEX_TYPES, IndexSpec, build_index, describe, format_report, recall_report
 
 LOCAL_RAG_DIR="data"
 FAISS_INDEX_DIR = "faiss_index"
+VECTORDB_FILES = ["index.faiss", "index.pkl"]
+# the API reads documents lazily from this file instead of unpickling index.pkl,
+# index.pkl is still published for older API versions and incremental runs
+DOCSTORE_FILE = "docstore.sqlite"
+# type and build parameters of the index, the API does not need it
+INDEX_SPEC_FILE = "index.json"
+PUBLISHED_FILES = VECTORDB_FILES + [DOCSTORE_FILE, INDEX_SPEC_FILE]
+MANIFEST_FILE = "manifest.json"
+# index of a streaming ingestion in progress, in a directory next to the
+# local index
+CHECKPOINT_SUFFIX = ".checkpoint"
+CHECKPOINT_FILE = "checkpoint.json"
+# ids of the chunks read from the source so far, in the checkpoint directory
+SEEN_FILE = "seen.sqlite"
+STREAMING_PUBLISHED_FILES = ["index.faiss", DOCSTORE_FILE, INDEX_SPEC_FILE]
 if not os.path.exists(LOCAL_RAG_DIR):
    os.makedirs(LOCAL_RAG_DIR)
 
 embeddings_model = os.environ.get('EMBEDDING_MODEL_ID')
 bedrock_service = os.environ.get('BEDROCK_SERVICE')
-boto3_bedrock = boto3.client(service_name=bedrock_service)
-br_embeddings = BedrockEmbeddings(client=boto3_bedrock, model_id=embeddings_model)
+# chunks that were already embedded in a previous run are read from the cache
+EMBEDDING_CACHE_DIR = os.environ.get('EMBEDDING_CACHE_DIR', "embeddings_cache")
+
+TENANTS = {
+    "tenanta": f"./{LOCAL_RAG_DIR}/Amazon_SageMaker_FAQs.csv",
+    "tenantb": f"./{LOCAL_RAG_DIR}/Amazon_EMR_FAQs.csv",
+}
+
+
+def chunk_id(doc: Document) -> str:
+    """
+    Identifies a chunk by its content and source file. The row number is left
+    out so inserting a row in the CSV does not change the id of every chunk
+    after it.
+    """
+    key = json.dumps({"source": doc.metadata.get("source"), "text": doc.page_content}, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def read_csv_documents(datafile: str) -> Iterator[Document]:
+    """
+    Yields one document per CSV row, like langchain's CSVLoader but without
+    reading the whole file into memory.
+    """
+    with open(datafile, newline="") as csvfile:
+        for i, row in enumerate(csv.DictReader(csvfile)):
+            content = "\n".join(f"{k.strip()}: {v.strip()}" for k, v in row.items())
+            yield Document(page_content=content, metadata={"source": datafile, "row": i})
+
 
-TENANTS=["tenanta", "tenantb"]
+def split_documents(docs: List[Document]) -> List[Document]:
+    return CharacterTextSplitter(chunk_size=2000, chunk_overlap=400, separator=",").split_documents(docs)
 
-for t in TENANTS:
-    if t == "tenanta":
-        DATAFILE="Amazon_SageMaker_FAQs.csv"
-    elif t == "tenantb":
-        DATAFILE="Amazon_EMR_FAQs.csv"
 
-    loader = CSVLoader(f"./{LOCAL_RAG_DIR}/{DATAFILE}")
-    documents_aws = loader.load()
+def load_chunks(datafile: str) -> Dict[str, Document]:
+    documents_aws = list(read_csv_documents(datafile))
     print(f"documents:loaded:size={len(documents_aws)}")
-    
-    docs = CharacterTextSplitter(chunk_size=2000, chunk_overlap=400, separator=",").split_documents(documents_aws)
-    
+
+    docs = split_documents(documents_aws)
     print(f"Documents:after split and chunking size={len(docs)}")
-    
-    vector_db = FAISS.from_documents(
-        documents=docs,
-        embedding=br_embeddings, 
-    )
+
+    # identical chunks collapse into one
+    chunks = {}
+    for d in docs:
+        chunks.setdefault(chunk_id(d), d)
+    return chunks
+
+
+def sha256_file(fpath: str) -> str:
+    digest = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest_from_s3(s3, bucket: str) -> Optional[Dict]:
+    try:
+        body = s3.Object(bucket, f"{FAISS_INDEX_DIR}/{MANIFEST_FILE}").get()['Body'].read()
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey", "403"):
+            return None
+        raise
+    return json.loads(body)
+
+
+def download_existing_index(s3, bucket: str, local_dir: str, files: List[str] = PUBLISHED_FILES) -> bool:
+    os.makedirs(local_dir, exist_ok=True)
+    manifest = read_manifest_from_s3(s3, bucket)
+    vdb_files = [f for f in files if f in manifest['files']] if manifest else VECTORDB_FILES
+    try:
+        for vdb_file in vdb_files:
+            key = manifest['files'][vdb_file]['key'] if manifest else f"{FAISS_INDEX_DIR}/{vdb_file}"
+            s3.Bucket(bucket).download_file(key, os.path.join(local_dir, vdb_file))
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey", "403"):
+            return False
+        raise
+    return True
+
+
+def create_docs_table(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE TABLE IF NOT EXISTS docs (position INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, "
+                 "page_content TEXT NOT NULL, metadata TEXT NOT NULL)")
+
+
+def doc_row(position: int, doc_id: str, doc: Document) -> Tuple[int, str, str, str]:
+    return position, doc_id, doc.page_content, json.dumps(doc.metadata, sort_keys=True)
+
+
+def add_bm25_index(conn: sqlite3.Connection) -> None:
+    """
+    Adds an FTS5 index over the text of the docs table, its rowids are the
+    FAISS positions.
+    """
+    # external content table, the text is stored once in docs
+    conn.execute("DROP TABLE IF EXISTS docs_fts")
+    conn.execute("CREATE VIRTUAL TABLE docs_fts USING fts5(page_content, content='docs', "
+                 "content_rowid='position')")
+    conn.execute("INSERT INTO docs_fts(docs_fts) VALUES ('rebuild')")
+
+
+def save_sqlite_docstore(vector_db: FAISS, local_dir: str, bm25: bool = False) -> None:
+    """
+    Writes the documents of the index to a SQLite file with one row per FAISS
+    position, so a reader can fetch the documents of a search result without
+    loading the others. With bm25 a BM25 index is added, see add_bm25_index.
+    """
+    fpath = os.path.join(local_dir, DOCSTORE_FILE)
+    tmp_path = f"{fpath}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        create_docs_table(conn)
+        conn.executemany("INSERT INTO docs VALUES (?, ?, ?, ?)",
+                         (doc_row(position, doc_id, vector_db.docstore.search(doc_id))
+                          for position, doc_id in sorted(vector_db.index_to_docstore_id.items())))
+        if bm25:
+            add_bm25_index(conn)
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, fpath)
+
+
+def read_sqlite_docstore(local_dir: str) -> Tuple[InMemoryDocstore, Dict[int, str]]:
+    """
+    The docstore and FAISS position -> id mapping of a SQLite docstore, for
+    indexes published without index.pkl by a streaming run.
+    """
+    conn = sqlite3.connect(os.path.join(local_dir, DOCSTORE_FILE))
+    try:
+        docs, index_to_docstore_id = {}, {}
+        for position, doc_id, page_content, metadata in conn.execute(
+                "SELECT position, id, page_content, metadata FROM docs ORDER BY position"):
+            docs[doc_id] = Document(page_content=page_content, metadata=json.loads(metadata))
+            index_to_docstore_id[position] = doc_id
+    finally:
+        conn.close()
+    return InMemoryDocstore(docs), index_to_docstore_id
+
+
+def publish_index(s3, bucket: str, local_dir: str, published_files: List[str] = PUBLISHED_FILES) -> str:
+    """
+    Uploads the index as an immutable version and then points the manifest
+    at it. The API polls the manifest and swaps in new versions, the manifest
+    is written last so it never references a partially uploaded version.
+    """
+    files = {f: {"sha256": sha256_file(os.path.join(local_dir, f)),
+                 "size": os.path.getsize(os.path.join(local_dir, f))} for f in published_files}
+    version = hashlib.sha256(json.dumps(files, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    for f in published_files:
+        files[f]["key"] = f"{FAISS_INDEX_DIR}/versions/{version}/{f}"
+        s3.Bucket(bucket).upload_file(os.path.join(local_dir, f), files[f]["key"])
+    manifest = {"version": version, "created_at": int(time.time()), "files": files}
+    s3.Object(bucket, f"{FAISS_INDEX_DIR}/{MANIFEST_FILE}").put(Body=json.dumps(manifest, indent=2).encode("utf-8"),
+                                                                ContentType="application/json")
+    return version
+
+
+def load_existing_index(s3, bucket: str, local_dir: str, embeddings) -> Optional[FAISS]:
+    """
+    Returns the index built by the previous run, from the local directory or
+    else from S3, or None when there is no index built with chunk ids.
+    """
+    have_local = os.path.exists(os.path.join(local_dir, "index.faiss")) and any(
+        os.path.exists(os.path.join(local_dir, f)) for f in ("index.pkl", DOCSTORE_FILE))
+    if not have_local and not download_existing_index(s3, bucket, local_dir):
+        return None
+    if os.path.exists(os.path.join(local_dir, "index.pkl")):
+        vector_db = FAISS.load_local(local_dir, embeddings)
+    else:
+        # published by a streaming run
+        docstore, index_to_docstore_id = read_sqlite_docstore(local_dir)
+        vector_db = FAISS(embeddings.embed_query, faiss.read_index(os.path.join(local_dir, "index.faiss")),
+                          docstore, index_to_docstore_id)
+    # indexes built before incremental ingestion use random uuids as ids
+    ids = vector_db.index_to_docstore_id.values()
+    if not all(len(i) == 64 for i in ids):
+        print(f"existing index in {local_dir} has no chunk ids, rebuilding it")
+        return None
+    return vector_db
+
+
+def embed_in_batches(embeddings: CachedEmbeddings, docs: List[Document], batch_size: int) -> List[List[float]]:
+    vectors = []
+    for i in range(0, len(docs), batch_size):
+        vectors.extend(embeddings.embed_documents([d.page_content for d in docs[i:i + batch_size]]))
+        print(f"embeddings:{min(i + batch_size, len(docs))}/{len(docs)}")
+    return vectors
+
+
+def index_up_to_date(local_dir: str, spec: IndexSpec, bm25: bool) -> bool:
+    """
+    Whether the local index has a SQLite docstore and was built with spec
+    and the bm25 option. Indexes published before index.json existed are
+    flat without BM25.
+    """
+    if not os.path.exists(os.path.join(local_dir, DOCSTORE_FILE)):
+        return False
+    saved = {"index_type": "flat"}
+    if os.path.exists(os.path.join(local_dir, INDEX_SPEC_FILE)):
+        with open(os.path.join(local_dir, INDEX_SPEC_FILE)) as f:
+            saved = json.load(f)
+    if saved.pop("bm25", False) != bm25:
+        return False
+    if spec.index_type == "flat":
+        return saved["index_type"] == "flat"
+    return saved == spec.to_dict()
+
+
+def apply_delta(vector_db: Optional[FAISS], chunks: Dict[str, Document], added: List[str], removed: List[str],
+                embeddings: CachedEmbeddings, batch_size: int) -> FAISS:
+    docs = [chunks[i] for i in added]
+    vectors = embed_in_batches(embeddings, docs, batch_size)
+    text_embeddings = list(zip([d.page_content for d in docs], vectors))
+    metadatas = [d.metadata for d in docs]
+    if vector_db is None:
+        return FAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas, ids=added)
+    if removed:
+        remove_chunks(vector_db, removed)
+    if added:
+        vector_db.add_embeddings(text_embeddings, metadatas=metadatas, ids=added)
+    return vector_db
+
+
+def remove_chunks(vector_db: FAISS, removed: List[str]) -> None:
+    """
+    Same as FAISS.delete, which scans the whole mapping for every removed
+    position, with a single id -> position map.
+    """
+    positions = {doc_id: position for position, doc_id in vector_db.index_to_docstore_id.items()}
+    removed_positions = {positions[i] for i in removed}
+    vector_db.index.remove_ids(np.asarray(sorted(removed_positions), dtype=np.int64))
+    vector_db.docstore.delete(removed)
+    # the remaining vectors keep their order
+    remaining = [doc_id for position, doc_id in sorted(vector_db.index_to_docstore_id.items())
+                 if position not in removed_positions]
+    vector_db.index_to_docstore_id = dict(enumerate(remaining))
+
+
+def build_ann_vector_db(chunks: Dict[str, Document], embeddings: CachedEmbeddings,
+                        batch_size: int, spec: IndexSpec) -> FAISS:
+    ids = list(chunks)
+    docs = [chunks[i] for i in ids]
+    vectors = np.asarray(embed_in_batches(embeddings, docs, batch_size), dtype=np.float32)
+    index = build_index(vectors, spec)
+    print(f"index:built {describe(index)} over {index.ntotal} vectors")
+    return FAISS(embeddings.embed_query, index, InMemoryDocstore(dict(zip(ids, docs))),
+                 dict(enumerate(ids)))
+
+
+def write_recall_report(tenant: str, chunks: Dict[str, Document], embeddings: CachedEmbeddings,
+                        batch_size: int, spec: IndexSpec) -> None:
+    vectors = np.asarray(embed_in_batches(embeddings, list(chunks.values()), batch_size), dtype=np.float32)
+    specs = [IndexSpec(**{**spec.to_dict(), "index_type": t}) for t in INDEX_TYPES]
+    rows = recall_report(vectors, specs)
+    print(f"{tenant}:recall report over {len(vectors)} chunks\n{format_report(rows)}")
+    with open(f"index_report-{tenant}.json", "w") as f:
+        json.dump(rows, f, indent=2)
+
+
+def ingest_tenant(tenant: str, datafile: str, bucket: str, embeddings: CachedEmbeddings,
+                  batch_size: int, full: bool, spec: IndexSpec, bm25: bool = False,
+                  report: bool = False) -> Dict[str, int]:
+    s3 = boto3.resource('s3')
+    local_dir = f"{FAISS_INDEX_DIR}-{tenant}"
+    chunks = load_chunks(datafile)
+    if report:
+        write_recall_report(tenant, chunks, embeddings, batch_size, spec)
+
+    vector_db = None if full else load_existing_index(s3, bucket, local_dir, embeddings)
+    existing_ids = set(vector_db.index_to_docstore_id.values()) if vector_db else set()
+    added = [i for i in chunks if i not in existing_ids]
+    removed = [i for i in existing_ids if i not in chunks]
+    print(f"{tenant}:chunks={len(chunks)}, added={len(added)}, removed={len(removed)}")
+
+    # indexes published before the SQLite docstore existed, or built with
+    # another index type, are published again
+    if vector_db is not None and not added and not removed and index_up_to_date(local_dir, spec, bm25):
+        print(f"{tenant}:index is up to date")
+        return {"chunks": len(chunks), "added": 0, "removed": 0}
+
+    if spec.index_type != "flat" or (vector_db is not None and not isinstance(vector_db.index, faiss.IndexFlat)):
+        # trained indexes are rebuilt so that they are trained on the current corpus
+        vector_db = build_ann_vector_db(chunks, embeddings, batch_size, spec)
+    else:
+        vector_db = apply_delta(vector_db, chunks, added, removed, embeddings, batch_size)
 
     print(f"vector_db:created={vector_db}::")
+    save_and_publish(s3, tenant, bucket, vector_db, local_dir, spec, bm25)
+    return {"chunks": len(chunks), "added": len(added), "removed": len(removed)}
+
+
+def save_and_publish(s3, tenant: str, bucket: str, vector_db: FAISS, local_dir: str,
+                     spec: IndexSpec, bm25: bool) -> None:
+    vector_db.save_local(local_dir)
+    save_sqlite_docstore(vector_db, local_dir, bm25)
+    with open(os.path.join(local_dir, INDEX_SPEC_FILE), "w") as f:
+        json.dump({**spec.to_dict(), "bm25": bm25}, f, sort_keys=True)
+
+    print(f"S3 Bucket: ${bucket}")
+    try:
+        version = publish_index(s3, bucket, local_dir)
+        print(f"{tenant}:published version={version}")
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == "404":
+            print("The object does not exist.")
+        else:
+            raise
+
+
+def source_fingerprint(datafile: str) -> Dict:
+    # hashing a multi-GB source on every run would take longer than reading it
+    stat = os.stat(datafile)
+    return {"source": os.path.abspath(datafile), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def open_streaming_docstore(checkpoint_dir: str) -> sqlite3.Connection:
+    """
+    The docstore being written by a streaming run, with the ids of the chunks
+    seen in the source attached as seen.ids.
+    """
+    conn = sqlite3.connect(os.path.join(checkpoint_dir, DOCSTORE_FILE))
+    create_docs_table(conn)
+    conn.execute("ATTACH DATABASE ? AS seen", (os.path.join(checkpoint_dir, SEEN_FILE),))
+    conn.execute("CREATE TABLE IF NOT EXISTS seen.ids (id TEXT PRIMARY KEY)")
+    return conn
+
+
+def save_checkpoint(index: faiss.Index, conn: sqlite3.Connection, checkpoint_dir: str, state: Dict) -> None:
+    """
+    Commits the documents added since the previous checkpoint and saves the
+    index and the state. The documents are committed first: a failure before
+    the state is saved leaves documents past the saved index, which the
+    resumed run drops, and rows that are read again but not added twice.
+    """
+    conn.commit()
+    tmp_path = os.path.join(checkpoint_dir, "index.faiss.tmp")
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, os.path.join(checkpoint_dir, "index.faiss"))
+    tmp_path = os.path.join(checkpoint_dir, f"{CHECKPOINT_FILE}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, sort_keys=True)
+    os.replace(tmp_path, os.path.join(checkpoint_dir, CHECKPOINT_FILE))
+
+
+def load_checkpoint(checkpoint_dir: str, fingerprint: Dict,
+                    full: bool) -> Optional[Tuple[faiss.Index, sqlite3.Connection, Dict]]:
+    """
+    The index, docstore and state of the checkpoint left by a failed run over
+    the same source, None when there is none.
+    """
+    try:
+        with open(os.path.join(checkpoint_dir, CHECKPOINT_FILE)) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("fingerprint") != fingerprint or state.get("full") != full or "indexed" not in state:
+        print(f"checkpoint in {checkpoint_dir} is for another source or mode, ignoring it")
+        return None
+    index = faiss.read_index(os.path.join(checkpoint_dir, "index.faiss")) if state["indexed"] else None
+    conn = open_streaming_docstore(checkpoint_dir)
+    conn.execute("DELETE FROM docs WHERE position >= ?", (state["indexed"],))
+    return index, conn, state
+
+
+def start_streaming(s3, bucket: str, local_dir: str, checkpoint_dir: str,
+                    full: bool) -> Tuple[Optional[faiss.Index], sqlite3.Connection]:
+    """
+    Starts the docstore of a streaming run from a copy of the previous
+    index's one, returns the previous index, None when it is rebuilt.
+    """
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    os.makedirs(checkpoint_dir)
+    index = None
+    have_local = all(os.path.exists(os.path.join(local_dir, f)) for f in ("index.faiss", DOCSTORE_FILE))
+    if not full and (have_local or download_existing_index(s3, bucket, local_dir, STREAMING_PUBLISHED_FILES)):
+        if not os.path.exists(os.path.join(local_dir, DOCSTORE_FILE)):
+            print(f"existing index in {local_dir} has no SQLite docstore, rebuilding it")
+        else:
+            index = faiss.read_index(os.path.join(local_dir, "index.faiss"))
+            shutil.copyfile(os.path.join(local_dir, DOCSTORE_FILE), os.path.join(checkpoint_dir, DOCSTORE_FILE))
+    conn = open_streaming_docstore(checkpoint_dir)
+    if index is not None:
+        # the BM25 index is rebuilt on publish
+        conn.execute("DROP TABLE IF EXISTS docs_fts")
+        count, without_chunk_id = conn.execute(
+            "SELECT COUNT(*), TOTAL(length(id) != 64) FROM docs").fetchone()
+        if not isinstance(index, faiss.IndexFlat) or without_chunk_id or count != index.ntotal:
+            print(f"existing index in {local_dir} is not a flat index with chunk ids, rebuilding it")
+            index = None
+            conn.execute("DELETE FROM docs")
+        conn.commit()
+    return index, conn
+
+
+def add_batch(index: Optional[faiss.Index], conn: sqlite3.Connection, docs: List[Document],
+              embeddings: CachedEmbeddings, batch_size: int) -> Tuple[Optional[faiss.Index], int]:
+    """
+    Records the chunks of a batch of rows as seen and adds the ones that are
+    not indexed yet, returns the index and the number of chunks added.
+    """
+    chunks: Dict[str, Document] = {}
+    for d in split_documents(docs):
+        chunks.setdefault(chunk_id(d), d)
+    conn.executemany("INSERT OR IGNORE INTO seen.ids VALUES (?)", ((i,) for i in chunks))
+    ids = list(chunks)
+    indexed = set()
+    # stay well below the sqlite host parameter limit
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        indexed.update(row[0] for row in conn.execute(
+            f"SELECT id FROM docs WHERE id IN ({','.join('?' * len(chunk))})", chunk))
+    added = [i for i in ids if i not in indexed]
+    if not added:
+        return index, 0
+    vectors = np.asarray(embed_in_batches(embeddings, [chunks[i] for i in added], batch_size), dtype=np.float32)
+    if index is None:
+        # the index langchain's FAISS builds
+        index = faiss.IndexFlatL2(vectors.shape[1])
+    start = index.ntotal
+    index.add(vectors)
+    conn.executemany("INSERT INTO docs VALUES (?, ?, ?, ?)",
+                     (doc_row(start + n, i, chunks[i]) for n, i in enumerate(added)))
+    return index, len(added)
+
 
-    vector_db.save_local(f"{FAISS_INDEX_DIR}-{t}")
-    
-    S3_BUCKET=f"contextual-data-{t}-{os.environ.get('RANDOM_STRING')}"
-    print(f"S3 Bucket: ${S3_BUCKET}")
+def remove_unseen(index: faiss.Index, conn: sqlite3.Connection) -> int:
+    """
+    Removes the chunks of the previous index that are no longer in the
+    source and renumbers the documents after them like remove_ids does.
+    """
+    removed = [p for (p,) in conn.execute(
+        "SELECT position FROM docs WHERE id NOT IN (SELECT id FROM seen.ids) ORDER BY position")]
+    if not removed:
+        return 0
+    index.remove_ids(np.asarray(removed, dtype=np.int64))
+    conn.execute("CREATE TABLE docs_kept AS SELECT ROW_NUMBER() OVER (ORDER BY position) - 1 AS position, "
+                 "id, page_content, metadata FROM docs WHERE id IN (SELECT id FROM seen.ids)")
+    conn.execute("DROP TABLE docs")
+    create_docs_table(conn)
+    conn.execute("INSERT INTO docs SELECT position, id, page_content, metadata FROM docs_kept ORDER BY position")
+    conn.execute("DROP TABLE docs_kept")
+    conn.commit()
+    return len(removed)
 
-    s3_path = f"s3://{S3_BUCKET}/{DATAFILE}"
-    
+
+def ingest_tenant_streaming(tenant: str, datafile: str, bucket: str, embeddings: CachedEmbeddings,
+                            batch_size: int, full: bool, bm25: bool = False,
+                            rows_per_batch: int = 1000, checkpoint_rows: int = 100000) -> Dict[str, int]:
+    """
+    Incremental ingestion of a flat index that keeps a batch of rows and the
+    vectors of the index in memory, see --streaming.
+    """
     s3 = boto3.resource('s3')
+    local_dir = f"{FAISS_INDEX_DIR}-{tenant}"
+    checkpoint_dir = f"{local_dir}{CHECKPOINT_SUFFIX}"
+    fingerprint = source_fingerprint(datafile)
 
+    checkpoint = load_checkpoint(checkpoint_dir, fingerprint, full)
+    if checkpoint is not None:
+        index, conn, state = checkpoint
+        print(f"{tenant}:resuming after row {state['rows']} with {state['added']} chunks added")
+    else:
+        index, conn = start_streaming(s3, bucket, local_dir, checkpoint_dir, full)
+        existing = index.ntotal if index is not None else 0
+        state = {"fingerprint": fingerprint, "full": full, "rows": 0, "added": 0,
+                 "existing": existing, "indexed": existing}
     try:
-        to_upload = os.listdir(f"./{FAISS_INDEX_DIR}-{t}")
-        for file in to_upload:
-            s3.Bucket(S3_BUCKET).upload_file(f"./{FAISS_INDEX_DIR}-{t}/{file}", f"{FAISS_INDEX_DIR}/{file}", )
+        documents = read_csv_documents(datafile)
+        # the rows before the checkpoint were added and seen already
+        rows = sum(1 for _ in itertools.islice(documents, state["rows"]))
+        checkpointed_rows = rows
+        while True:
+            batch = list(itertools.islice(documents, rows_per_batch))
+            if not batch:
+                break
+            rows += len(batch)
+            index, added = add_batch(index, conn, batch, embeddings, batch_size)
+            state["added"] += added
+            if rows - checkpointed_rows >= checkpoint_rows and index is not None:
+                state["rows"] = checkpointed_rows = rows
+                state["indexed"] = index.ntotal
+                save_checkpoint(index, conn, checkpoint_dir, state)
+                print(f"{tenant}:checkpoint after row {rows}, {index.ntotal} chunks indexed")
+        conn.commit()
+
+        if index is None:
+            raise ValueError(f"{datafile} has no rows")
+        removed = remove_unseen(index, conn)
+        chunks = conn.execute("SELECT COUNT(*) FROM seen.ids").fetchone()[0]
+        stats = {"rows": rows, "chunks": chunks, "added": state["added"], "removed": removed}
+        print(f"{tenant}:{stats}")
+
+        spec = IndexSpec(index_type="flat")
+        if state["existing"] and not state["added"] and not removed and index_up_to_date(local_dir, spec, bm25):
+            print(f"{tenant}:index is up to date")
+        else:
+            if bm25:
+                add_bm25_index(conn)
+                conn.commit()
+            conn.close()
+            publish_streaming(s3, tenant, bucket, index, checkpoint_dir, local_dir, spec, bm25)
+    finally:
+        conn.close()
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    return stats
+
+
+def publish_streaming(s3, tenant: str, bucket: str, index: faiss.Index, checkpoint_dir: str, local_dir: str,
+                      spec: IndexSpec, bm25: bool) -> None:
+    """
+    Moves the index and docstore of a streaming run to the local index and
+    publishes them. index.pkl is not written, a stale one is removed.
+    """
+    os.makedirs(local_dir, exist_ok=True)
+    faiss.write_index(index, os.path.join(local_dir, "index.faiss"))
+    os.replace(os.path.join(checkpoint_dir, DOCSTORE_FILE), os.path.join(local_dir, DOCSTORE_FILE))
+    if os.path.exists(os.path.join(local_dir, "index.pkl")):
+        os.remove(os.path.join(local_dir, "index.pkl"))
+    with open(os.path.join(local_dir, INDEX_SPEC_FILE), "w") as f:
+        json.dump({**spec.to_dict(), "bm25": bm25}, f, sort_keys=True)
+
+    try:
+        version = publish_index(s3, bucket, local_dir, STREAMING_PUBLISHED_FILES)
+        print(f"{tenant}:published version={version}")
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404":
             print("The object does not exist.")
         else:
             raise
+
+
+def read_manifest(path: Optional[str]) -> Dict[str, Dict[str, str]]:
+    manifest = TENANTS
+    if path:
+        with open(path) as f:
+            manifest = json.load(f)
+    tenants = {}
+    for t, source in manifest.items():
+        if isinstance(source, str):
+            source = {"source": source}
+        source.setdefault("bucket", f"contextual-data-{t}-{os.environ.get('RANDOM_STRING')}")
+        tenants[t] = source
+    return tenants
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest tenant CSV files into FAISS indexes")
+    parser.add_argument("--manifest", help="JSON file mapping tenant to its source (and bucket)")
+    parser.add_argument("--tenant-concurrency", type=int, default=2,
+                        help="number of tenants ingested in parallel")
+    parser.add_argument("--embedding-concurrency", type=int, default=8,
+                        help="maximum number of in-flight Bedrock embedding calls, across all tenants")
+    parser.add_argument("--batch-size", type=int, default=256,
+                        help="number of chunks embedded (and cached) per batch")
+    parser.add_argument("--max-retries", type=int, default=8,
+                        help="retries with exponential backoff when Bedrock throttles")
+    parser.add_argument("--full", action="store_true",
+                        help="ignore the existing index and rebuild from scratch")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default="flat",
+                        help="flat (exact) or an approximate index trained on the tenant's embeddings")
+    parser.add_argument("--nlist", type=int, help="IVF lists, 4 * sqrt(chunks) by default")
+    parser.add_argument("--nprobe", type=int, default=8, help="IVF lists visited per search")
+    parser.add_argument("--hnsw-m", type=int, default=32, help="HNSW neighbours per node")
+    parser.add_argument("--ef-construction", type=int, default=200, help="HNSW build time search depth")
+    parser.add_argument("--ef-search", type=int, default=64, help="HNSW query time search depth")
+    parser.add_argument("--pq-m", type=int, help="PQ sub-quantizers, must divide the embedding dimension")
+    parser.add_argument("--pq-bits", type=int, default=8, help="bits per PQ sub-quantizer code")
+    parser.add_argument("--bm25", action="store_true",
+                        help="also build a BM25 index for hybrid lexical and vector retrieval")
+    parser.add_argument("--recall-report", action="store_true",
+                        help="print recall@4 and latency of every index type against the flat index")
+    parser.add_argument("--streaming", action="store_true",
+                        help="read the sources lazily and add them to the index in batches, with checkpoints")
+    parser.add_argument("--rows-per-batch", type=int, default=1000,
+                        help="CSV rows split, embedded and added to the index per batch with --streaming")
+    parser.add_argument("--checkpoint-rows", type=int, default=100000,
+                        help="CSV rows between two checkpoints of the index with --streaming")
+    args = parser.parse_args()
+    if args.streaming and (args.index_type != "flat" or args.recall_report):
+        parser.error("--streaming builds flat indexes, approximate indexes are trained on all the embeddings")
+    spec = IndexSpec(index_type=args.index_type, nlist=args.nlist, nprobe=args.nprobe, hnsw_m=args.hnsw_m,
+                     ef_construction=args.ef_construction, ef_search=args.ef_search,
+                     pq_m=args.pq_m, pq_bits=args.pq_bits)
+
+    boto3_bedrock = boto3.client(service_name=bedrock_service,
+                                 config=Config(max_pool_connections=args.embedding_concurrency,
+                                               retries={'max_attempts': 3, 'mode': 'adaptive'}))
+    br_embeddings = BedrockEmbeddings(client=boto3_bedrock, model_id=embeddings_model)
+    cached_embeddings = CachedEmbeddings(br_embeddings, embeddings_model, EMBEDDING_CACHE_DIR,
+                                         batch_concurrency=args.embedding_concurrency,
+                                         max_retries=args.max_retries,
+                                         bedrock_limiter=threading.BoundedSemaphore(args.embedding_concurrency))
+
+    tenants = read_manifest(args.manifest)
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.tenant_concurrency) as executor:
+        if args.streaming:
+            futures = {executor.submit(ingest_tenant_streaming, t, cfg["source"], cfg["bucket"], cached_embeddings,
+                                       args.batch_size, args.full, args.bm25, args.rows_per_batch,
+                                       args.checkpoint_rows): t
+                       for t, cfg in tenants.items()}
+        else:
+            futures = {executor.submit(ingest_tenant, t, cfg["source"], cfg["bucket"], cached_embeddings,
+                                       args.batch_size, args.full, spec, args.bm25, args.recall_report): t
+                       for t, cfg in tenants.items()}
+        for future in as_completed(futures):
+            t = futures[future]
+            try:
+                print(f"{t}:done {future.result()}")
+            except Exception as e:
+                print(f"{t}:failed {e}")
+                failed.append(t)
+
+    print(f"embeddings:cache hits={cached_embeddings.hits}, misses={cached_embeddings.misses}, "
+          f"retries={cached_embeddings.retries}")
+    if failed:
+        raise SystemExit(f"ingestion failed for tenants: {failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+On-disk embedding cache for the ingestion script.
+
+Embeddings are stored in a SQLite file keyed by a hash of the model id and
+the chunk text, so re-ingesting an unchanged source does not call Bedrock
+again. Chunks that are not cached yet are embedded in parallel since Titan
+embeddings take one text per invocation, with exponential backoff when
+Bedrock throttles.
+"""
+import os
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+
+THROTTLING_ERRORS = ("ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException")
+
+
+def embedding_key(model_id: str, text: str) -> str:
+    return hashlib.sha256(f"{model_id}\0{text}".encode("utf-8")).hexdigest()
+
+
+def is_throttling_error(e: Exception) -> bool:
+    # BedrockEmbeddings re-raises the botocore error as a ValueError
+    return any(code in str(e) for code in THROTTLING_ERRORS)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Thread safe, one instance is shared by all the tenants ingested in
+    parallel. bedrock_limiter bounds the number of in-flight Bedrock calls
+    across all of them.
+    """
+    def __init__(self, embeddings: Embeddings, model_id: str, cache_dir: str,
+                 batch_concurrency: int = 8, max_retries: int = 8,
+                 bedrock_limiter: Optional[threading.BoundedSemaphore] = None):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.embeddings = embeddings
+        self.model_id = model_id
+        self.batch_concurrency = batch_concurrency
+        self.max_retries = max_retries
+        self.bedrock_limiter = bedrock_limiter or threading.BoundedSemaphore(batch_concurrency)
+        self.path = os.path.join(cache_dir, "embeddings.sqlite")
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.retries = 0
+
+    def _get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self.conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                                         chunk).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def _put_many(self, items: Dict[str, List[float]]) -> None:
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                                  [(k, np.asarray(v, dtype=np.float32).tobytes()) for k, v in items.items()])
+
+    def _embed_with_retry(self, text: str) -> List[float]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.bedrock_limiter:
+                    return self.embeddings.embed_query(text)
+            except Exception as e:
+                if attempt == self.max_retries or not is_throttling_error(e):
+                    raise
+                with self._lock:
+                    self.retries += 1
+                # full jitter exponential backoff, capped at 20 seconds
+                time.sleep(random.uniform(0, min(20, 0.5 * 2 ** attempt)))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [embedding_key(self.model_id, t) for t in texts]
+        found = self._get_many(list(set(keys)))
+        missing = {k: t for k, t in zip(keys, texts) if k not in found}
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.batch_concurrency) as executor:
+                vectors = list(executor.map(self._embed_with_retry, missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self._put_many(computed)
+            found.update(computed)
+        with self._lock:
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        return [found[k] for k in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
@@ -0,0 +1,37 @@
+"""
+Shared setup of the unit tests. The API and the ingestion script are imported
+from their directories like the benchmark does, and the AWS services are
+replaced by the benchmark's local stand-ins.
+"""
+import os
+import sys
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "api", "app"))
+sys.path.insert(0, os.path.join(REPO_DIR, "api", "benchmark"))
+sys.path.insert(0, os.path.join(REPO_DIR, "data_ingestion_to_vectordb"))
+
+# the API reads its configuration from the environment at import time
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("BEDROCK_SERVICE", "bedrock-runtime")
+os.environ.setdefault("TEXT2TEXT_MODEL_ID", "anthropic.claude-v2")
+os.environ.setdefault("EMBEDDING_MODEL_ID", "amazon.titan-embed-text-v1")
+os.environ.setdefault("CHATHISTORY_TABLE", "test-chat-history")
+os.environ.setdefault("CONTEXTUAL_DATA_BUCKET", "contextual-data-test")
+os.environ.setdefault("VECTORDB_REFRESH_SECONDS", "0")
+
+import fakes  # noqa: E402
+
+
+@pytest.fixture
+def table():
+    """
+    An in-memory chat history table without latency.
+    """
+    return fakes.FakeTable("test-chat-history", fakes.Latency())
+
+
+@pytest.fixture
+def s3(tmp_path):
+    return fakes.FakeS3(str(tmp_path / "s3"))
@@ -0,0 +1,87 @@
+import pytest
+from api.api_v1.endpoints import answer_cache as answer_cache_module
+from api.api_v1.endpoints.answer_cache import SemanticAnswerCache, normalize_question
+
+
+def store(cache, question, embedding, answer="answer", version="v1", params_key="p"):
+    cache.store("tenant", version, params_key, question, embedding, answer, [])
+
+
+def test_normalize_question():
+    assert normalize_question("  What is   SageMaker? ") == "what is sagemaker?"
+
+
+def test_exact_hit_on_the_normalized_question():
+    cache = SemanticAnswerCache(threshold=0.95)
+    store(cache, "What is SageMaker?", [1, 0])
+    entry = cache.lookup_exact("tenant", "v1", "p", "what is  sagemaker?")
+    assert entry is not None and entry.answer == "answer"
+    assert cache.lookup_exact("tenant", "v1", "other-params", "what is sagemaker?") is None
+
+
+def test_semantic_hit_above_the_threshold_only():
+    cache = SemanticAnswerCache(threshold=0.95)
+    store(cache, "What is SageMaker?", [1, 0])
+    assert cache.lookup("tenant", "v1", "p", "What's SageMaker?", [0.99, 0.05]).answer == "answer"
+    assert cache.lookup("tenant", "v1", "p", "What is EMR?", [0.5, 0.5]) is None
+    assert cache.stats()["tenants"]["tenant"]["hits"] == 1
+    assert cache.stats()["tenants"]["tenant"]["misses"] == 1
+
+
+def test_entries_are_evicted_in_lru_order():
+    cache = SemanticAnswerCache(max_entries=2)
+    store(cache, "q1", [1, 0, 0])
+    store(cache, "q2", [0, 1, 0])
+    assert cache.lookup_exact("tenant", "v1", "p", "q1") is not None
+    store(cache, "q3", [0, 0, 1])
+    assert cache.lookup_exact("tenant", "v1", "p", "q2") is None
+    assert cache.lookup_exact("tenant", "v1", "p", "q1") is not None
+
+
+def test_entries_expire(monkeypatch):
+    cache = SemanticAnswerCache(ttl_seconds=60)
+    now = [1000.0]
+    monkeypatch.setattr(answer_cache_module.time, "time", lambda: now[0])
+    store(cache, "q1", [1, 0])
+    now[0] += 61
+    assert cache.lookup_exact("tenant", "v1", "p", "q1") is None
+
+
+def test_index_swap_drops_the_older_versions():
+    cache = SemanticAnswerCache()
+    cache.index_swapped("tenant", "v1")
+    store(cache, "q1", [1, 0])
+    cache.index_swapped("tenant", "v2")
+    assert cache.lookup_exact("tenant", "v2", "p", "q1") is None
+    assert cache.stats()["tenants"]["tenant"]["entries"] == 0
+    assert cache.stats()["tenants"]["tenant"]["invalidations"] == 1
+
+
+def test_requests_on_an_older_version_do_not_thrash_the_cache():
+    cache = SemanticAnswerCache()
+    cache.index_swapped("tenant", "v2")
+    store(cache, "q1", [1, 0], version="v2")
+    # a request still running on the previous index
+    assert cache.lookup("tenant", "v1", "p", "q1", [1, 0]) is None
+    store(cache, "q2", [0, 1], version="v1")
+    assert cache.lookup_exact("tenant", "v2", "p", "q1") is not None
+    assert cache.lookup_exact("tenant", "v1", "p", "q2") is None
+    assert cache.stats()["tenants"]["tenant"]["entries"] == 1
+    assert cache.stats()["tenants"]["tenant"]["invalidations"] == 0
+
+
+def test_invalidate_drops_the_tenant_only():
+    cache = SemanticAnswerCache()
+    store(cache, "q1", [1, 0])
+    cache.store("other", "v1", "p", "q1", [1, 0], "answer", [])
+    cache.invalidate("tenant")
+    assert cache.lookup_exact("tenant", "v1", "p", "q1") is None
+    assert cache.lookup_exact("other", "v1", "p", "q1") is not None
+    assert cache.stats()["tenants"]["tenant"]["invalidations"] == 1
+
+
+@pytest.mark.parametrize("embedding", [[0, 0], [0.0, 0.0, 0.0]])
+def test_zero_embeddings_do_not_match(embedding):
+    cache = SemanticAnswerCache(threshold=0.5)
+    store(cache, "q1", [1] + [0] * (len(embedding) - 1))
+    assert cache.lookup("tenant", "v1", "p", "q2", embedding) is None
@@ -0,0 +1,132 @@
+import asyncio
+import pytest
+from api.api_v1.endpoints import bedrock_scheduler
+from api.api_v1.endpoints.bedrock_scheduler import BedrockScheduler, BedrockThrottledError, TokenBucket
+
+
+# how langchain re-raises a throttled botocore call
+THROTTLED = "Error raised by bedrock service: An error occurred (ThrottlingException) when calling InvokeModel"
+
+
+def test_token_bucket_serves_the_burst_then_the_rate():
+    bucket = TokenBucket(rate=10, burst=3)
+    assert [bucket.reserve(max_wait=1) for _ in range(3)] == [0, 0, 0]
+    # tokens are reserved in advance, so the waits grow
+    assert bucket.reserve(max_wait=1) == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve(max_wait=1) == pytest.approx(0.2, abs=0.01)
+
+
+def test_token_bucket_rejects_waits_longer_than_max_wait():
+    bucket = TokenBucket(rate=1, burst=1)
+    bucket.reserve(max_wait=0)
+    with pytest.raises(BedrockThrottledError) as e:
+        bucket.reserve(max_wait=0.5)
+    assert e.value.retry_after == pytest.approx(1, abs=0.01)
+    # a rejected call does not take a token
+    assert bucket.tokens == pytest.approx(0, abs=0.01)
+
+
+def test_throttling_halves_the_limit_once_per_interval():
+    scheduler = BedrockScheduler(max_concurrency=16)
+    scheduler.active = 2
+    scheduler.release(throttled=True)
+    scheduler.release(throttled=True)
+    assert scheduler.limit == 8
+    assert scheduler.throttled == 2
+
+
+def test_successful_calls_grow_the_limit_up_to_the_maximum():
+    scheduler = BedrockScheduler(max_concurrency=4)
+    scheduler.limit = 2.0
+    scheduler.active = 10
+    scheduler.release(throttled=False)
+    scheduler.release(throttled=False)
+    assert scheduler.limit == pytest.approx(2.9, abs=0.01)
+    for _ in range(6):
+        scheduler.release(throttled=False)
+    assert scheduler.limit == 4
+
+
+def test_limit_does_not_drop_below_one():
+    scheduler = BedrockScheduler(max_concurrency=1)
+    scheduler.active = 1
+    scheduler.release(throttled=True)
+    assert scheduler.limit == 1
+
+
+def test_waiting_tenants_are_served_round_robin():
+    async def scenario():
+        scheduler = BedrockScheduler(max_concurrency=1, calls_per_second=0)
+        await scheduler.acquire("busy")
+        served = []
+
+        async def call(tenant):
+            await scheduler.acquire(tenant)
+            served.append(tenant)
+
+        tasks = [asyncio.ensure_future(call(t)) for t in ("a", "a", "a", "b")]
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth("a") == 3 and scheduler.queue_depth("b") == 1
+        for _ in tasks:
+            scheduler.release(throttled=False)
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return served
+
+    assert asyncio.run(scenario()) == ["a", "b", "a", "a"]
+
+
+def test_queue_timeout_rejects_and_leaves_the_queue(monkeypatch):
+    monkeypatch.setattr(bedrock_scheduler, "BEDROCK_QUEUE_TIMEOUT_SECONDS", 0.01)
+
+    async def scenario():
+        scheduler = BedrockScheduler(max_concurrency=1, calls_per_second=0)
+        await scheduler.acquire("busy")
+        with pytest.raises(BedrockThrottledError):
+            await scheduler.acquire("a")
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler.queue_depth("a") == 0
+    assert scheduler.rejected == 1
+
+
+def test_throttled_calls_are_retried(monkeypatch):
+    monkeypatch.setattr(bedrock_scheduler, "backoff_delay", lambda attempt: 0)
+    attempts = []
+
+    def call():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ValueError(THROTTLED)
+        return "answer"
+
+    scheduler = BedrockScheduler(max_concurrency=4, calls_per_second=0)
+    assert asyncio.run(scheduler.run(call)) == "answer"
+    assert len(attempts) == 3
+    assert scheduler.retries == 2 and scheduler.throttled == 2 and scheduler.active == 0
+
+
+def test_other_errors_are_not_retried(monkeypatch):
+    monkeypatch.setattr(bedrock_scheduler, "backoff_delay", lambda attempt: 0)
+
+    def call():
+        raise ValueError("invalid prompt")
+
+    scheduler = BedrockScheduler(max_concurrency=4, calls_per_second=0)
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.run(call))
+    assert scheduler.retries == 0 and scheduler.active == 0
+
+
+def test_calls_still_throttled_after_the_retries_are_rejected(monkeypatch):
+    monkeypatch.setattr(bedrock_scheduler, "backoff_delay", lambda attempt: 0)
+    monkeypatch.setattr(bedrock_scheduler, "BEDROCK_MAX_RETRIES", 1)
+
+    def call():
+        raise ValueError(THROTTLED)
+
+    scheduler = BedrockScheduler(max_concurrency=4, calls_per_second=0)
+    with pytest.raises(BedrockThrottledError):
+        asyncio.run(scheduler.run(call))
+    assert scheduler.retries == 1 and scheduler.rejected == 1
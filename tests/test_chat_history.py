@@ -0,0 +1,103 @@
+import pytest
+from langchain.schema.messages import AIMessage, HumanMessage
+from api.api_v1.endpoints import chat_history
+from api.api_v1.endpoints.chat_history import SessionHistoryCache, WindowedDynamoDBChatMessageHistory
+
+
+@pytest.fixture(autouse=True)
+def small_window(monkeypatch):
+    monkeypatch.setattr(chat_history, "HISTORY_WINDOW_TURNS", 2)
+    monkeypatch.setattr(chat_history, "HISTORY_MAX_TURNS", 3)
+
+
+def turn(i):
+    return [HumanMessage(content=f"question {i}"), AIMessage(content=f"answer {i}")]
+
+
+def worker_history(table, session_id="session"):
+    """
+    The history of a session as seen by one worker, with its own cache.
+    """
+    return WindowedDynamoDBChatMessageHistory(table, session_id, cache=SessionHistoryCache())
+
+
+def stored(table, session_id="session"):
+    return table.get_item(Key={"SessionId": session_id})["Item"]
+
+
+def test_turns_are_appended(table):
+    history = worker_history(table)
+    history.add_messages(turn(1))
+    history.add_messages(turn(2))
+    assert [m.content for m in history.messages] == ["question 1", "answer 1", "question 2", "answer 2"]
+    assert len(stored(table)["History"]) == 4
+    assert stored(table)["Version"] == 2
+    assert [m.content for m in worker_history(table).messages] == [m.content for m in history.messages]
+
+
+def test_history_is_compacted_past_the_maximum(table):
+    history = worker_history(table)
+    for i in range(1, 4):
+        history.add_messages(turn(i))
+    assert history.evicted_by(turn(4)) == turn(1) + turn(2)
+    history.add_messages(turn(4), summary="the user asked about 1 and 2")
+    assert [m.content for m in history.messages] == ["question 3", "answer 3", "question 4", "answer 4"]
+    assert history.summary == "the user asked about 1 and 2"
+    item = stored(table)
+    assert len(item["History"]) == 4 and item["Summary"] == "the user asked about 1 and 2"
+
+
+def test_summary_is_bounded(table, monkeypatch):
+    monkeypatch.setattr(chat_history, "HISTORY_SUMMARY_MAX_CHARS", 10)
+    history = worker_history(table)
+    for i in range(1, 5):
+        history.add_messages(turn(i), summary="x" * 20 + "the end")
+    assert history.summary == "xxxthe end"
+
+
+def test_unsaved_turns_are_read_back_before_they_are_written(table):
+    history = worker_history(table)
+    history.add_messages(turn(1))
+    history.add_unsaved(turn(2))
+    assert len(history.messages) == 4
+    assert len(stored(table)["History"]) == 2
+    history.save_unsaved(2)
+    assert len(stored(table)["History"]) == 4 and stored(table)["Version"] == 2
+
+
+def test_a_stale_cache_is_reloaded_before_writing(table, monkeypatch):
+    # the cached copy is not checked, the conditional write detects it
+    monkeypatch.setattr(chat_history, "HISTORY_CACHE_CHECK_SECONDS", 3600)
+    first, second = worker_history(table), worker_history(table)
+    first.add_messages(turn(1))
+    assert len(second.messages) == 2
+    first.add_messages(turn(2))
+    second.add_messages(turn(3))
+    contents = [m["data"]["content"] for m in stored(table)["History"]]
+    assert contents == ["question 1", "answer 1", "question 2", "answer 2", "question 3", "answer 3"]
+    assert [m.content for m in second.messages] == contents
+    assert stored(table)["Version"] == 3
+
+
+def test_turns_written_by_another_worker_are_seen(table, monkeypatch):
+    monkeypatch.setattr(chat_history, "HISTORY_CACHE_CHECK_SECONDS", 0)
+    first, second = worker_history(table), worker_history(table)
+    first.add_messages(turn(1))
+    assert len(second.messages) == 2
+    first.add_messages(turn(2))
+    assert len(second.messages) == 4
+
+
+def test_items_written_before_versions_are_updated(table):
+    table.put_item(Item={"SessionId": "session", "History": chat_history.messages_to_dict(turn(1))})
+    history = worker_history(table)
+    history.add_messages(turn(2))
+    assert len(stored(table)["History"]) == 4 and stored(table)["Version"] == 1
+
+
+def test_clear(table):
+    history = worker_history(table)
+    history.add_messages(turn(1))
+    history.clear()
+    assert history.messages == []
+    assert "Item" not in table.get_item(Key={"SessionId": "session"})
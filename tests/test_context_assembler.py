@@ -0,0 +1,56 @@
+from langchain.schema import Document
+from api.api_v1.endpoints import context_assembler
+from api.api_v1.endpoints.context_assembler import _merge, _truncate, assemble_context
+
+ROW = " ".join(f"sentence {i} about the service." for i in range(40))
+
+
+def test_merge_drops_duplicates_and_contained_chunks():
+    assert _merge([ROW, ROW[100:300], ROW]) == [ROW]
+
+
+def test_merge_replaces_a_chunk_by_the_chunk_containing_it():
+    assert _merge([ROW[100:300], ROW]) == [ROW]
+
+
+def test_merge_joins_overlapping_chunks():
+    first, second = ROW[:600], ROW[400:]
+    assert _merge([first, second]) == [ROW]
+    assert _merge([second, first]) == [ROW]
+
+
+def test_merge_keeps_short_overlaps_apart():
+    first, second = ROW[:600], ROW[600 - context_assembler.MIN_OVERLAP_CHARS + 1:]
+    assert _merge([first, second]) == [first, second]
+
+
+def test_merge_keeps_the_order_of_relevance():
+    other = "a different row of the source with unrelated text"
+    assert _merge([other, ROW[:600], ROW[400:]]) == [other, ROW]
+
+
+def test_merge_joins_chunks_bridged_by_a_later_one():
+    a, b, bridge = ROW[:300], ROW[600:900], ROW[200:700]
+    assert _merge([a, b, bridge]) == [ROW[:900]]
+
+
+def test_truncate_cuts_at_a_sentence_boundary():
+    text = "First sentence here. Second sentence here. Third one"
+    assert _truncate(text, 45) == "First sentence here. Second sentence here."
+
+
+def test_truncate_without_a_boundary_cuts_hard():
+    assert _truncate("x" * 100, 40) == "x" * 40
+
+
+def test_assemble_context_stays_within_the_budget(monkeypatch):
+    monkeypatch.setattr(context_assembler, "CONTEXT_TOKEN_BUDGET_RATIO", 1)
+    monkeypatch.setattr(context_assembler, "MIN_TRUNCATED_TOKENS", 10)
+    other = "x " * 500
+    docs = [Document(page_content=ROW[:600]), Document(page_content=ROW[400:]), Document(page_content=other)]
+    context = assemble_context(docs, max_token_count=400)
+    # the merged row fits, the last chunk is cut to the rest of the budget
+    assert context.texts[0] == ROW
+    assert len(context.texts) == 2 and other.startswith(context.texts[1])
+    assert context.tokens_after <= 400
+    assert context.tokens_before > context.tokens_after
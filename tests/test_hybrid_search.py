@@ -0,0 +1,29 @@
+from api.api_v1.endpoints.hybrid_search import query_terms, reciprocal_rank_fusion
+
+
+def test_rrf_ranks_documents_found_by_both_retrievers_first():
+    vector, lexical = [1, 2, 3, 4], [5, 3, 6]
+    fused = reciprocal_rank_fusion([vector, lexical], k=60)
+    assert fused[0] == 3
+    assert set(fused) == {1, 2, 3, 4, 5, 6}
+
+
+def test_rrf_breaks_ties_by_rank():
+    fused = reciprocal_rank_fusion([[1, 2], [3, 4]], k=60)
+    # equal ranks in both lists score the same, the first list comes first
+    assert fused == [1, 3, 2, 4]
+
+
+def test_rrf_k_dampens_the_top_ranks():
+    rankings = [[1, 2], [3, 4, 2]]
+    # found by both retrievers beats a single top rank unless k is small
+    assert reciprocal_rank_fusion(rankings, k=60)[0] == 2
+    assert reciprocal_rank_fusion(rankings, k=0)[0] == 1
+
+
+def test_rrf_of_nothing():
+    assert reciprocal_rank_fusion([[], []]) == []
+
+
+def test_query_terms_drop_stopwords_and_duplicates():
+    assert query_terms("What is the price of SageMaker Canvas, and of Canvas?") == ["price", "sagemaker", "canvas"]
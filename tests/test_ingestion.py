@@ -0,0 +1,141 @@
+import os
+import csv
+import json
+import sqlite3
+from typing import List, Optional
+import faiss
+import numpy as np
+import pytest
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+import fakes
+import data_ingestion_to_vectordb as ingestion
+
+DIM = 64
+
+
+class HashEmbeddings(Embeddings):
+    """
+    The fake Bedrock embeddings without the Bedrock call, failing once
+    fail_after texts were embedded.
+    """
+    def __init__(self, fail_after: Optional[int] = None):
+        self.fail_after = fail_after
+        self.calls = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.fail_after is not None and self.calls + len(texts) > self.fail_after:
+            raise RuntimeError("embedding failed")
+        self.calls += len(texts)
+        return [fakes.fake_embedding(t, DIM) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def chunks_of(texts):
+    docs = [Document(page_content=t, metadata={"source": "test.csv", "row": i}) for i, t in enumerate(texts)]
+    return {ingestion.chunk_id(d): d for d in docs}
+
+
+def assert_consistent(vector_db, chunks):
+    """
+    Every chunk is indexed once, at the position its id is mapped to.
+    """
+    assert vector_db.index.ntotal == len(chunks)
+    assert sorted(vector_db.index_to_docstore_id) == list(range(len(chunks)))
+    assert set(vector_db.index_to_docstore_id.values()) == set(chunks)
+    for position, doc_id in vector_db.index_to_docstore_id.items():
+        vector = fakes.fake_embedding(chunks[doc_id].page_content, DIM)
+        np.testing.assert_allclose(vector_db.index.reconstruct(position), vector, rtol=1e-6)
+        assert vector_db.docstore.search(doc_id).page_content == chunks[doc_id].page_content
+
+
+def test_apply_delta_adds_and_removes_chunks():
+    embeddings = HashEmbeddings()
+    old = chunks_of([f"answer {i} about service {i}" for i in range(10)])
+    vector_db = ingestion.apply_delta(None, old, list(old), [], embeddings, batch_size=4)
+    assert_consistent(vector_db, old)
+
+    new = chunks_of([f"answer {i} about service {i}" for i in range(3, 14)])
+    added = [i for i in new if i not in old]
+    removed = [i for i in old if i not in new]
+    embeddings.calls = 0
+    vector_db = ingestion.apply_delta(vector_db, new, added, removed, embeddings, batch_size=4)
+    assert embeddings.calls == len(added)
+    assert_consistent(vector_db, new)
+
+
+def test_remove_chunks_keeps_the_order_of_the_remaining_ones():
+    chunks = chunks_of([f"text {i}" for i in range(6)])
+    vector_db = ingestion.apply_delta(None, chunks, list(chunks), [], HashEmbeddings(), batch_size=8)
+    ids = [vector_db.index_to_docstore_id[p] for p in range(6)]
+    ingestion.remove_chunks(vector_db, [ids[0], ids[3]])
+    assert vector_db.index_to_docstore_id == dict(enumerate([ids[1], ids[2], ids[4], ids[5]]))
+
+
+def write_csv(path, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["question", "answer"])
+        writer.writerows(rows)
+
+
+def read_docstore(local_dir):
+    conn = sqlite3.connect(os.path.join(local_dir, ingestion.DOCSTORE_FILE))
+    try:
+        return conn.execute("SELECT position, id FROM docs ORDER BY position").fetchall()
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def streaming(tmp_path, monkeypatch, s3):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ingestion.boto3, "resource", lambda *args, **kwargs: s3)
+    datafile = str(tmp_path / "faqs.csv")
+    write_csv(datafile, [(f"What is feature {i}?", f"Feature {i} does thing {i}.") for i in range(40)])
+
+    def run(embeddings, **kwargs):
+        return ingestion.ingest_tenant_streaming("tenant", datafile, "bucket", embeddings, batch_size=4,
+                                                 full=False, rows_per_batch=5, checkpoint_rows=10, **kwargs)
+    return datafile, run
+
+
+def test_streaming_resumes_from_the_checkpoint(streaming):
+    datafile, run = streaming
+    with pytest.raises(RuntimeError):
+        run(HashEmbeddings(fail_after=25))
+    checkpoint_dir = f"{ingestion.FAISS_INDEX_DIR}-tenant{ingestion.CHECKPOINT_SUFFIX}"
+    with open(os.path.join(checkpoint_dir, ingestion.CHECKPOINT_FILE)) as f:
+        state = json.load(f)
+    assert state["rows"] == 20 and state["indexed"] == 20
+
+    embeddings = HashEmbeddings()
+    stats = run(embeddings)
+    # only the rows after the checkpoint are embedded again
+    assert embeddings.calls == 20
+    assert stats == {"rows": 40, "chunks": 40, "added": 40, "removed": 0}
+    assert not os.path.exists(checkpoint_dir)
+
+    local_dir = f"{ingestion.FAISS_INDEX_DIR}-tenant"
+    rows = read_docstore(local_dir)
+    assert [p for p, _ in rows] == list(range(40))
+    assert {i for _, i in rows} == set(ingestion.load_chunks(datafile))
+    assert faiss.read_index(os.path.join(local_dir, "index.faiss")).ntotal == 40
+
+
+def test_streaming_applies_the_delta_of_the_source(streaming, s3):
+    datafile, run = streaming
+    run(HashEmbeddings())
+    write_csv(datafile, [(f"What is feature {i}?", f"Feature {i} does thing {i}.") for i in range(10, 45)])
+
+    embeddings = HashEmbeddings()
+    stats = run(embeddings)
+    assert embeddings.calls == 5
+    assert stats == {"rows": 35, "chunks": 35, "added": 5, "removed": 10}
+
+    # the published index is the one the API and the regular run load
+    local_dir = f"{ingestion.FAISS_INDEX_DIR}-tenant"
+    vector_db = ingestion.load_existing_index(s3, "bucket", local_dir, HashEmbeddings())
+    assert_consistent(vector_db, ingestion.load_chunks(datafile))
@@ -0,0 +1,39 @@
+import pytest
+from langchain.schema.messages import AIMessage, HumanMessage
+from api.api_v1.endpoints import question_rewrite
+from api.api_v1.endpoints.question_rewrite import (DISABLED, NO_HISTORY, REWRITTEN, SELF_CONTAINED,
+                                                   needs_rewrite)
+
+HISTORY = [HumanMessage(content="What is Amazon SageMaker?"),
+           AIMessage(content="A service to build, train and deploy machine learning models.")]
+
+
+def test_questions_without_history_are_not_rewritten():
+    assert needs_rewrite("How much does it cost?", []) == (False, NO_HISTORY)
+
+
+@pytest.mark.parametrize("question", [
+    "How much does it cost?",
+    "What are their limits?",
+    "And what about training jobs on GPUs?",
+    "Tell me more about the pricing model",
+    "Is that available in every region?",
+    "Pricing?",
+])
+def test_questions_referring_to_the_conversation_are_rewritten(question):
+    assert needs_rewrite(question, HISTORY) == (True, REWRITTEN)
+
+
+@pytest.mark.parametrize("question", [
+    "What is Amazon EMR used for?",
+    "How do I enable encryption for SageMaker notebooks?",
+])
+def test_self_contained_questions_are_not_rewritten(question):
+    assert needs_rewrite(question, HISTORY) == (False, SELF_CONTAINED)
+
+
+def test_modes(monkeypatch):
+    monkeypatch.setattr(question_rewrite, "CONDENSE_QUESTION_MODE", "always")
+    assert needs_rewrite("What is Amazon EMR used for?", HISTORY) == (True, REWRITTEN)
+    monkeypatch.setattr(question_rewrite, "CONDENSE_QUESTION_MODE", "never")
+    assert needs_rewrite("How much does it cost?", HISTORY) == (False, DISABLED)
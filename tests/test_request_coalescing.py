@@ -0,0 +1,77 @@
+import asyncio
+from api.api_v1.endpoints.request_coalescing import RequestCoalescer, SharedAnswer
+
+
+def test_key_normalizes_the_question():
+    assert RequestCoalescer.key("t", "v1", "p", "What is  EMR?") == RequestCoalescer.key("t", "v1", "p", "what is emr?")
+    assert RequestCoalescer.key("t", "v1", "p", "q") != RequestCoalescer.key("t", "v2", "p", "q")
+
+
+def test_followers_get_the_leaders_answer():
+    async def scenario():
+        coalescer = RequestCoalescer()
+        key = coalescer.key("t", "v1", "p", "q")
+        leader = coalescer.join(key)
+        followers = [coalescer.join(key) for _ in range(2)]
+        waits = [asyncio.ensure_future(f.wait()) for f in followers]
+        await asyncio.sleep(0)
+        leader.complete(SharedAnswer("answer", []))
+        answers = await asyncio.gather(*waits)
+        return coalescer, leader, followers, answers
+
+    coalescer, leader, followers, answers = asyncio.run(scenario())
+    assert leader.leader and not any(f.leader for f in followers)
+    assert [a.answer for a in answers] == ["answer", "answer"]
+    assert coalescer.stats()["leaders"] == 1 and coalescer.stats()["followers"] == 2
+    assert coalescer.stats()["in_flight"] == 0
+
+
+def test_followers_get_none_when_the_leader_fails():
+    async def scenario():
+        coalescer = RequestCoalescer()
+        key = coalescer.key("t", "v1", "p", "q")
+        leader = coalescer.join(key)
+        follower = coalescer.join(key)
+        leader.complete(None)
+        return await follower.wait()
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_a_completed_flight_is_not_joined():
+    async def scenario():
+        coalescer = RequestCoalescer()
+        key = coalescer.key("t", "v1", "p", "q")
+        coalescer.join(key).complete(SharedAnswer("answer", []))
+        return coalescer.join(key)
+
+    assert asyncio.run(scenario()).leader
+
+
+def test_only_the_leader_completes_the_flight():
+    async def scenario():
+        coalescer = RequestCoalescer()
+        key = coalescer.key("t", "v1", "p", "q")
+        leader = coalescer.join(key)
+        follower = coalescer.join(key)
+        follower.complete(SharedAnswer("not mine", []))
+        assert not leader.future.done()
+        leader.complete(SharedAnswer("answer", []))
+        return await follower.wait()
+
+    assert asyncio.run(scenario()).answer == "answer"
+
+
+def test_a_cancelled_follower_does_not_cancel_the_flight():
+    async def scenario():
+        coalescer = RequestCoalescer()
+        key = coalescer.key("t", "v1", "p", "q")
+        leader = coalescer.join(key)
+        first, second = coalescer.join(key), coalescer.join(key)
+        waiting = asyncio.ensure_future(first.wait())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        leader.complete(SharedAnswer("answer", []))
+        return await second.wait()
+
+    assert asyncio.run(scenario()).answer == "answer"